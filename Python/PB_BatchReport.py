@@ -0,0 +1,321 @@
+# Generates the html pages of all stubs found below a root directory
+#
+# usage: python PB_BatchReport.py <root> [--workers N] [--summary FILE]
+#
+# Each stub is parsed, matched, cropped and rendered in its own process
+# (see PB_GeneratePage.generate_page). A failing stub does not stop the
+# others, the run summary lists the result of every stub. With --trace the
+# stages of every stub are timed and written to '<stub_dir>/trace.json'.
+
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import process_PAsearch
+import trace_pipeline
+
+
+def find_stubs(root, index_file=None, scan_workers=1):
+    """
+    Finds the stubs below root and pairs them with their PA search files
+
+    Keyword arguments:
+    root -- the directory searched for stubs
+
+    index_file, scan_workers -- the discovery index and the number of
+                                threads listing the directories, see
+                                process_PAsearch.walk_stubdir
+
+    returns a list of dictionaries with the keys 'stub_dir', 'EDAX_PAsearch'
+    and 'IJ_PAsearch' (None if the stub has no such file)
+    """
+
+    stub_loc = process_PAsearch.walk_stubdir(root, index_file=index_file,
+                                             workers=scan_workers)
+
+    def by_stub(files):
+        return {os.path.dirname(file): file for file in files}
+
+    EDAX_files = by_stub(stub_loc['EDAX_PAsearch'])
+    IJ_files = by_stub(stub_loc['IJ_PAsearch'])
+
+    return [{'stub_dir': stub_dir,
+             'EDAX_PAsearch': EDAX_files.get(stub_dir),
+             'IJ_PAsearch': IJ_files.get(stub_dir)}
+            for stub_dir in stub_loc['stub_dir']]
+
+
+def process_stub(stub, options, trace=False, keep_table=False):
+    """
+    generate the page of one stub, errors are returned in the result, the
+    matched particle table as 'table' with keep_table
+    """
+
+    # imported here, so the workers load bokeh and skimage themselves
+    import PB_GeneratePage
+
+    result = dict(stub)
+    start = time.time()
+    if trace:
+        result['trace'] = os.path.join(stub['stub_dir'], 'trace.json')
+        trace_pipeline.enable(result['trace'])
+    try:
+        if stub['EDAX_PAsearch'] is None or stub['IJ_PAsearch'] is None:
+            raise FileNotFoundError('PA search file missing')
+        page = PB_GeneratePage.generate_page(
+            stub['stub_dir'], stub['EDAX_PAsearch'], stub['IJ_PAsearch'],
+            **options)
+        table = page.pop('table', None)
+        result.update(page)
+        if keep_table:
+            result['table'] = table
+        result['status'] = 'ok'
+    except Exception as err:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+        result['traceback'] = traceback.format_exc()
+    finally:
+        if trace:
+            trace_pipeline.disable()
+    result['seconds'] = round(time.time() - start, 3)
+
+    return result
+
+
+def failed_stub(stub, err):
+    """result of a stub whose worker process died"""
+
+    result = dict(stub)
+    result['status'] = 'failed'
+    result['error'] = '{}: {}'.format(type(err).__name__, err)
+    result['seconds'] = 0.0
+    return result
+
+
+def process_stubs(stubs, options, trace=False, workers=1, keep_table=False,
+                  done=None):
+    """
+    Runs process_stub for every stub in a pool of worker processes
+
+    A worker which dies (segfault, out of memory) breaks the pool and fails
+    all its pending stubs. These are submitted again to a fresh pool. The
+    pool hands the stubs to its processes in their order, at most
+    workers + 1 at a time, so only the first workers + 1 of the failed
+    stubs can have been in progress. A stub in progress when a second pool
+    breaks is run in a process of its own, so only the stub killing its
+    worker fails.
+
+    done -- called in this process with the result of every stub as soon
+            as it is finished
+
+    returns the results in the order of the stubs
+    """
+
+    results = [None] * len(stubs)
+
+    def finish(i, result):
+        if done is not None:
+            done(result)
+        results[i] = result
+
+    def run_alone(i):
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                result = pool.submit(process_stub, stubs[i], options, trace,
+                                     keep_table).result()
+            except Exception as err:
+                result = failed_stub(stubs[i], err)
+        finish(i, result)
+
+    strikes = {}    # pools broken while the stub was in progress
+    pending = list(range(len(stubs)))
+    while pending:
+        broken = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(process_stub, stubs[i], options, trace,
+                                   keep_table): i
+                       for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    finish(i, future.result())
+                except BrokenProcessPool:
+                    broken.append(i)
+                except Exception as err:
+                    finish(i, failed_stub(stubs[i], err))
+
+        broken.sort()
+        for i in broken[:workers + 1]:
+            strikes[i] = strikes.get(i, 0) + 1
+        alone = [i for i in broken if strikes.get(i, 0) > 1]
+        for i in alone:
+            run_alone(i)
+        pending = [i for i in broken if i not in alone]
+
+    return results
+
+
+def batch_report(root, workers=None, thumbnail_atlas=False, crop=True,
+                 trace=False, index_file=None, scan_workers=4,
+                 thumbnail_encoder=None, tiles=False, mosaic=False,
+                 dedup_dist=0.005, db_file=None):
+    """
+    Generates the pages of all stubs below root in a process pool
+
+    Keyword arguments:
+    root -- the directory searched for stubs
+
+    workers -- maximal number of stubs processed at the same time, None
+               uses all cores
+
+    thumbnail_atlas, crop, thumbnail_encoder, tiles, mosaic, dedup_dist --
+        see PB_GeneratePage.generate_page
+
+    trace -- write the timing of the stages to '<stub_dir>/trace.json',
+             see trace_pipeline
+
+    index_file, scan_workers -- see find_stubs
+
+    db_file -- the particle database the generated stubs are ingested into,
+               see particle_db.py. A stub which fails to be ingested keeps
+               its page, the error is recorded as 'ingest_error'.
+
+    returns the run summary as a dictionary
+    """
+
+    start = time.time()
+    stubs = find_stubs(root, index_file=index_file,
+                       scan_workers=scan_workers)
+    options = dict(thumbnail_atlas=thumbnail_atlas, crop=crop,
+                   thumbnail_encoder=thumbnail_encoder, tiles=tiles,
+                   mosaic=mosaic, dedup_dist=dedup_dist)
+
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(1, min(workers, len(stubs)))
+
+    # the database is written by this process only, each stub as soon as
+    # its page is done with the particle table matched by its worker
+    con = None
+    if db_file is not None:
+        import particle_db
+
+        con = particle_db.connect(db_file)
+
+    def ingest(result):
+        table = result.pop('table', None)
+        if con is None or result['status'] != 'ok':
+            return
+        try:
+            result['ingested'] = particle_db.ingest_stub(
+                con, result['stub_dir'], result['EDAX_PAsearch'],
+                result['IJ_PAsearch'], table=table, dedup_dist=dedup_dist)
+        except Exception as err:
+            result['ingested'] = None
+            result['ingest_error'] = '{}: {}'.format(type(err).__name__,
+                                                     err)
+
+    keep_table = con is not None
+    try:
+        if workers > 1:
+            results = process_stubs(stubs, options, trace, workers,
+                                    keep_table, done=ingest)
+        else:
+            results = []
+            for stub in stubs:
+                results.append(process_stub(stub, options, trace,
+                                            keep_table))
+                ingest(results[-1])
+    finally:
+        if con is not None:
+            con.close()
+
+    return {'root': os.path.abspath(root),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'workers': workers,
+            'seconds': round(time.time() - start, 3),
+            'stubs': len(results),
+            'failed': sum(result['status'] != 'ok' for result in results),
+            'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate the Particle Browser pages of all stubs.')
+    parser.add_argument('root', help='directory searched for stubs')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='stubs processed in parallel (default: cores)')
+    parser.add_argument('--summary', default=None,
+                        help='run summary file '
+                             '(default: <root>/batch_summary.json)')
+    parser.add_argument('--atlas', action='store_true',
+                        help='pack the thumbnails into sprite sheets')
+    parser.add_argument('--tiles', action='store_true',
+                        help='load the particles from static tiles on pan '
+                             'and zoom (for large stubs)')
+    parser.add_argument('--mosaic', action='store_true',
+                        help='show the mosaic of the field images beneath '
+                             'the particles')
+    parser.add_argument('--dedup-dist', type=float, default=0.005,
+                        help='particles of different fields closer than '
+                             'this (mm) are counted once, 0 keeps them '
+                             '(default: 0.005)')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='use the existing thumbnails')
+    parser.add_argument('--thumbnail-format', default='png',
+                        help='png, webp or jpeg (default: png)')
+    parser.add_argument('--png-level', type=int, default=None,
+                        help='PNG compression level 0-9, lower is faster '
+                             '(default: 6)')
+    parser.add_argument('--quality', type=int, default=None,
+                        help='quality 1-100 of lossy WebP and JPEG '
+                             '(default: lossless WebP, JPEG 90)')
+    parser.add_argument('--trace', action='store_true',
+                        help='write the timing of the stages of every stub '
+                             'to <stub_dir>/trace.json')
+    parser.add_argument('--scan-workers', type=int, default=4,
+                        help='threads listing the directories (default: 4)')
+    parser.add_argument('--db', default=None,
+                        help='ingest the stubs into this particle database')
+    parser.add_argument('--no-index', action='store_true',
+                        help='do not keep the discovery index '
+                             '<root>/.stub_index.json')
+    args = parser.parse_args()
+
+    index_file = None
+    if not args.no_index:
+        index_file = os.path.join(args.root, '.stub_index.json')
+
+    # the encoder is chosen once and shared by all stubs
+    encoder = process_PAsearch.ThumbnailEncoder(
+        args.thumbnail_format, compress_level=args.png_level,
+        quality=args.quality)
+
+    summary = batch_report(args.root, workers=args.workers,
+                           thumbnail_atlas=args.atlas,
+                           crop=not args.no_crop, trace=args.trace,
+                           index_file=index_file,
+                           scan_workers=args.scan_workers,
+                           thumbnail_encoder=encoder, tiles=args.tiles,
+                           mosaic=args.mosaic,
+                           dedup_dist=args.dedup_dist or None,
+                           db_file=args.db)
+
+    summary_file = args.summary or os.path.join(args.root,
+                                                'batch_summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    for result in summary['results']:
+        print('{:<8} {:>8.1f} s  {}'.format(
+            result['status'], result['seconds'], result['stub_dir']))
+        if result['status'] != 'ok':
+            print('         ' + result['error'])
+        if result.get('ingest_error'):
+            print('         ingest failed: ' + result['ingest_error'])
+    print('{} stubs, {} failed, {:.1f} s'.format(
+        summary['stubs'], summary['failed'], summary['seconds']))
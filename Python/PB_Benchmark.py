@@ -0,0 +1,359 @@
+# Benchmarks the processing pipeline on synthetic stubs
+#
+# usage: python PB_Benchmark.py [--scales 100x1000,324x10000] [--out FILE]
+#        python PB_Benchmark.py --check-imports
+#
+# For each scale (fields x particles) a synthetic stub is written (see
+# PB_SyntheticStub.py) and the stages of the pipeline are timed and their
+# peak memory traced. The thumbnails are then cropped with each of
+# THUMBNAIL_ENCODINGS to compare the encoding time and size, and the tables
+# are loaded and matched with float64 and with the compact dtypes to compare
+# their memory. The results are written as json, one record per scale and
+# stage.
+#
+# --check-imports imports the modules of the command line tools in fresh
+# interpreters and fails if an import exceeds the time budget or loads one
+# of the heavy dependencies, which are only imported by the stages using
+# them.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import process_PAsearch
+import create_bokehplot
+import PB_SyntheticStub
+import trace_pipeline
+
+DEFAULT_SCALES = [(100, 1000), (324, 10000), (1024, 100000)]
+
+# the command line tools and the modules they import, and the dependencies
+# they must not load at import time
+CLI_MODULES = ['process_PAsearch', 'PB_GeneratePage', 'PB_BatchReport',
+               'PB_Server', 'PB_Watch', 'PB_SyntheticStub', 'PB_Benchmark',
+               'detect_particles', 'particle_db', 'substrate_mosaic',
+               'particle_tiles', 'create_bokehplot', 'trace_pipeline']
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'skimage', 'bokeh', 'jinja2']
+
+# thumbnail encodings compared by benchmark_encoders, (format, options)
+THUMBNAIL_ENCODINGS = [('png', {}), ('png', {'compress_level': 1}),
+                       ('webp', {}), ('webp', {'quality': 80}),
+                       ('jpeg', {})]
+
+
+def timed(func, *args, **kwargs):
+    """runs func once, returns the wall time in seconds"""
+
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    runs func once, returns the peak of the memory allocated by Python and
+    numpy in bytes (traced separately as tracing slows down the run)
+    """
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(func, *args, repeat=1, **kwargs):
+    """
+    Times func (fastest of repeat runs) and traces its peak memory
+
+    returns a dictionary with the keys 'seconds' and 'peak_mb'
+    """
+
+    seconds = min(timed(func, *args, **kwargs) for _ in range(repeat))
+    peak = peak_memory(func, *args, **kwargs)
+
+    return {'seconds': round(seconds, 4), 'peak_mb': round(peak / 2**20, 2)}
+
+
+def benchmark_stub(stub_dir, repeat=1):
+    """
+    Benchmarks the pipeline stages on one stub directory
+
+    Keyword arguments:
+    stub_dir -- the stub directory
+
+    repeat -- number of runs per stage, the fastest run is reported
+
+    returns a dictionary with the measurement of each stage
+    """
+    import pandas as pd
+
+    EDAX_file = os.path.join(stub_dir, 'stub01.csv')
+    IJ_file = os.path.join(stub_dir, 'IJ_PA.csv')
+    root = os.path.dirname(stub_dir)
+
+    # the parsed tables are cached here, the cached stages read the cache
+    df_EDAX = process_PAsearch.get_stubinfo(EDAX_file)
+    df_IJ = process_PAsearch.import_IJfile(IJ_file)
+    img_list = ['thumbnails/{:0>4d}{:0>4d}.png'.format(1, 1)] * len(df_EDAX)
+    df_MRK = pd.DataFrame.from_dict(
+        process_PAsearch.get_markerpos(stub_dir), orient='index')
+    df_MRK.columns = ['StgX', 'StgY']
+
+    stages = [
+        ('walk_stubdir', process_PAsearch.walk_stubdir, (root,), {}),
+        ('get_stubinfo', process_PAsearch.get_stubinfo, (EDAX_file,),
+         {'use_cache': False}),
+        ('get_stubinfo_cached', process_PAsearch.get_stubinfo,
+         (EDAX_file,), {}),
+        ('import_IJfile', process_PAsearch.import_IJfile, (IJ_file,),
+         {'use_cache': False}),
+        ('import_IJfile_cached', process_PAsearch.import_IJfile,
+         (IJ_file,), {}),
+        ('match_EDAX_IJ_PAsearch', process_PAsearch.match_EDAX_IJ_PAsearch,
+         (df_EDAX, df_IJ), {}),
+        ('process_fields', process_PAsearch.process_fields,
+         (df_EDAX, stub_dir, '.png'), {'incremental': False}),
+        ('makelayout', create_bokehplot.makelayout,
+         (df_EDAX, df_MRK, img_list), {}),
+    ]
+
+    results = {}
+    for name, func, args, kwargs in stages:
+        results[name] = measure(func, *args, repeat=repeat, **kwargs)
+        print('{:<24} {:>9.3f} s {:>9.1f} MB'.format(
+            name, results[name]['seconds'], results[name]['peak_mb']))
+
+    return results
+
+
+def benchmark_encoders(stub_dir, encodings=THUMBNAIL_ENCODINGS):
+    """
+    Crops the thumbnails of a stub with each encoding
+
+    returns a dictionary with the cropping time, the encoding time and the
+    size per thumbnail of each encoding
+    """
+
+    df_EDAX = process_PAsearch.get_stubinfo(
+        os.path.join(stub_dir, 'stub01.csv'))
+
+    results = {}
+    for fmt, options in encodings:
+        name = '_'.join(['thumbnails', fmt] +
+                        ['{}{}'.format(*option) for option in options.items()])
+        encoder = process_PAsearch.ThumbnailEncoder(fmt, **options)
+
+        # the counts of process_fields are read from its span, the memory is
+        # not traced as that slows down the encoding
+        with trace_pipeline.tracing(memory=False) as trace:
+            process_PAsearch.process_fields(df_EDAX, stub_dir, '.png',
+                                            incremental=False,
+                                            encoder=encoder)
+        record = [r for r in trace.records
+                  if r['name'] == 'process_PAsearch.process_fields'][-1]
+        n = max(record['counts']['thumbnails'], 1)
+        results[name] = {
+            'seconds': record['wall'],
+            'encode_ms_per_thumbnail': round(
+                1e3 * record['counts']['encode_seconds'] / n, 4),
+            'kB_per_thumbnail': round(
+                record['counts']['bytes_written'] / n / 1e3, 3)}
+        print('{:<32} {:>9.3f} s {:>9.3f} ms {:>9.3f} kB'.format(
+            name, results[name]['seconds'],
+            results[name]['encode_ms_per_thumbnail'],
+            results[name]['kB_per_thumbnail']))
+
+    return results
+
+
+def benchmark_tables(stub_dir):
+    """
+    Loads and matches the tables of a stub with float64 and with the compact
+    dtypes (see process_PAsearch.compact_table)
+
+    returns a dictionary with the size of the table and the peak memory of
+    each stage and dtype
+    """
+
+    EDAX_file = os.path.join(stub_dir, 'stub01.csv')
+    IJ_file = os.path.join(stub_dir, 'IJ_PA.csv')
+
+    results = {}
+    for kind, compact in (('float64', False), ('compact', True)):
+        tables = {}
+        stages = [
+            ('get_stubinfo', lambda: process_PAsearch.get_stubinfo(
+                EDAX_file, use_cache=False, compact=compact)),
+            ('import_IJfile', lambda: process_PAsearch.import_IJfile(
+                IJ_file, use_cache=False, compact=compact)),
+            ('match_EDAX_IJ_PAsearch',
+             lambda: process_PAsearch.match_EDAX_IJ_PAsearch(
+                 tables['get_stubinfo'], tables['import_IJfile']))]
+        for stage, load in stages:
+            tracemalloc.start()
+            try:
+                tables[stage] = load()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            name = 'table_{}_{}'.format(stage, kind)
+            results[name] = {
+                'table_mb': process_PAsearch.table_mb(tables[stage]),
+                'peak_mb': round(peak / 2**20, 2)}
+            print('{:<40} {:>9.1f} MB table {:>9.1f} MB peak'.format(
+                name, results[name]['table_mb'], results[name]['peak_mb']))
+
+    return results
+
+
+def run_benchmark(scales=DEFAULT_SCALES, workdir=None, repeat=1, seed=0):
+    """
+    Writes a synthetic stub per scale and benchmarks the pipeline on it
+
+    Keyword arguments:
+    scales -- list of (fields, particles) tuples
+
+    workdir -- directory of the synthetic stubs, a temporary directory
+               (removed afterwards) if None
+
+    repeat -- number of runs per stage, the fastest run is reported
+
+    seed -- seed of the synthetic stubs
+
+    returns the results as a dictionary
+    """
+    import numpy as np
+    import pandas as pd
+
+    tmpdir = None
+    if workdir is None:
+        workdir = tmpdir = tempfile.mkdtemp(prefix='pb_benchmark_')
+
+    records = []
+    try:
+        for n_fields, n_particles in scales:
+            print('--- {} fields, {} particles'.format(n_fields, n_particles))
+            stub_dir = os.path.join(
+                workdir, 'bench_{}x{}'.format(n_fields, n_particles),
+                'stub01')
+            start = time.perf_counter()
+            PB_SyntheticStub.make_stub(stub_dir, n_fields=n_fields,
+                                       n_particles=n_particles, seed=seed)
+            print('{:<24} {:>9.3f} s'.format(
+                'make_stub', time.perf_counter() - start))
+
+            results = benchmark_stub(stub_dir, repeat)
+            results.update(benchmark_encoders(stub_dir))
+            results.update(benchmark_tables(stub_dir))
+            for stage, result in results.items():
+                records.append(dict(fields=n_fields, particles=n_particles,
+                                    stage=stage, **result))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'repeat': repeat,
+            'results': records}
+
+
+def import_time(module):
+    """
+    Imports module in a fresh interpreter
+
+    returns the import time in seconds and the heavy modules it loaded
+    """
+
+    code = ('import sys, time, json\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'print(json.dumps([time.perf_counter() - start,\n'
+            '                  [m for m in {!r} if m in sys.modules]]))'
+            .format(module, HEAVY_MODULES))
+    output = subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def check_imports(modules=CLI_MODULES, budget=0.25):
+    """
+    Checks the import time of the command line modules
+
+    Keyword arguments:
+    modules -- the modules to be imported
+
+    budget -- maximal import time of a module in seconds
+
+    returns a list of the violations, empty if all imports are within the
+    budget and load none of HEAVY_MODULES
+    """
+
+    violations = []
+    for module in modules:
+        seconds, heavy = import_time(module)
+        print('{:<24} {:>9.3f} s  {}'.format(
+            module, seconds, ' '.join(heavy)))
+        if seconds > budget:
+            violations.append('{} imports in {:.3f} s (budget {} s)'
+                              .format(module, seconds, budget))
+        if heavy:
+            violations.append('{} imports {}'.format(module,
+                                                     ', '.join(heavy)))
+
+    return violations
+
+
+def parse_scales(text):
+    """parse '100x1000,324x10000' to [(100, 1000), (324, 10000)]"""
+
+    return [tuple(int(n) for n in scale.split('x'))
+            for scale in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark the processing pipeline on synthetic stubs.')
+    parser.add_argument('--scales', type=parse_scales,
+                        default=DEFAULT_SCALES,
+                        help='comma separated <fields>x<particles> '
+                             '(default: 100x1000,324x10000,1024x100000)')
+    parser.add_argument('--out', default='benchmark.json',
+                        help='results file (default: benchmark.json)')
+    parser.add_argument('--workdir', default=None,
+                        help='keep the synthetic stubs in this directory')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per stage, the fastest is reported')
+    parser.add_argument('--check-imports', action='store_true',
+                        help='only check the import time of the modules')
+    parser.add_argument('--import-budget', type=float, default=0.25,
+                        help='import time budget in seconds (default: 0.25)')
+    args = parser.parse_args()
+
+    if args.check_imports:
+        violations = check_imports(budget=args.import_budget)
+        for violation in violations:
+            print('FAILED: ' + violation)
+        sys.exit(1 if violations else 0)
+
+    benchmark = run_benchmark(args.scales, workdir=args.workdir,
+                              repeat=args.repeat)
+
+    with open(args.out, 'w') as f:
+        json.dump(benchmark, f, indent=1)
+    print('Results written to ' + args.out)
@@ -7,21 +7,18 @@
 # ./spc -- EDX data
 
 
-import numpy as np
-import pandas as pd
-from os.path import join
+from os.path import join, basename, normpath, dirname, abspath
 from os import getcwd
-from jinja2 import Template
 import time
 
-from bokeh.embed import file_html, components
-from bokeh.resources import JSResources, CSSResources, INLINE
-
-# import custom module for PA search
+# import custom module for PA search, numpy, pandas and bokeh are imported
+# by the functions using them
 import process_PAsearch
-import create_bokehplot
+import trace_pipeline
+from trace_pipeline import traced
 
 
+@traced(lambda imgs: {'thumbnails': len(imgs)})
 def create_imagelist(pd_dataframe, img_dir, ext):
     """
     Creates a list of image paths of the thumbnails
@@ -34,117 +31,239 @@ def create_imagelist(pd_dataframe, img_dir, ext):
     ext -- File extension of the thumbnail
 
     """
-    imgs = []    # list of image paths
-
-    fields = pd_dataframe.Field.unique()
-    # Loop over fields
-    for field_no, field in enumerate(fields):
-        # fetch the index of particles on the field
-        particles = pd_dataframe[
-            pd_dataframe.loc[:, 'Field'] == field
-        ].Part.values
-
-        # Loop over particles
-        for particle_no, particle in enumerate(particles):
-            imgs.append('thumbnails/'
-                        + '{:0>4d}'.format(int(field))
-                        + '{:0>4d}'.format(int(particle_no)+1)
-                        + ext)
+    # the thumbnails are numbered per field in the order of the complete
+    # PA search, also if particles were removed (see deduplicate_particles)
+    numbers = process_PAsearch.particle_numbers(pd_dataframe)
+    imgs = ['thumbnails/'
+            + '{:0>4d}'.format(int(field))
+            + '{:0>4d}'.format(int(particle_no) + 1)
+            + ext
+            for field, particle_no in zip(pd_dataframe.Field.values,
+                                          numbers)]
 
     return imgs
 
 
-root_dir = getcwd()
-
-# Directory containing the stub data
-directory = 'DemoData'
-
-# Create the full path
-wdir = join(root_dir, directory)
-print(wdir)
-
-# use function 'walk_stubdir' to extract the info
-stub_loc = process_PAsearch.walk_stubdir(wdir)
-
-#    --> only continue when one directory was found
-if len(stub_loc['stub_dir']) > 1:
-    print('More than one PA search found')
-
-# Import the stub summary info
-stub_summary = process_PAsearch.get_header_data(stub_loc['stub_dir'][0])
-
-# Import the stub data
-df_EDAX = process_PAsearch.get_stubinfo(stub_loc['EDAX_PAsearch'][0])
-
-# Import IJ PA search data
-df_IJ = process_PAsearch.import_IJfile(stub_loc['IJ_PAsearch'][0])
-
-# Join the PA search data
-df = process_PAsearch.match_EDAX_IJ_PAsearch(
-    df_EDAX,
-    df_IJ,
-    match_dist=0.005)
-
-# randomize the particle position to give a homogeneous distribution
-# power distribution for the radius, unifomr for the azimuthal angle
-
-radius = 12.2 * np.random.power(2, df_EDAX.size)
-phi = 2*np.pi*np.random.random_sample(df_EDAX.size)
-
-# Replace the positions
-df_EDAX.StgX = pd.DataFrame(radius * np.cos(phi))
-df_EDAX.StgY = pd.DataFrame(radius * np.sin(phi))
-
-# ------------- Sample info -------------------------
-sample_info = {
-    'SAMPLE_ID': 'Particle Substrate No. 1',
-    'CRM': 'NBL-129A',
-    'REMARKS': 'Particles prepared from suspension',
-    'UAMOUNT': 'xx',  # in pg
-    # SEM Particle Search Parameters
-    'MAGNIFICATION': stub_summary['Mag'],
-    'VOLTAGE': stub_summary['Acc. Voltage'],
-    'PARTICLES_COUNTED': stub_summary['Particles Counted'],
-    'PARTICLES_ANALYZED': stub_summary['Particles Analyzed'],
-    'DATE': time.strftime('%B %d, %Y')
-}
+@traced(lambda result: {'particles': result['particles'],
+                        'bytes_written': result['html_bytes']})
+def generate_page(stub_dir, EDAX_file, IJ_file, ext='.png',
+                  thumbnail_atlas=False, crop=False,
+                  randomize_positions=False, sample_info=None,
+                  thumbnail_encoder=None, tiles=False, mosaic=False,
+                  dedup_dist=0.005, df_EDAX=None):
+    """
+    Generates the html page of a stub
 
+    Keyword arguments:
+    stub_dir -- location of the stub info files, the page is written to
+                '<stub_dir>/<stub name>.html'
 
-# ------------- Preparations for bokeh plots --------
+    EDAX_file, IJ_file -- the EDAX and ImageJ PA search files
 
-# Generate the list of filepaths for thumbnail view for hover tooltip
+    ext -- File extension of the field images
 
-img_list = create_imagelist(df_EDAX, wdir, '.png')
+    thumbnail_atlas -- pack the thumbnails into sprite sheets instead of
+                       single files
 
-# Import the markers from the file
+    crop -- crop the thumbnails from the field images before rendering
 
-import_marker = process_PAsearch.get_markerpos(stub_loc['stub_dir'][0])
+    randomize_positions -- spread the particles homogeneously over the
+                           substrate (for the demo data)
 
-df_MRK = pd.DataFrame.from_dict(import_marker, orient='index')
-df_MRK.columns = ['StgX', 'StgY']  # add the column names
+    sample_info -- entries overriding the default sample info of the page
 
-# ------------ Create the plots --------------
-# Open our custom template
-with open('PB_template.jinja', 'r') as f:
-    template = Template(f.read())
+    thumbnail_encoder -- process_PAsearch.ThumbnailEncoder of the thumbnails,
+                         the format of the field images if None
 
-# Use inline resources, render the html and open
-bokehlayout = create_bokehplot.makelayout(df_EDAX, df_MRK, img_list)
-title = 'Particle Search Results'
-js_resources = JSResources(mode='cdn')
-css_resources = CSSResources(mode='cdn')
-html = file_html(bokehlayout,
-                 resources=(js_resources, css_resources),
-                 title=title, template=template,
-                 template_variables=sample_info)
+    tiles -- write the particles to static tiles in '<stub_dir>/tiles/'
+             which the page loads on pan and zoom (see particle_tiles.py),
+             only a sample of the particles is embedded in the page
 
-script, div = components(bokehlayout)
+    mosaic -- build the mosaic of the field images in '<stub_dir>/mosaic/'
+              and show it beneath the particles (see substrate_mosaic.py)
 
-"""html = template.render(js_resources=js_resources,
-                       css_resources=css_resources,
-                       div=div)"""
+    dedup_dist -- particles of neighbouring fields closer than dedup_dist
+                  (in mm) are counted once, the removed duplicates are
+                  listed in '<stub_dir>/duplicates.csv'. None keeps them.
 
-output_file = directory + '.html'
+    df_EDAX -- the EDAX PA search table, read from EDAX_file if None
 
-with open(directory + '/' + output_file, mode='w', encoding='utf-8') as f:
-    f.write(html)
+    returns a dictionary with the output file, the number of particles and
+    the matched particle table ('table', see
+    process_PAsearch.match_EDAX_IJ_PAsearch)
+    """
+    import numpy as np
+    import pandas as pd
+    from jinja2 import Template
+    from bokeh.embed import file_html
+    from bokeh.resources import JSResources, CSSResources
+
+    import create_bokehplot
+
+    # Import the stub summary info
+    stub_summary = process_PAsearch.get_header_data(stub_dir)
+
+    # Import the stub data
+    if df_EDAX is None:
+        df_EDAX = process_PAsearch.get_stubinfo(EDAX_file)
+
+    # Crop the thumbnails, a failed field only misses its thumbnails. They
+    # are cropped from the complete PA search, with or without duplicates
+    # they keep their names.
+    if thumbnail_encoder is None:
+        thumbnail_encoder = process_PAsearch.ThumbnailEncoder(ext)
+    errors = {}
+    if crop:
+        process_PAsearch.make_stub_dirs(stub_dir)
+        errors = process_PAsearch.process_fields(
+            df_EDAX, stub_dir, ext, encoder=thumbnail_encoder)
+
+    # Remove the particles counted twice on overlapping fields before the
+    # plots are made
+    duplicates = []
+    if dedup_dist is not None:
+        df_EDAX, duplicates = process_PAsearch.deduplicate_particles(
+            df_EDAX, dedup_dist)
+        if len(duplicates):
+            duplicates.to_csv(join(stub_dir, 'duplicates.csv'), index=False)
+        print('{} duplicates removed'.format(len(duplicates)))
+
+    # Import IJ PA search data
+    df_IJ = process_PAsearch.import_IJfile(IJ_file)
+
+    # Join the PA search data
+    df = process_PAsearch.match_EDAX_IJ_PAsearch(
+        df_EDAX,
+        df_IJ,
+        match_dist=0.005)
+
+    if randomize_positions:
+        # randomize the particle position to give a homogeneous distribution
+        # power distribution for the radius, unifomr for the azimuthal angle
+
+        radius = 12.2 * np.random.power(2, df_EDAX.size)
+        phi = 2*np.pi*np.random.random_sample(df_EDAX.size)
+
+        # Replace the positions
+        df_EDAX.StgX = pd.DataFrame(radius * np.cos(phi))
+        df_EDAX.StgY = pd.DataFrame(radius * np.sin(phi))
+
+    # ------------- Sample info -------------------------
+    info = {
+        'SAMPLE_ID': 'Particle Substrate No. 1',
+        'CRM': 'NBL-129A',
+        'REMARKS': 'Particles prepared from suspension',
+        'UAMOUNT': 'xx',  # in pg
+        # SEM Particle Search Parameters
+        'MAGNIFICATION': stub_summary['Mag'],
+        'VOLTAGE': stub_summary['Acc. Voltage'],
+        'PARTICLES_COUNTED': stub_summary['Particles Counted'],
+        'PARTICLES_ANALYZED': stub_summary['Particles Analyzed'],
+        'DATE': time.strftime('%B %d, %Y')
+    }
+    if sample_info is not None:
+        info.update(sample_info)
+
+    # ------------- Preparations for bokeh plots --------
+
+    # Generate the list of filepaths for thumbnail view for hover tooltip
+
+    img_list = create_imagelist(df_EDAX, stub_dir, thumbnail_encoder.ext)
+
+    tile_index = None
+    if tiles:
+        import particle_tiles
+
+        tile_index = particle_tiles.write_tiles(df_EDAX, stub_dir,
+                                                thumbnail_encoder.ext)
+        if thumbnail_atlas:
+            print('The thumbnail atlas is not used with the particle tiles')
+            thumbnail_atlas = False
+
+    mosaic_index = None
+    if mosaic:
+        import substrate_mosaic
+
+        mosaic_index = substrate_mosaic.make_mosaic(stub_dir, df_EDAX, ext)
+
+    atlas = None
+    if thumbnail_atlas:
+        atlas = process_PAsearch.build_atlas(img_list, stub_dir)
+
+    # Import the markers from the file
+
+    import_marker = process_PAsearch.get_markerpos(stub_dir)
+
+    df_MRK = pd.DataFrame.from_dict(import_marker, orient='index')
+    df_MRK.columns = ['StgX', 'StgY']  # add the column names
+
+    # ------------ Create the plots --------------
+    # Open our custom template
+    with open(join(dirname(abspath(__file__)), 'PB_template.jinja'),
+              'r') as f:
+        template = Template(f.read())
+
+    # Use inline resources, render the html and open
+    bokehlayout = create_bokehplot.makelayout(df_EDAX, df_MRK, img_list,
+                                              atlas, tiles=tile_index,
+                                              mosaic=mosaic_index)
+    title = 'Particle Search Results'
+    js_resources = JSResources(mode='cdn')
+    css_resources = CSSResources(mode='cdn')
+    with trace_pipeline.span('file_html') as span:
+        html = file_html(bokehlayout,
+                         resources=(js_resources, css_resources),
+                         title=title, template=template,
+                         template_variables=info)
+        span.add(characters=len(html))
+
+    output_file = join(stub_dir, basename(normpath(stub_dir)) + '.html')
+
+    with trace_pipeline.span('write_page'):
+        with open(output_file, mode='w', encoding='utf-8') as f:
+            f.write(html)
+
+    # Report the size of the page and the savings of the pruned data source,
+    # estimated from the dtypes, the table is not serialized again
+    size_full = create_bokehplot.source_size(df_EDAX.dtypes, len(df_EDAX))
+    size_pruned = create_bokehplot.source_size(
+        [dtype for column, dtype in create_bokehplot.PLOT_COLUMNS.items()
+         if column in df_EDAX], len(df_EDAX))
+    print('Report size: {:.0f} kB'.format(len(html.encode('utf-8')) / 1e3))
+    print('Particle data: {:.0f} kB, {:.0f} kB saved by pruning the columns'
+          .format(size_pruned / 1e3, (size_full - size_pruned) / 1e3))
+
+    return {'output_file': output_file,
+            'particles': len(df_EDAX),
+            'matched': int(df.Part_IJ.notna().sum()),
+            'duplicates': len(duplicates),
+            'failed_fields': len(errors),
+            'html_bytes': len(html.encode('utf-8')),
+            'table': df}
+
+
+if __name__ == "__main__":
+    root_dir = getcwd()
+
+    # Directory containing the stub data
+    directory = 'DemoData'
+
+    # Pack the thumbnails into sprite sheets instead of single files
+    thumbnail_atlas = False
+
+    # Create the full path
+    wdir = join(root_dir, directory)
+    print(wdir)
+
+    # use function 'walk_stubdir' to extract the info
+    stub_loc = process_PAsearch.walk_stubdir(wdir)
+
+    #    --> only continue when one directory was found
+    if len(stub_loc['stub_dir']) > 1:
+        print('More than one PA search found, see PB_BatchReport.py')
+
+    generate_page(stub_loc['stub_dir'][0],
+                  stub_loc['EDAX_PAsearch'][0],
+                  stub_loc['IJ_PAsearch'][0],
+                  thumbnail_atlas=thumbnail_atlas,
+                  randomize_positions=True)
@@ -0,0 +1,367 @@
+# Serves the Particle Browser of a stub from a bokeh server
+#
+# usage: python PB_Server.py <stub_dir> [--port 5006] [--max-points 20000]
+#
+# The static page of PB_GeneratePage.py carries every particle. Here the
+# page starts without particles: on pan or zoom of the 'Particle Positions
+# on Substrate' plot the server looks up the visible particles in a grid
+# index and sends only these, or a 2D histogram of them when more than
+# max_points are visible. Selections are resolved to the particles of the
+# stub on the server, also beyond the visible range. The thumbnails are
+# served from '<stub_dir>/thumbnails'.
+
+import argparse
+import os
+
+import process_PAsearch
+
+
+class ParticleGrid(object):
+    """
+    Grid index of the particle positions for rectangle queries
+
+    Keyword arguments:
+    x, y -- particle positions in mm, particles without a position are not
+            indexed
+
+    cell_size -- width and height of the grid cells in mm
+    """
+
+    def __init__(self, x, y, cell_size=0.25):
+        import numpy as np
+
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cell_size = cell_size
+
+        indexed = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        if len(indexed) == 0:
+            self.x0 = self.y0 = 0.0
+            self.nx = self.ny = 1
+        else:
+            self.x0 = self.x[indexed].min()
+            self.y0 = self.y[indexed].min()
+            self.nx = int((self.x[indexed].max() - self.x0) // cell_size) + 1
+            self.ny = int((self.y[indexed].max() - self.y0) // cell_size) + 1
+
+        # the particles sorted by cell (row by row), starts[c] is the first
+        # particle of cell c
+        cells = self._cells(self.x[indexed], self.y[indexed])
+        order = np.argsort(cells, kind='stable')
+        self.order = indexed[order]
+        self.starts = np.searchsorted(cells[order],
+                                      np.arange(self.nx * self.ny + 1))
+
+    def _cells(self, x, y):
+        import numpy as np
+
+        ix = ((x - self.x0) // self.cell_size).astype(np.int64)
+        iy = ((y - self.y0) // self.cell_size).astype(np.int64)
+        return iy * self.nx + ix
+
+    def query(self, x_min, x_max, y_min, y_max):
+        """positions (in x, y) of the particles within the rectangle"""
+        import numpy as np
+
+        def cell_range(low, high, origin, n):
+            first = int(max((low - origin) // self.cell_size, 0))
+            last = int(min((high - origin) // self.cell_size, n - 1))
+            return first, last
+
+        ix0, ix1 = cell_range(x_min, x_max, self.x0, self.nx)
+        iy0, iy1 = cell_range(y_min, y_max, self.y0, self.ny)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.zeros(0, dtype=np.int64)
+
+        # the cells ix0..ix1 of a grid row are contiguous
+        candidates = np.concatenate(
+            [self.order[self.starts[iy * self.nx + ix0]:
+                        self.starts[iy * self.nx + ix1 + 1]]
+             for iy in range(iy0, iy1 + 1)])
+        x, y = self.x[candidates], self.y[candidates]
+        inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+
+        return np.sort(candidates[inside])
+
+    def query_polygon(self, xs, ys):
+        """positions (in x, y) of the particles within the polygon with the
+        vertices xs, ys, e.g. a lasso (see points_in_polygon)"""
+        import numpy as np
+
+        xs = np.asarray(xs, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        if len(xs) < 3:
+            return np.zeros(0, dtype=np.int64)
+
+        rows = self.query(xs.min(), xs.max(), ys.min(), ys.max())
+        return rows[points_in_polygon(self.x[rows], self.y[rows], xs, ys)]
+
+
+def points_in_polygon(x, y, xs, ys):
+    """
+    Mask of the points x, y within the polygon with the vertices xs, ys,
+    by the even-odd rule of matplotlib.path.Path.contains_points: a ray
+    from the point to +x crosses the edges an odd number of times
+    """
+    import numpy as np
+
+    inside = np.zeros(len(x), dtype=bool)
+    for x0, y0, x1, y1 in zip(xs, ys, np.roll(xs, 1), np.roll(ys, 1)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+
+    return inside
+
+
+def geometry_coords(values):
+    """the coordinates of a lasso as sent by the browser, a list or the
+    typed array serialized as {index: value}"""
+
+    if isinstance(values, dict):
+        return [values[key] for key in sorted(values, key=int)]
+    return list(values)
+
+
+def load_stub(stub_dir, ext='.png', cell_size=0.25, dedup_dist=0.005):
+    """
+    Loads the particles, markers and thumbnail paths of a stub and indexes
+    the particle positions
+
+    Keyword arguments:
+    stub_dir -- the stub directory
+
+    ext -- File extension of the thumbnails
+
+    cell_size -- cell size of the grid index in mm
+
+    dedup_dist -- particles of neighbouring fields closer than dedup_dist
+                  (in mm) are counted once as on the static page, see
+                  process_PAsearch.deduplicate_particles. None keeps them.
+
+    returns a dictionary with the keys 'particles', 'markers', 'imgs',
+    'grid' (the ParticleGrid) and 'duplicates' (the removed particles)
+    """
+    import pandas as pd
+
+    import PB_GeneratePage
+
+    stub_loc = process_PAsearch.walk_stubdir(stub_dir)
+    # the plots show the EDAX PA search only, as on the static page
+    df_EDAX = process_PAsearch.get_stubinfo(stub_loc['EDAX_PAsearch'][0])
+    duplicates = []
+    if dedup_dist is not None:
+        df_EDAX, duplicates = process_PAsearch.deduplicate_particles(
+            df_EDAX, dedup_dist)
+
+    df_MRK = pd.DataFrame.from_dict(process_PAsearch.get_markerpos(stub_dir),
+                                    orient='index')
+    df_MRK.columns = ['StgX', 'StgY']
+
+    return {'particles': df_EDAX,
+            'markers': df_MRK,
+            'imgs': PB_GeneratePage.create_imagelist(df_EDAX, stub_dir, ext),
+            'grid': ParticleGrid(df_EDAX.StgX.values, df_EDAX.StgY.values,
+                                 cell_size),
+            'duplicates': duplicates}
+
+
+def make_document(doc, stub, max_points=20000, bins=128, delay=100):
+    """
+    Builds the page of a stub in a bokeh document and attaches the
+    callbacks streaming the visible particles
+
+    Keyword arguments:
+    doc -- the bokeh document of a browser session
+
+    stub -- the stub data, see load_stub
+
+    max_points -- largest number of visible particles sent as points, more
+                  are shown as a 2D histogram with bins x bins cells
+
+    delay -- milliseconds the ranges have to rest before the particles are
+             looked up, a pan sends one update instead of one per frame
+    """
+    import numpy as np
+    from bokeh.events import SelectionGeometry
+    from bokeh.layouts import column
+    from bokeh.models import ColumnDataSource, Div, LinearColorMapper
+    from bokeh.palettes import Greys256
+
+    import create_bokehplot
+
+    df = stub['particles']
+    imgs = stub['imgs']
+    grid = stub['grid']
+
+    # the large-dataset mode draws the size plots from histograms of all
+    # particles, the positions plot is filled by the server
+    root = create_bokehplot.makelayout(df, stub['markers'], imgs,
+                                       large_threshold=0, lod_range=None,
+                                       source_rows=[])
+    source = root.select_one({'name': 'particles'})
+    selection = root.select_one({'name': 'selection'})
+    plot = root.select_one({'name': 'positions'})
+    particles = root.select_one({'name': 'top_left'})
+    density = root.select_one({'name': 'density_top_left'})
+
+    # the selection is resolved here instead of in the browser
+    source.selected.js_property_callbacks = {}
+
+    aggregate = ColumnDataSource(
+        create_bokehplot.histogram2d_quads([], [], bins, (0, 1), (0, 1)))
+    mapper = LinearColorMapper(palette=Greys256[::-1][32:], low=0)
+    aggregated = plot.quad(left='left', right='right', bottom='bottom',
+                           top='top', source=aggregate, line_color=None,
+                           fill_color={'field': 'count', 'transform': mapper},
+                           fill_alpha=0.7, visible=False)
+    info = Div(width=600)
+
+    state = {'shown': np.zeros(0, dtype=np.int64),
+             'selected': np.zeros(0, dtype=np.int64),
+             'pending': False, 'updating': False}
+
+    def show_selection():
+        rows = state['selected']
+        selection.data = create_bokehplot.particle_data(df, imgs, rows=rows)
+        if len(rows) == 0:
+            info.text = ''
+            return
+        um = df.UM.values[rows] if 'UM' in df else np.zeros(0)
+        info.text = ('<b>{} particles selected</b>, mean content {:.2f} wt %,'
+                     ' particles {}'.format(
+                         len(rows), np.nanmean(um) if len(um) else np.nan,
+                         ', '.join(str(int(p)) for p in
+                                   df.Part.values[rows[:20]]))
+                     + (', ...' if len(rows) > 20 else ''))
+
+    def update():
+        state['pending'] = False
+        rows = grid.query(plot.x_range.start, plot.x_range.end,
+                          plot.y_range.start, plot.y_range.end)
+
+        state['updating'] = True
+        if len(rows) <= max_points:
+            state['shown'] = rows
+            source.data = create_bokehplot.particle_data(df, imgs, rows=rows)
+            # keep the selection of the particles which are still visible
+            source.selected.indices = list(np.flatnonzero(
+                np.isin(rows, state['selected'])))
+            aggregate.data = create_bokehplot.histogram2d_quads(
+                [], [], bins, (0, 1), (0, 1))
+        else:
+            state['shown'] = np.zeros(0, dtype=np.int64)
+            source.data = create_bokehplot.particle_data(df, imgs, rows=[])
+            aggregate.data = create_bokehplot.histogram2d_quads(
+                grid.x[rows], grid.y[rows], bins,
+                (plot.x_range.start, plot.x_range.end),
+                (plot.y_range.start, plot.y_range.end))
+        state['updating'] = False
+
+        particles.visible = len(rows) <= max_points
+        aggregated.visible = not particles.visible
+        density.visible = False
+
+    def on_range(attr, old, new):
+        if not state['pending']:
+            state['pending'] = True
+            doc.add_timeout_callback(update, delay)
+
+    def on_select(attr, old, new):
+        # the aggregated view has no particles in the browser, its
+        # selections are resolved by on_geometry
+        if state['updating'] or aggregated.visible:
+            return
+        state['selected'] = state['shown'][np.asarray(new, dtype=np.int64)]
+        show_selection()
+
+    def on_geometry(event):
+        # box and lasso of the positions plot select in the grid index,
+        # also the particles binned in the aggregated view
+        geometry = event.geometry
+        if not event.final:
+            return
+        if geometry['type'] == 'rect':
+            rows = grid.query(min(geometry['x0'], geometry['x1']),
+                              max(geometry['x0'], geometry['x1']),
+                              min(geometry['y0'], geometry['y1']),
+                              max(geometry['y0'], geometry['y1']))
+        elif geometry['type'] == 'poly':
+            rows = grid.query_polygon(geometry_coords(geometry['x']),
+                                      geometry_coords(geometry['y']))
+        else:
+            return
+        state['selected'] = rows
+        state['updating'] = True
+        source.selected.indices = list(np.flatnonzero(
+            np.isin(state['shown'], rows)))
+        state['updating'] = False
+        show_selection()
+
+    for attr in ('start', 'end'):
+        plot.x_range.on_change(attr, on_range)
+        plot.y_range.on_change(attr, on_range)
+    source.selected.on_change('indices', on_select)
+    plot.on_event(SelectionGeometry, on_geometry)
+
+    update()
+    doc.add_root(column(root, info))
+    doc.title = 'Particle Search Results'
+
+
+def serve(stub_dir, port=5006, show=False, dedup_dist=0.005, **options):
+    """
+    Runs the bokeh server of a stub until it is interrupted
+
+    Keyword arguments:
+    stub_dir -- the stub directory
+
+    port -- port of the server
+
+    show -- open the page in the browser
+
+    dedup_dist -- see load_stub
+
+    options -- see make_document
+    """
+    from bokeh.server.server import Server
+    from tornado.web import StaticFileHandler
+
+    # the stub is loaded and indexed once and shared by the sessions
+    stub = load_stub(stub_dir, dedup_dist=dedup_dist)
+    print('{} particles loaded from {}, {} duplicates removed'.format(
+        len(stub['particles']), stub_dir, len(stub['duplicates'])))
+
+    def app(doc):
+        make_document(doc, stub, **options)
+
+    thumbnails = os.path.join(os.path.abspath(stub_dir), 'thumbnails')
+    server = Server({'/': app}, port=port, extra_patterns=[
+        (r'/thumbnails/(.*)', StaticFileHandler, {'path': thumbnails})])
+    server.start()
+    print('Serving http://localhost:{}/'.format(port))
+    if show:
+        server.io_loop.add_callback(server.show, '/')
+    server.io_loop.start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Serve the Particle Browser of a stub.')
+    parser.add_argument('stub_dir', help='the stub directory')
+    parser.add_argument('--port', type=int, default=5006,
+                        help='port of the server (default: 5006)')
+    parser.add_argument('--max-points', type=int, default=20000,
+                        help='most particles sent as points, more are '
+                             'binned (default: 20000)')
+    parser.add_argument('--show', action='store_true',
+                        help='open the page in the browser')
+    parser.add_argument('--dedup-dist', type=float, default=0.005,
+                        help='particles of different fields closer than '
+                             'this (mm) are counted once, 0 keeps them '
+                             '(default: 0.005)')
+    args = parser.parse_args()
+
+    serve(args.stub_dir, port=args.port, show=args.show,
+          dedup_dist=args.dedup_dist or None, max_points=args.max_points)
@@ -0,0 +1,339 @@
+# Writes synthetic stub directories with the layout of a Particle Search
+#
+# usage: python PB_SyntheticStub.py <directory> [--fields N] [--particles N]
+#
+# <directory>
+#     |
+#     |_____/fields/fldNNNN.png
+#     |_____/thumbnails/
+#     |_____/refmarkers/marker_pos.txt
+#     |_____/Stub Summary.txt
+#     |_____/stub01.csv         (EDAX PA search, 14 header lines, \r)
+#     |_____/IJ_PA.csv          (ImageJ PA search)
+#
+# The files follow the format of DemoData, the positions of the EDAX and
+# ImageJ particles agree within the match tolerance of
+# process_PAsearch.match_EDAX_IJ_PAsearch.
+
+import argparse
+import os
+
+PIXELSIZE = 0.23142628587258555     # um
+IMG_SIZE = (2048, 1600)             # x, y in pixels
+
+EDAX_COLUMNS = ['Part#', 'Field#', 'Phase#', 'X_stage', 'Y_stage', 'X_cent',
+                'Y_cent', 'X_left', 'Y_low', 'X_width', 'Y_height', 'Xferet',
+                'Yferet', 'AvgDiam', 'LProj', 'Area', 'Perim', 'Shape',
+                'Aspe', 'Orient', 'CK', 'OK', 'AlK', 'SiK', 'UM', '  CPS ',
+                'AvgVideo', 'StgX ', 'StgY ', 'MinCnts']
+
+EDAX_FORMAT = ['%5d', '%2d', '%2d', '%6d', '%6d', '%4d', '%4d', '%4d', '%4d',
+               '%4d', '%4d', '%8.2f', '%8.2f', '%8.2f', '%8.2f', '%9.4f',
+               '%8.2f', '%8.2f', '%8.2f', '%3d', '%7.2f', '%7.2f', '%7.2f',
+               '%7.2f', '%7.2f', '%6d', '%3d', '%8.3f', '%8.3f', '%4d']
+
+IJ_COLUMNS = [' ', 'Label', 'Area', 'Mean', 'StdDev', 'Mode', 'Min', 'Max',
+              'X', 'Y', 'XM', 'YM', 'Perim.', 'Major', 'Minor', 'Angle',
+              'Circ.', 'Feret', 'IntDen', 'Median', 'RawIntDen', 'Slice',
+              'FeretX', 'FeretY', 'FeretAngle', 'MinFeret', 'AR', 'Round',
+              'Solidity']
+
+
+def field_grid(n_fields):
+    """
+    Stage positions of the fields in um, a square grid of 0.474x0.370 mm
+    fields centred on the stub and numbered row by row from the top
+
+    returns the arrays X_stage, Y_stage
+    """
+    import numpy as np
+
+    step_x = IMG_SIZE[0] * PIXELSIZE
+    step_y = IMG_SIZE[1] * PIXELSIZE
+    cols = int(np.ceil(np.sqrt(n_fields)))
+    row, col = np.divmod(np.arange(n_fields), cols)
+    rows = row.max() + 1
+
+    X_stage = np.round((col - (cols - 1) / 2) * step_x).astype(int)
+    Y_stage = np.round(((rows - 1) / 2 - row) * step_y).astype(int)
+
+    return X_stage, Y_stage
+
+
+def synthetic_particles(n_fields, n_particles, rng):
+    """
+    Random particles of a stub as a dictionary of arrays, sorted by field
+
+    The EDAX coordinates have the origin in the bottom left of a field.
+    """
+    import numpy as np
+
+    X_stage, Y_stage = field_grid(n_fields)
+    field = np.sort(rng.integers(0, n_fields, n_particles))
+
+    # particle diameter in um, lognormal around the demo data
+    diam = np.clip(rng.lognormal(np.log(1.2), 0.15, n_particles), 0.5, 5.0)
+    aspect = 1 + rng.exponential(0.1, n_particles)
+
+    # keep the particles 10 pixels from the border
+    x_cent = rng.integers(10, IMG_SIZE[0] - 10, n_particles)
+    y_cent = rng.integers(10, IMG_SIZE[1] - 10, n_particles)
+
+    return {'Field': field + 1,
+            'X_stage': X_stage[field],
+            'Y_stage': Y_stage[field],
+            'X_cent': x_cent,
+            'Y_cent': y_cent,
+            'AvgDiam': diam,
+            'Aspect': aspect,
+            'UM': np.clip(rng.normal(70.8, 3.4, n_particles), 0, 100)}
+
+
+def stage_position(particles):
+    """stage position in mm, as the EDAX PA search reports it"""
+
+    StgX = (particles['X_stage'] / 1000
+            + PIXELSIZE / 1000 * (particles['X_cent'] - IMG_SIZE[0] / 2))
+    StgY = (particles['Y_stage'] / 1000
+            + PIXELSIZE / 1000 * (particles['Y_cent'] - IMG_SIZE[1] / 2
+                                  - 160))
+    return StgX, StgY
+
+
+def write_stub_summary(directory, n_fields, n_particles):
+    """write 'Stub Summary.txt' (\\r\\n newlines)"""
+
+    lines = [' Stub Summary:   ' + os.path.join(directory, 'Stub Summary.txt'),
+             ' Microscope:             Quanta',
+             ' Mag:                    600',
+             ' Acc. Voltage:           10.0 kV',
+             ' Pixel size:             0.23 um ',
+             ' Particle size filter:   0.5 - 100.0 um ',
+             ' Particle scan type:     Centroid',
+             ' Prescan CPS:            None',
+             ' Takeoff angle:          37.4',
+             ' Amplifier time:          3.2',
+             '',
+             ' Data type:              ZAF Elem Wt%',
+             ' Element list:           C,O,Al,Si,U',
+             ' No. of fields per stub: {}'.format(n_fields),
+             ' Field size (mm):        0.474x0.370',
+             ' Stub Label                        StageX  StageY ',
+             '   1  SYNTHETIC                    0.000    0.000   ',
+             '',
+             '',
+             ' Starting Time:      16:09   02-28-2017',
+             ' Ending Time:        01:03   03-01-2017',
+             ' Video thresholds:          23-255',
+             ' Particles Analyzed:         {} '.format(n_particles),
+             ' Particles Counted:         {} '.format(n_particles),
+             ' Area covered (sq.mm):      {:.2f}'.format(n_fields * 0.1754),
+             ' Stub % covered:            9.10',
+             '']
+
+    with open(os.path.join(directory, 'Stub Summary.txt'), 'w',
+              newline='') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+
+
+def write_EDAX_PAsearch(filename, particles, rng):
+    """write the EDAX PA search csv file, 14 header lines and \\r newlines"""
+    import numpy as np
+
+    n = len(particles['Field'])
+    diam = particles['AvgDiam']
+    StgX, StgY = stage_position(particles)
+    UM = particles['UM']
+    CK = rng.uniform(7, 13, n)
+
+    data = np.column_stack([
+        np.arange(1, n + 1), particles['Field'], np.ones(n),
+        particles['X_stage'], particles['Y_stage'],
+        particles['X_cent'], particles['Y_cent'],
+        np.maximum(particles['X_cent'] - 16, 0),
+        np.maximum(particles['Y_cent'] - 12, 0),
+        np.full(n, 32), np.full(n, 25),
+        diam * 1.07, diam, diam, diam * 1.22, np.pi / 4 * diam**2,
+        np.pi * diam, rng.uniform(0.65, 1.9, n),
+        particles['Aspect'] * 1.4, rng.integers(-38, 91, n),
+        CK, 100 - UM - CK, np.zeros(n), np.zeros(n), UM,
+        rng.normal(1520, 90, n), rng.integers(80, 150, n),
+        StgX, StgY, rng.normal(4430, 250, n)])
+
+    header = [' File,' + filename,
+              ' Stub,SYNTHETIC',
+              ' Date, 2,28,2017',
+              ' Time,16, 9',
+              ' Acc.,Voltage,10.0',
+              ' Magn:,   600',
+              'Thresholds:',
+              ' Phase,Low,Upp',
+              '   1,  23, 255',
+              ' TakeOff,37.4',
+              ' Preset,Time:,   3.0',
+              ' Elem, 5',
+              ' Data,Type:,ZAF Elem.,Wt%',
+              ' Particle, Scan,10',
+              ','.join(EDAX_COLUMNS)]
+
+    with open(filename, 'w', newline='') as f:
+        f.write('\r'.join(header) + '\r')
+        np.savetxt(f, data, fmt=EDAX_FORMAT, delimiter=',', newline='\r')
+
+
+def write_IJ_PAsearch(filename, particles, rng, extra=0.02, missing=0.01):
+    """
+    write the ImageJ PA search csv file
+
+    extra -- fraction of additional particles only found by ImageJ
+    missing -- fraction of the EDAX particles not found by ImageJ
+
+    returns the ImageJ particles (field, x, y with origin top left, major,
+    minor) used to draw the field images
+    """
+    import numpy as np
+    import pandas as pd
+
+    n = len(particles['Field'])
+    found = rng.random(n) >= missing
+    n_extra = int(extra * n)
+
+    # ImageJ has the origin top left, the centres deviate by about a pixel
+    field = particles['Field'][found]
+    x = particles['X_cent'][found] + rng.normal(0, 1, found.sum())
+    y = IMG_SIZE[1] - particles['Y_cent'][found] + rng.normal(0, 1,
+                                                              found.sum())
+    diam = particles['AvgDiam'][found] / PIXELSIZE
+    aspect = particles['Aspect'][found]
+
+    # particles below the EDAX size filter, only found by ImageJ
+    n_fields = particles['Field'].max() if n else 1
+    field = np.concatenate([field, rng.integers(1, n_fields + 1, n_extra)])
+    x = np.concatenate([x, rng.uniform(10, IMG_SIZE[0] - 10, n_extra)])
+    y = np.concatenate([y, rng.uniform(10, IMG_SIZE[1] - 10, n_extra)])
+    diam = np.concatenate([diam, rng.uniform(1.5, 2.2, n_extra)])
+    aspect = np.concatenate([aspect, np.ones(n_extra)])
+
+    order = np.argsort(field, kind='stable')
+    field, x, y = field[order], x[order], y[order]
+    major = (diam * np.sqrt(aspect))[order]
+    minor = (diam / np.sqrt(aspect))[order]
+
+    m = len(field)
+    area = np.pi / 4 * major * minor
+    perim = np.pi * (major + minor) / 2
+    mean = rng.uniform(60, 110, m)
+    values = [area, mean, rng.uniform(30, 45, m), mean, np.full(m, 12.0),
+              rng.uniform(120, 140, m), x, y, x, y, perim, major, minor,
+              rng.uniform(0, 180, m), 4 * np.pi * area / perim**2,
+              major * 1.1, area * mean, mean, area * mean, field,
+              x - major / 2, y, rng.uniform(0, 180, m), minor,
+              major / minor, minor / major, rng.uniform(0.8, 0.95, m)]
+
+    df = pd.DataFrame(dict(zip(IJ_COLUMNS[2:], values)),
+                      columns=IJ_COLUMNS[2:])
+    df.insert(0, 'Label', ['fields:fld{:0>4d}'.format(fld) for fld in field])
+    df.index = np.arange(1, m + 1)
+    df.to_csv(filename, index_label=' ', float_format='%.3E')
+
+    return field, x, y, major, minor
+
+
+def write_fields(directory, n_fields, field, x, y, major, minor):
+    """
+    write the field images, grey disks of the particles on black (RGB)
+    """
+    import numpy as np
+    from skimage import io
+
+    os.makedirs(os.path.join(directory, 'fields'), exist_ok=True)
+    yy, xx = np.mgrid[-8:9, -8:9]
+
+    bounds = np.searchsorted(field, np.arange(1, n_fields + 2))
+    for fld in range(1, n_fields + 1):
+        img = np.zeros((IMG_SIZE[1], IMG_SIZE[0]), dtype=np.uint8)
+        for i in range(bounds[fld - 1], bounds[fld]):
+            cx, cy = int(round(x[i])), int(round(y[i]))
+            r = max(min((major[i] + minor[i]) / 4, 8), 1)
+            disk = (xx**2 + yy**2) <= r**2
+            window = img[cy - 8:cy + 9, cx - 8:cx + 9]
+            if window.shape == disk.shape:
+                window[disk] = 128
+        io.imsave(os.path.join(directory, 'fields',
+                               'fld{:0>4d}.png'.format(fld)),
+                  np.dstack([img] * 3), check_contrast=False)
+
+
+def write_markers(directory):
+    """write refmarkers/marker_pos.txt"""
+
+    os.makedirs(os.path.join(directory, 'refmarkers'), exist_ok=True)
+    with open(os.path.join(directory, 'refmarkers', 'marker_pos.txt'),
+              'w') as f:
+        f.write('# Position of markers in mm\n'
+                '#\n'
+                '# Comment lines start with #\n'
+                '#\n'
+                'Type,stageX,stageY\n'
+                'I,-4.287,-3.491\n'
+                'T,-1.004,5.786\n'
+                'X,4.495,-2.139\n'
+                'C, 0.000,0.000\n')
+
+
+def make_stub(directory, n_fields=324, n_particles=400, images=True, seed=0):
+    """
+    Writes a synthetic stub directory
+
+    Keyword arguments:
+    directory -- the stub directory, created if missing
+
+    n_fields -- number of fields of the stub
+
+    n_particles -- number of particles found by the EDAX PA search
+
+    images -- write the field images (needed for cropping thumbnails)
+
+    seed -- seed of the random generator, equal seeds give equal stubs
+
+    returns a dictionary with the locations of the written files
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(directory, 'thumbnails'), exist_ok=True)
+
+    particles = synthetic_particles(n_fields, n_particles, rng)
+
+    EDAX_file = os.path.join(directory, 'stub01.csv')
+    IJ_file = os.path.join(directory, 'IJ_PA.csv')
+
+    write_stub_summary(directory, n_fields, n_particles)
+    write_EDAX_PAsearch(EDAX_file, particles, rng)
+    IJ_particles = write_IJ_PAsearch(IJ_file, particles, rng)
+    write_markers(directory)
+    if images:
+        write_fields(directory, n_fields, *IJ_particles)
+
+    return {'stub_dir': directory,
+            'EDAX_PAsearch': EDAX_file,
+            'IJ_PAsearch': IJ_file}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic stub directory.')
+    parser.add_argument('directory', help='stub directory to be written')
+    parser.add_argument('--fields', type=int, default=324,
+                        help='number of fields (default: 324)')
+    parser.add_argument('--particles', type=int, default=400,
+                        help='number of EDAX particles (default: 400)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random generator')
+    parser.add_argument('--no-images', action='store_true',
+                        help='do not write the field images')
+    args = parser.parse_args()
+
+    make_stub(args.directory, n_fields=args.fields,
+              n_particles=args.particles, images=not args.no_images,
+              seed=args.seed)
@@ -0,0 +1,283 @@
+# Processes a stub while the SEM particle search is still running
+#
+# usage: python PB_Watch.py <stub_dir> [--interval 5] [--report-interval 300]
+#                           [--idle 30] [--detect]
+#
+# The stub directory is polled for new field images and new rows of the
+# EDAX PA search table. A field is cropped as soon as its image has stopped
+# growing and its particles are complete, i.e. the table has moved on to a
+# later field. The manifest of process_PAsearch.process_fields skips the
+# fields cropped before, so every poll only crops the new ones. The page is
+# refreshed every report_interval seconds. The scan has ended once the stub
+# summary exists and nothing changed for idle seconds (or on Ctrl-C), then
+# the last fields are cropped and the final page is written.
+#
+# The directory is polled instead of watched with inotify, as the
+# instruments write to network shares which do not deliver file events.
+
+import argparse
+import os
+import time
+
+import process_PAsearch
+
+
+def stub_files(stub_dir):
+    """
+    The PA search files of a stub during the scan, named as
+    process_PAsearch.walk_stubdir finds them
+
+    returns a dictionary with the paths 'EDAX_PAsearch', 'IJ_PAsearch' and
+    'summary', None for the files not written yet
+    """
+
+    files = {'EDAX_PAsearch': None, 'IJ_PAsearch': None, 'summary': None}
+    detected = None
+    for name in sorted(os.listdir(stub_dir)):
+        if name.endswith('stub01.csv'):
+            files['EDAX_PAsearch'] = os.path.join(stub_dir, name)
+        elif name == process_PAsearch.DETECTED_IJ_FILE:
+            detected = os.path.join(stub_dir, name)
+        elif name.startswith('IJ') and name.endswith('.csv'):
+            files['IJ_PAsearch'] = os.path.join(stub_dir, name)
+        elif name == 'Stub Summary.txt':
+            files['summary'] = os.path.join(stub_dir, name)
+
+    # the ImageJ PA search is used instead of the detected particles
+    if files['IJ_PAsearch'] is None:
+        files['IJ_PAsearch'] = detected
+
+    return files
+
+
+def poll_fields(stub_dir, ext, sizes):
+    """
+    The field images which have stopped growing since the last poll
+
+    Keyword arguments:
+    stub_dir -- the stub directory, the images are in 'fields/'
+
+    ext -- File extension of the field images
+
+    sizes -- the file size of every field image at the last poll, updated
+             in place
+
+    returns the set of the numbers of the complete fields
+    """
+
+    complete = set()
+    field_dir = os.path.join(stub_dir, 'fields')
+    if not os.path.isdir(field_dir):
+        return complete
+
+    for entry in os.scandir(field_dir):
+        if not (entry.name.startswith('fld') and entry.name.endswith(ext)):
+            continue
+        try:
+            field = int(entry.name[3:-len(ext)])
+            size = entry.stat().st_size
+        except (ValueError, OSError):
+            continue
+        if size and sizes.get(field) == size:
+            complete.add(field)
+        sizes[field] = size
+
+    return complete
+
+
+def read_table(EDAX_file):
+    """
+    The rows of the EDAX PA search written so far, a partly written last
+    row is left out. Raises ValueError if the header is not complete yet.
+    """
+
+    df = process_PAsearch.get_stubinfo(EDAX_file, use_cache=False)
+    with open(EDAX_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell():
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) not in (b'\r', b'\n'):
+                df = df.iloc[:-1]
+
+    return df.dropna(subset=['Part', 'Field', 'X_cent', 'Y_cent'])
+
+
+def complete_fields(df, images, finished=False):
+    """
+    The fields which can be cropped: their image is complete and their
+    particles are, unless the scan has finished the particles of the last
+    field in the table may still be analysed. A later field image shows
+    that the scan has moved on.
+    """
+
+    fields = set(int(field) for field in df.Field.unique())
+    if not finished and fields:
+        last = max(fields)
+        if not any(field > last for field in images):
+            fields.discard(last)
+
+    return fields & images
+
+
+def watch(stub_dir, ext='.png', interval=5, report_interval=300, idle=30,
+          detect=False, encoder=None, dedup_dist=0.005, **options):
+    """
+    Crops the fields of a running scan and refreshes its page until the
+    scan has ended, then writes the final page
+
+    Keyword arguments:
+    stub_dir -- the stub directory
+
+    ext -- File extension of the field images
+
+    interval -- seconds between two polls of the directory
+
+    report_interval -- least seconds between two refreshs of the page
+
+    idle -- seconds without new fields or particles after which a scan
+            with a stub summary has ended
+
+    detect -- detect the particles of every new field (see
+              detect_particles.py) and write them to
+              process_PAsearch.DETECTED_IJ_FILE, instead of waiting for
+              the ImageJ PA search
+
+    encoder, dedup_dist, options -- see PB_GeneratePage.generate_page
+
+    returns the result of the final PB_GeneratePage.generate_page
+    """
+    import PB_GeneratePage
+
+    if encoder is None:
+        encoder = process_PAsearch.ThumbnailEncoder(ext)
+    process_PAsearch.make_stub_dirs(stub_dir)
+    if detect:
+        from skimage import io
+
+        import detect_particles
+
+    sizes = {}
+    seen = set()
+    detected = {}
+    table = {'stat': None, 'df': None}
+    cropped = None
+    last_change = time.time()
+    last_report = time.time()
+    pending = False     # changes not yet shown on the page
+
+    def refresh(files):
+        """write the page, None if the stub files are not complete yet"""
+
+        if detect and detected:
+            files['IJ_PAsearch'] = detect_particles.write_IJfile(
+                detect_particles.particle_table(
+                    [detected[field] for field in sorted(detected)]),
+                os.path.join(stub_dir, process_PAsearch.DETECTED_IJ_FILE))
+        if None in files.values() or table['df'] is None:
+            return None
+        # the rows read so far, without the partly written last one
+        return PB_GeneratePage.generate_page(
+            stub_dir, files['EDAX_PAsearch'], files['IJ_PAsearch'], ext,
+            crop=False, thumbnail_encoder=encoder, dedup_dist=dedup_dist,
+            df_EDAX=table['df'], **options)
+
+    finished = False
+    while True:
+        try:
+            if not finished:
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Interrupted, writing the final page')
+            finished = True
+
+        files = stub_files(stub_dir)
+        if (not finished and files['summary'] is not None
+                and time.time() - last_change >= idle):
+            print('No new fields for {} s, the scan has ended'.format(idle))
+            finished = True
+
+        images = poll_fields(stub_dir, ext, sizes)
+        if finished:
+            # the images do not grow anymore, also the new ones are complete
+            images = poll_fields(stub_dir, ext, sizes)
+        if images - seen:
+            seen |= images
+            last_change = time.time()
+
+        if detect:
+            for field in sorted(images - set(detected)):
+                detected[field] = detect_particles.detect_field(
+                    io.imread(os.path.join(
+                        stub_dir, 'fields',
+                        'fld{:0>4d}{}'.format(field, ext))), field)
+                pending = True
+
+        if files['EDAX_PAsearch'] is not None:
+            stat = os.stat(files['EDAX_PAsearch'])
+            if (stat.st_mtime_ns, stat.st_size) != table['stat']:
+                # the thumbnails are cropped from the complete table, the
+                # duplicates are removed for the page only
+                try:
+                    table['df'] = read_table(files['EDAX_PAsearch'])
+                    table['stat'] = (stat.st_mtime_ns, stat.st_size)
+                except ValueError:
+                    pass    # the header is still being written
+                last_change = time.time()
+                pending = True
+
+        df = table['df']
+        if df is not None:
+            fields = complete_fields(df, images, finished)
+            if fields != cropped:
+                process_PAsearch.process_fields(
+                    df[df.Field.isin(fields)], stub_dir, ext,
+                    encoder=encoder)
+                cropped = fields
+                pending = True
+
+        if finished:
+            start = time.time()
+            result = refresh(files)
+            if result is None:
+                print('Stub summary, EDAX or IJ PA search missing, '
+                      'no page written')
+            else:
+                print('Final page written in {:.1f} s'.format(
+                    time.time() - start))
+            return result
+
+        if pending and time.time() - last_report >= report_interval:
+            # a failed refresh does not end the watch, the page is
+            # refreshed again at the next report interval
+            try:
+                if refresh(files) is not None:
+                    pending = False
+            except Exception as err:
+                print('Refresh failed: {}: {}'.format(type(err).__name__,
+                                                      err))
+            last_report = time.time()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Process a stub while the particle search is running.')
+    parser.add_argument('stub_dir', help='the stub directory')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between the polls (default: 5)')
+    parser.add_argument('--report-interval', type=float, default=300,
+                        help='seconds between the refreshs of the page '
+                             '(default: 300)')
+    parser.add_argument('--idle', type=float, default=30,
+                        help='seconds without new data after which the scan '
+                             'has ended (default: 30)')
+    parser.add_argument('--detect', action='store_true',
+                        help='detect the particles of the new fields '
+                             'instead of using the ImageJ PA search')
+    parser.add_argument('--thumbnail-format', default='png',
+                        help='png, webp or jpeg (default: png)')
+    args = parser.parse_args()
+
+    watch(args.stub_dir, interval=args.interval,
+          report_interval=args.report_interval, idle=args.idle,
+          detect=args.detect,
+          encoder=process_PAsearch.ThumbnailEncoder(args.thumbnail_format))
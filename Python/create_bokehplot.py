@@ -1,20 +1,231 @@
-from bokeh.plotting import figure
-from bokeh.models import (ColumnDataSource,
-                          LinearColorMapper,
-                          CustomJS,
-                          HoverTool,
-                          Rect)
-from bokeh.layouts import layout
+from trace_pipeline import traced
 
+# Columns of the particle table referenced by the glyphs and tooltips and
+# the compact dtypes they are sent with
+PLOT_COLUMNS = {'Part': 'int32',
+                'Field': 'int32',
+                'StgX': 'float32',
+                'StgY': 'float32',
+                'UM': 'float32',
+                'AvgDiam': 'float32'}
 
-def makelayout(PADataFrame, MRKDataFrame, imgs):
-    """Makes a bokeh layout from input-data and the list of thumbnails"""
 
-    # The Data Source from the imported csv stub info
-    PAsource = ColumnDataSource(PADataFrame)
+def prune_source(PADataFrame):
+    """Columns of the particle table used by the plots as compact arrays
 
-    # Add the image files
-    PAsource.add(imgs, 'imgs')
+    Numpy arrays of these dtypes are embedded by bokeh as binary (base64)
+    typed arrays instead of JSON lists. Integer columns with missing values
+    are sent as float32.
+    """
+    import numpy as np
+
+    data = {}
+    for column, dtype in PLOT_COLUMNS.items():
+        if column not in PADataFrame:
+            continue
+        values = PADataFrame[column].values
+        if dtype == 'int32' and np.isnan(values.astype(float)).any():
+            dtype = 'float32'
+        data[column] = values.astype(dtype)
+    return data
+
+
+def particle_data(PADataFrame, imgs, atlas=None, rows=None):
+    """Columns of the particle data source: the pruned particle table, the
+    thumbnail paths and the atlas columns (see makelayout)
+
+    Keyword arguments:
+    rows -- positions of the particles in the table, all if None
+    """
+    import numpy as np
+
+    if rows is None:
+        rows = slice(None)
+    data = prune_source(PADataFrame.iloc[rows])
+    data['imgs'] = list(np.asarray(imgs, dtype=object)[rows])
+    if atlas is not None:
+        for column, values in atlas.items():
+            if column == 'atlas':
+                data[column] = list(np.asarray(values, dtype=object)[rows])
+            else:
+                data[column] = np.asarray(values, dtype='int32')[rows]
+    return data
+
+
+def source_size(dtypes, rows):
+    """estimated size in bytes of a data source in the serialized document,
+    from the dtypes of its columns without serializing them
+
+    The numeric columns are embedded as base64 typed arrays (see
+    prune_source), 4 characters per 3 bytes.
+    """
+    import numpy as np
+
+    size = 0
+    for dtype in dtypes:
+        try:
+            itemsize = np.dtype(dtype).itemsize
+        except TypeError:
+            itemsize = 8    # categories, counted like float64
+        size += 4 * -(-itemsize * rows // 3)
+    return size
+
+
+def histogram_quads(values, bins, value_range):
+    """1D histogram as the columns of a quad glyph (empty bins dropped)"""
+    import numpy as np
+
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    keep = counts > 0
+    return {'left': edges[:-1][keep], 'right': edges[1:][keep],
+            'bottom': np.zeros(keep.sum()), 'top': counts[keep],
+            'count': counts[keep]}
+
+
+def histogram2d_quads(x, y, bins, x_range, y_range):
+    """2D histogram as the columns of a quad glyph (empty bins dropped)"""
+    import numpy as np
+
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins,
+                                              range=[x_range, y_range])
+    i, j = np.nonzero(counts)
+    return {'left': x_edges[i], 'right': x_edges[i + 1],
+            'bottom': y_edges[j], 'top': y_edges[j + 1],
+            'count': counts[i, j]}
+
+
+def _value_range(values):
+    """range of the finite values, widened if all values are equal"""
+    import numpy as np
+
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return (0.0, 1.0)
+    low, high = float(values.min()), float(values.max())
+    return (low, high) if high > low else (low - 0.5, high + 0.5)
+
+
+def _binned_levels(plot, level_data, color_mapper=None, **quad_options):
+    """
+    Draws histograms of increasing resolution as quads, the level shown
+    follows the zoom of the x range: each zoom by a factor of 2 shows the
+    next level with twice the number of bins.
+    """
+    import numpy as np
+    from bokeh.models import ColumnDataSource, CustomJS
+
+    levels = []
+    for level, data in enumerate(level_data):
+        options = dict(quad_options)
+        if color_mapper is not None:
+            options['fill_color'] = {'field': 'count',
+                                     'transform': color_mapper}
+        levels.append(plot.quad(left='left', right='right',
+                                bottom='bottom', top='top',
+                                source=ColumnDataSource(data),
+                                visible=(level == 0), **options))
+
+    x_range = _value_range(np.concatenate(
+        [np.concatenate([d['left'], d['right']]) for d in level_data]))
+    code = """
+        var zoom = %f / Math.max(cb_obj.end - cb_obj.start, 1e-12);
+        var level = Math.floor(Math.log(Math.max(zoom, 1)) / Math.LN2);
+        level = Math.min(level, levels.length - 1);
+        for (var i = 0; i < levels.length; i++) {
+            levels[i].visible = (i == level);
+        }
+    """ % (x_range[1] - x_range[0])
+    for attr in ('start', 'end'):
+        plot.x_range.js_on_change(attr, CustomJS(args=dict(levels=levels),
+                                                 code=code))
+
+    return levels
+
+
+@traced(lambda plots: {'plots': len(plots.children)})
+def makelayout(PADataFrame, MRKDataFrame, imgs, atlas=None,
+               large_threshold=50000, lod_range=4.0, hex_size=0.25,
+               hist_bins=(32, 64, 128), source_rows=None, tiles=None,
+               mosaic=None):
+    """Makes a bokeh layout from input-data and the list of thumbnails
+
+    Keyword arguments:
+    atlas -- columns of the thumbnail sprite sheets as returned by
+             process_PAsearch.build_atlas. The tooltips then crop the
+             thumbnails from the sheets instead of loading single files.
+    large_threshold -- number of particles above which the large-dataset
+                       mode is used (None to disable): the plots are
+                       rendered with WebGL, the substrate plots show
+                       the binned particle density while zoomed out and
+                       the size plots show precomputed histograms
+    lod_range -- width of the visible range in mm below which the
+                 particles are drawn in the large-dataset mode, None leaves
+                 the switching to the server (see PB_Server.py)
+    hex_size -- size of the hexagonal density bins in mm
+    hist_bins -- number of bins per axis of the histogram levels in the
+                 large-dataset mode
+    source_rows -- rows of PADataFrame initially sent with the particle
+                   data source, all if None. The scales, histograms and
+                   densities always cover all particles.
+    tiles -- index of the particle tiles as returned by
+             particle_tiles.write_tiles. The source starts with the root
+             tile and the tiles of the visible range are loaded on pan and
+             zoom of the positions plot.
+    mosaic -- index of the mosaic of the field images as returned by
+              substrate_mosaic.make_mosaic. The substrate plots show the
+              mosaic beneath the particles, the positions plot loads the
+              tiles of the visible range at the level of its zoom.
+
+    The models looked up by the server are named: the data sources
+    'particles' and 'selection', the figure 'positions' and the renderers
+    by their key in renderers, e.g. 'top_left' and 'density_top_left'.
+    """
+    import numpy as np
+    from bokeh.plotting import figure
+    from bokeh.models import (ColumnDataSource,
+                              LinearColorMapper,
+                              CustomJS,
+                              HoverTool,
+                              BoxSelectTool,
+                              LassoSelectTool,
+                              LinearInterpolator,
+                              Rect)
+    from bokeh.palettes import Greys256
+    from bokeh.layouts import layout
+
+    import particle_tiles
+    import substrate_mosaic
+
+    if tiles is not None and source_rows is None:
+        source_rows = tiles['root_rows']
+
+    # The Data Source from the imported csv stub info, reduced to the
+    # columns used by the plots, with the image files
+    PAsource = ColumnDataSource(
+        particle_data(PADataFrame, imgs, atlas, source_rows),
+        name='particles')
+
+    # Markup of the thumbnail in the tooltips
+    if atlas is None:
+        thumbnail = """
+                     <img
+                         src="@imgs" alt="@imgs"
+                         style="float: left; margin: 0px 15px 15px 0px;"
+                         border="2"
+                     ></img>"""
+        thumbnail_small = """
+                     <img src="@imgs" alt="@imgs"
+                          style="width = 50px"></img><br>"""
+    else:
+        sprite = """
+                     <div style="width: @atlas_w{0}px;
+                          height: @atlas_h{0}px;
+                          background: url(@atlas)
+                                      -@atlas_x{0}px -@atlas_y{0}px;
+                          %s"></div>"""
+        thumbnail = sprite % ('float: left; margin: 0px 15px 15px 0px; '
+                              'border: 2px solid;')
+        thumbnail_small = sprite % '' + '<br>'
 
     # The Data source of the markers
     MRKsource = ColumnDataSource(MRKDataFrame)
@@ -25,8 +236,6 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
                                      low=0, high=1e2)
 
     # Definition of a linear interpolator to map the circle sizes
-    from bokeh.models import LinearInterpolator
-
     size_mapper = LinearInterpolator(
         x=[PADataFrame.AvgDiam.min(), PADataFrame.AvgDiam.max()],
         y=[0.1, 0.3]
@@ -50,6 +259,10 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
 
     renderers = {}
 
+    large = (large_threshold is not None
+             and len(PADataFrame) > large_threshold)
+    backend = 'webgl' if large else 'canvas'
+
     TOOLS = "pan,wheel_zoom,box_select,lasso_select,reset,help"
 
     CBsource = ColumnDataSource({'x': [], 'y': [], 'width': [], 'height': []})
@@ -69,7 +282,9 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
                       width=fig_width,
                       height=fig_height,
                       title='Particle Positions on Substrate',
-                      x_range=[-13, 13], y_range=[-13, 13])
+                      output_backend=backend,
+                      x_range=[-13, 13], y_range=[-13, 13],
+                      name='positions')
 
     renderers['top_left'] = top_left.circle(
         'StgX', 'StgY',
@@ -103,12 +318,37 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
     top_left.y_range.callback = CustomJS(
             args=dict(source=CBsource), code=jscode % ('y', 'height'))
 
+    if tiles is not None:
+        loader = CustomJS(args=dict(source=PAsource,
+                                    x_range=top_left.x_range,
+                                    y_range=top_left.y_range),
+                          code=particle_tiles.tile_loader_code(tiles))
+        for axis_range in (top_left.x_range, top_left.y_range):
+            for attr in ('start', 'end'):
+                axis_range.js_on_change(attr, loader)
+
+    if mosaic is not None:
+        MOSAICsource = ColumnDataSource(substrate_mosaic.mosaic_tiles(
+            mosaic, (-13, 13), (-13, 13), fig_width))
+        top_left.image_url(url='url', x='x', y='y', w='w', h='h',
+                           anchor='top_left', source=MOSAICsource,
+                           level='image')
+        loader = CustomJS(args=dict(source=MOSAICsource,
+                                    x_range=top_left.x_range,
+                                    y_range=top_left.y_range),
+                          code=substrate_mosaic.mosaic_loader_code(
+                              mosaic, fig_width))
+        for axis_range in (top_left.x_range, top_left.y_range):
+            for attr in ('start', 'end'):
+                axis_range.js_on_change(attr, loader)
+
     # TOP RIGHT PLOT #
 
     top_right = figure(tools=TOOLS,
                        width=fig_width, height=fig_height,
                        toolbar_location=None,
                        title='Substrate Overview',
+                       output_backend=backend,
                        x_range=[-13, 13], y_range=[-13, 13])
 
     rect = Rect(x='x', y='y',
@@ -117,6 +357,14 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
                 line_alpha=0,
                 fill_color='Teal')
 
+    if mosaic is not None:
+        # the overview does not zoom, its tiles are fixed
+        top_right.image_url(url='url', x='x', y='y', w='w', h='h',
+                            anchor='top_left', level='image',
+                            source=ColumnDataSource(
+                                substrate_mosaic.mosaic_tiles(
+                                    mosaic, (-13, 13), (-13, 13), fig_width)))
+
     top_right.add_glyph(CBsource, rect)
 
     renderers['top_right'] = top_right.circle(
@@ -147,7 +395,8 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
                          active_scroll="wheel_zoom",
                          width=fig_width,
                          height=fig_height,
-                         title='Content vs Particle Size')
+                         title='Content vs Particle Size',
+                         output_backend=backend)
 
     renderers['bottom_left'] = bottom_left.circle(
         'AvgDiam', 'UM',
@@ -161,7 +410,8 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
                           active_scroll="wheel_zoom",
                           width=fig_width,
                           height=fig_height,
-                          title='Circularity vs Particle Size')
+                          title='Circularity vs Particle Size',
+                          output_backend=backend)
 
     renderers['bottom_right'] = bottom_right.circle(
         'AvgDiam', 'Circ',
@@ -174,6 +424,100 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
         hover_color='red',
         source=PAsource)
 
+    if large:
+        # Zoomed out, the substrate plots show hexagonal bins of the
+        # particle density. The particles are drawn once the visible range
+        # of the positions plot is narrower than lod_range. The selection
+        # tools only act on the particles, selections resolve to them.
+        for name, plot in (('top_left', top_left),
+                           ('top_right', top_right)):
+            density, bins = plot.hexbin(
+                PADataFrame.StgX.values, PADataFrame.StgY.values,
+                size=hex_size, palette=Greys256[::-1][32:],
+                fill_alpha=0.7)
+            renderers['density_' + name] = density
+            renderers[name].visible = False
+            for tool in plot.select(type=BoxSelectTool):
+                tool.renderers = [renderers[name]]
+            for tool in plot.select(type=LassoSelectTool):
+                tool.renderers = [renderers[name]]
+
+        if lod_range is not None:
+            lod_code = """
+                var zoomed_in = (cb_obj.end - cb_obj.start) < %f;
+                particles.visible = zoomed_in;
+                density.visible = !zoomed_in;
+            """ % lod_range
+            for attr in ('start', 'end'):
+                top_left.x_range.js_on_change(attr, CustomJS(
+                    args=dict(particles=renderers['top_left'],
+                              density=renderers['density_top_left']),
+                    code=lod_code))
+
+    distributions = []
+    if large:
+        # The size plots show 2D histograms computed here, so the browser
+        # draws a fixed number of bins. The particles selected in the
+        # substrate plots are copied into SELsource and drawn as points.
+        SELsource = ColumnDataSource({name: []
+                                      for name in PAsource.column_names},
+                                     name='selection')
+        PAsource.selected.js_on_change('indices', CustomJS(
+            args=dict(source=PAsource, selection=SELsource), code="""
+                var indices = source.selected.indices;
+                var data = {};
+                for (var name in source.data) {
+                    var values = [];
+                    for (var i = 0; i < indices.length; i++) {
+                        values.push(source.data[name][indices[i]]);
+                    }
+                    data[name] = values;
+                }
+                selection.data = data;
+            """))
+
+        diam = PADataFrame.AvgDiam.values.astype(float)
+        diam_range = _value_range(diam)
+        bin_mapper = LinearColorMapper(palette=Greys256[::-1][32:], low=0)
+        # the content plot only, bottom_right is not part of the layout
+        if 'UM' in PADataFrame:
+            values = PADataFrame.UM.values.astype(float)
+            finite = np.isfinite(diam) & np.isfinite(values)
+            _binned_levels(
+                bottom_left,
+                [histogram2d_quads(diam[finite], values[finite], bins,
+                                   diam_range, _value_range(values))
+                 for bins in hist_bins],
+                color_mapper=bin_mapper, line_color=None)
+
+            renderers['bottom_left'].visible = False
+            for tool in bottom_left.select(type=BoxSelectTool):
+                tool.renderers = [renderers['bottom_left']]
+            for tool in bottom_left.select(type=LassoSelectTool):
+                tool.renderers = [renderers['bottom_left']]
+            renderers['bottom_left'] = bottom_left.circle(
+                'AvgDiam', 'UM', size=circle_size, color='red',
+                alpha=0.5, source=SELsource)
+
+        # 1D distributions of the size and the content
+        for column, title, label in (
+                ('AvgDiam', 'Size Distribution', "Average Diameter / µm"),
+                ('UM', 'Content Distribution', "Content / (wt %)")):
+            values = PADataFrame[column].values.astype(float)
+            values = values[np.isfinite(values)]
+            plot = figure(width=fig_width, height=fig_height, title=title,
+                          tools="pan,xwheel_zoom,reset",
+                          active_scroll="xwheel_zoom",
+                          output_backend=backend)
+            _binned_levels(
+                plot,
+                [histogram_quads(values, bins, _value_range(values))
+                 for bins in hist_bins],
+                fill_color='Teal', line_color=None, fill_alpha=0.7)
+            plot.xaxis.axis_label = label
+            plot.yaxis.axis_label = "Particles"
+            distributions.append(plot)
+
     # Axis labels
     top_left.xaxis.axis_label = "x / mm"
     top_left.yaxis.axis_label = "y / mm"
@@ -189,12 +533,7 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
     PA_hover = HoverTool(
         tooltips="""
            <div>
-                 <div>
-                     <img
-                         src="@imgs" alt="@imgs"
-                         style="float: left; margin: 0px 15px 15px 0px;"
-                         border="2"
-                     ></img>
+                 <div>""" + thumbnail + """
                  </div>
                  <div>
                      <span style="font-size: 15px;
@@ -225,9 +564,7 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
     left_hover = HoverTool(
         tooltips="""
            <div>
-                 <div>
-                     <img src="@imgs" alt="@imgs"
-                          style="width = 50px"></img><br>
+                 <div>""" + thumbnail_small + """
                  </div>
                  <div>
                      <span style="font-size: 15px; font-weight: bold;
@@ -251,9 +588,7 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
     right_hover = HoverTool(
         tooltips="""
            <div>
-                 <div>
-                     <img src="@imgs" alt="@imgs"
-                          style="width = 50px"></img><br>
+                 <div>""" + thumbnail_small + """
                  </div>
                  <div>
                      <span style="font-size: 15px; font-weight: bold;
@@ -280,7 +615,10 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
     bottom_left.add_tools(left_hover)
     bottom_right.add_tools(right_hover)
 
-    figures = [top_right, top_left, bottom_left]
+    for name, renderer in renderers.items():
+        renderer.name = name
+
+    figures = [top_right, top_left, bottom_left] + distributions
     for plot in figures:
         plot.title.align = 'center'
         plot.title.text_font_style = 'normal'
@@ -288,4 +626,8 @@ def makelayout(PADataFrame, MRKDataFrame, imgs):
         plot.yaxis.axis_label_text_font_style = 'normal'
         plot.outline_line_color = "black"
 
+    if distributions:
+        return layout([[top_left, top_right], [bottom_left],
+                       distributions])
+
     return layout([[top_left, top_right], [bottom_left]])
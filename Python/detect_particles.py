@@ -0,0 +1,459 @@
+# Particle detection on the field images of a stub
+#
+# Replaces the ImageJ "Analyze Particles" run over fields/*.png. Every field
+# is thresholded and labelled (8-connected) and the particles are measured
+# like ImageJ does:
+#
+#   Area, Mean, StdDev, Mode, Min, Max, Median, IntDen, RawIntDen
+#                   grey values of the particle pixels
+#   X, Y, XM, YM    centroid and centre of mass (pixel centres at +0.5)
+#   Major, Minor, Angle
+#                   ellipse with the second moments and the area of the
+#                   particle, angle of the major axis (0-180, y up)
+#   Perim.          perimeter of the traced outline with corner correction
+#   Feret, FeretX, FeretY, FeretAngle, MinFeret
+#                   maximal and minimal caliper of the traced outline
+#   Circ., AR, Round, Solidity
+#                   shape descriptors
+#
+# The result is the DataFrame returned by process_PAsearch.import_IJfile.
+
+import os
+
+from trace_pipeline import traced
+
+PIXELSIZE = 0.23142628587258555     # um
+
+IJ_COLUMNS = ['Part', 'Field', 'Area', 'Mean', 'StdDev', 'Mode', 'Min',
+              'Max', 'X_cent', 'Y_cent', 'XM', 'YM', 'Perim.', 'Major',
+              'Minor', 'Angle', 'Circ', 'Feret', 'IntDen', 'Median',
+              'RawIntDen', 'Slice', 'FeretX', 'FeretY', 'FeretAngle',
+              'MinFeret', 'AR', 'Round', 'Solidity']
+
+# directions of the outline edges, each step to the next one is a left
+# turn (image coordinates, y down)
+_STEPS = ((0, -1), (-1, 0), (0, 1), (1, 0))
+
+
+def channel_sum(img):
+    """ Sum of the colour channels of a field image
+
+        ImageJ converts RGB to grey by the unweighted mean (r + g + b) // 3.
+        The sum is thresholded directly, the mean is only computed for the
+        particle pixels.
+
+        returns the sum (uint16) and the number of channels
+    """
+    import numpy as np
+
+    if img.ndim == 2:
+        return img, 1
+    total = img[..., 0].astype(np.uint16)
+    for channel in range(1, min(img.shape[2], 3)):
+        total += img[..., channel]
+    return total, min(img.shape[2], 3)
+
+
+def outlines(labels, pixels=None):
+    """ Outer outlines of the labelled particles along the pixel edges
+
+        labels:     label image of the particles (8-connected), 0 is the
+                    background
+
+        pixels:     the rows and columns of the particle pixels in the
+                    order of the image (np.nonzero(labels)), found if None
+
+        The boundary edges of all particles are found and linked to their
+        successor in array passes over the image: the edges keep the
+        particle on their left and turn right first, so diagonally
+        connected pixels are enclosed. The edges are ordered along their
+        outline by pointer jumping, one array pass per doubling of the
+        distance, the outlines of holes are left out.
+
+        returns the label of every vertex and the arrays x, y of the
+        vertices (pixel corners), grouped by label. The vertices of a
+        particle are in the order of ImageJ: clockwise, ending with the top
+        right corner of the first row of pixels. The corner correction of
+        the perimeter depends on the order, see outline_perimeters.
+    """
+    import numpy as np
+
+    dx = np.array([step[0] for step in _STEPS])
+    dy = np.array([step[1] for step in _STEPS])
+    height, width = labels.shape
+
+    def inside(x, y):
+        within = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        return within & (labels[np.clip(y, 0, height - 1),
+                                np.clip(x, 0, width - 1)] != 0)
+
+    # the boundary edges of the pixels counterclockwise: the neighbour
+    # outside the edge, the start corner and the direction of the edge
+    py, px = np.nonzero(labels) if pixels is None else pixels
+    edges = []
+    for (nx, ny), (sx, sy), d in (((0, -1), (1, 0), 1), ((-1, 0), (0, 0), 2),
+                                  ((0, 1), (0, 1), 3), ((1, 0), (1, 1), 0)):
+        free = ~inside(px + nx, py + ny)
+        edges.append((px[free] + sx, py[free] + sy, np.full(free.sum(), d),
+                      labels[py[free], px[free]]))
+    ex, ey, ed, el = (np.concatenate(column) for column in zip(*edges))
+    key = (ey.astype(np.int64) * (width + 1) + ex) * 4 + ed
+    order = np.argsort(key)
+    ex, ey, ed, el, key = ex[order], ey[order], ed[order], el[order], \
+        key[order]
+
+    # the successor: of the turns right, straight and left the first one
+    # with the particle on its left
+    x, y = ex + dx[ed], ey + dy[ed]
+    nd = (ed + 1) % 4
+    for turn in (0, 3):
+        e = (ed + turn) % 4
+        left = inside(x + (dx[e] + dy[e] - 1) // 2,
+                      y + (dy[e] - dx[e] - 1) // 2)
+        nd = np.where(left, e, nd)
+    nxt = np.searchsorted(key,
+                          (y.astype(np.int64) * (width + 1) + x) * 4 + nd)
+
+    # the outline starts down the left edge of the first pixel of the
+    # particle in the image, the edge before it is its last edge
+    n = len(key)
+    _, first = np.unique(labels[py, px], return_index=True)
+    start = np.searchsorted(key, (py[first].astype(np.int64) * (width + 1)
+                                  + px[first]) * 4 + 2)
+    pred = np.empty(n, dtype=np.int64)
+    pred[nxt] = np.arange(n)
+    last = np.zeros(n, dtype=bool)
+    last[pred[start]] = True
+
+    # the distance of every edge to the last edge of its outline, the edges
+    # of holes never reach one
+    jump = np.where(last, np.arange(n), nxt)
+    dist = (~last).astype(np.int64)
+    for _ in range(int(np.log2(max(n, 1))) + 1):
+        dist += dist[jump]
+        jump = jump[jump]
+    outer = np.flatnonzero(last[jump])
+    seq = outer[np.lexsort((-dist[outer], el[outer]))]
+
+    # the vertices are the corners where the direction changes
+    group = el[seq]
+    bounds = np.flatnonzero(np.diff(group, prepend=-1, append=-1))
+    d = ed[seq]
+    prev = np.roll(d, 1)
+    prev[bounds[:-1]] = d[bounds[1:] - 1]
+    corner = d != prev
+    vx, vy, vl = ex[seq][corner], ey[seq][corner], group[corner]
+
+    # ImageJ order: reversed, the first corner of the tracing (the top left
+    # corner of the first pixel) second to last
+    bounds = np.flatnonzero(np.diff(vl, prepend=-1, append=-1))
+    sizes = np.diff(bounds)
+    begin = np.repeat(bounds[:-1], sizes)
+    size = np.repeat(sizes, sizes)
+    p = np.arange(len(vl)) - begin
+    position = begin + np.where(p == size - 1, p, size - 2 - p)
+    out_x, out_y = np.empty_like(vx), np.empty_like(vy)
+    out_x[position], out_y[position] = vx, vy
+
+    return vl, out_x, out_y
+
+
+def outline_perimeters(vl, xs, ys, n):
+    """ Perimeters of the outlines with the corner correction of ImageJ
+
+        vl, xs, ys: the outlines as returned by outlines
+
+        n:          number of particles, labelled 1..n
+
+        Every vertex after a side longer than a pixel is a corner. Along
+        the steps of one pixel every second vertex is, starting with the
+        first one of an outline.
+
+        returns the perimeter of every particle
+    """
+    import numpy as np
+
+    bounds = np.flatnonzero(np.diff(vl, prepend=-1, append=-1))
+    first = np.zeros(len(vl), dtype=bool)
+    first[bounds[:-1]] = True
+
+    # the side to every vertex from the previous one of its outline
+    before = np.arange(len(vl)) - 1
+    before[bounds[:-1]] = bounds[1:] - 1
+    side = np.abs(xs - xs[before]) + np.abs(ys - ys[before])
+
+    index = np.arange(len(vl))
+    anchor = np.maximum.accumulate(np.where((side > 1) | first, index, 0))
+    corners = np.bincount(vl, (index - anchor) % 2 == 0, minlength=n + 1)
+
+    return (np.bincount(vl, side, minlength=n + 1)
+            - corners * (2.0 - 2.0**0.5))[1:]
+
+
+def outline_shape(xs, ys):
+    """ Feret values and convex hull area of a traced outline
+
+        returns Feret, FeretX, FeretY, FeretAngle, MinFeret and the area of
+        the convex hull
+    """
+    import numpy as np
+    from scipy.spatial import ConvexHull
+
+    # counterclockwise from the top left vertex
+    ccw = np.column_stack([xs, ys]).astype(float)[::-1]
+    top_left = np.lexsort((ccw[:, 0], ccw[:, 1]))[0]
+    ccw = np.roll(ccw, -top_left, axis=0)
+    hull = ConvexHull(ccw)
+
+    # maximal caliper: the most distant pair of vertices, both are vertices
+    # of the convex hull. ImageJ keeps the first of equally distant pairs in
+    # the order of the outline.
+    vertices = np.sort(hull.vertices)
+    pts = ccw[vertices]
+    diff = pts[:, None, :] - pts[None, :, :]
+    dist = np.hypot(diff[..., 0], diff[..., 1])
+    i, j = np.unravel_index(dist.argmax(), dist.shape)
+    (x1, y1), (x2, y2) = pts[min(i, j)], pts[max(i, j)]
+    if x1 > x2:
+        x1, y1, x2, y2 = x2, y2, x1, y1
+    angle = np.degrees(np.arctan2(y1 - y2, x2 - x1)) % 180.0
+
+    # the minimal caliper is perpendicular to one of the hull edges
+    corners = ccw[hull.vertices]
+    edges = np.roll(corners, -1, axis=0) - corners
+    normals = np.column_stack([-edges[:, 1], edges[:, 0]])
+    normals /= np.hypot(normals[:, 0], normals[:, 1])[:, None]
+    proj = corners @ normals.T
+    min_feret = (proj.max(axis=0) - proj.min(axis=0)).min()
+
+    return dist.max(), x1, y1, angle, min_feret, hull.volume
+
+
+def detect_field(img, field, threshold=12, min_area=1):
+    """ Detects and measures the particles on a field image
+
+        img:        the field image (grey or RGB)
+
+        field:      number of the field
+
+        threshold:  lowest grey value of a particle pixel
+
+        min_area:   smallest particle in pixels
+
+        returns a dictionary with an array for each column of IJ_COLUMNS
+        except 'Part'
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    total, channels = channel_sum(img)
+    labels, n = ndimage.label(total >= threshold * channels,
+                              structure=np.ones((3, 3), dtype=bool))
+
+    # statistics of all particles at once from the sorted particle pixels
+    index = np.flatnonzero(labels)
+    pixels = np.divmod(index, labels.shape[1])     # in the image order
+    label = labels.ravel()[index]
+    order = np.argsort(label, kind='stable')
+    index, label = index[order], label[order]
+    value = (total.ravel()[index] // channels).astype(float)
+    y, x = np.divmod(index, total.shape[1])
+    x, y = x + 0.5, y + 0.5
+
+    area = np.bincount(label, minlength=n + 1)[1:].astype(float)
+    keep = area >= min_area
+
+    def per_particle(weights):
+        return np.bincount(label, weights, minlength=n + 1)[1:]
+
+    raw = per_particle(value)
+    mean = raw / area
+    std = np.sqrt(np.maximum(per_particle(value**2) - area * mean**2, 0)
+                  / np.maximum(area - 1, 1))
+    xc = per_particle(x) / area
+    yc = per_particle(y) / area
+    xm = per_particle(x * value) / np.where(raw > 0, raw, 1)
+    ym = per_particle(y * value) / np.where(raw > 0, raw, 1)
+
+    # second moments of the pixels (a pixel adds 1/12) for the ellipse
+    rel_x, rel_y = x - xc[label - 1], y - yc[label - 1]
+    xx = per_particle(rel_x**2) / area + 1 / 12
+    yy = per_particle(rel_y**2) / area + 1 / 12
+    xy = per_particle(rel_x * rel_y) / area
+    root = np.sqrt(((xx - yy) / 2)**2 + xy**2)
+    major = np.sqrt((xx + yy) / 2 + root)
+    minor = np.sqrt(np.maximum((xx + yy) / 2 - root, 1e-12))
+    scale = np.sqrt(area / (np.pi * major * minor))
+    major, minor = 2 * major * scale, 2 * minor * scale
+    angle = np.degrees(np.arctan2(-2 * xy, xx - yy) / 2) % 180.0
+
+    bounds = np.searchsorted(label, np.arange(1, n + 2))
+    median = np.empty(n)
+    mode = np.empty(n)
+    vmin = np.empty(n)
+    vmax = np.empty(n)
+    shape = np.empty((n, 7))
+    # the outlines of all particles at once
+    vl, vx, vy = outlines(labels, pixels)
+    shape[:, 0] = outline_perimeters(vl, vx, vy, n)
+    corners = np.searchsorted(vl, np.arange(1, n + 2))
+    for i in np.flatnonzero(keep):
+        values = np.sort(value[bounds[i]:bounds[i + 1]])
+        vmin[i], vmax[i] = values[0], values[-1]
+        # ImageJ reports the lower median of an even number of values
+        median[i] = values[(len(values) - 1) // 2]
+        uniq, counts = np.unique(values, return_counts=True)
+        mode[i] = uniq[counts.argmax()]
+
+        shape[i, 1:] = outline_shape(vx[corners[i]:corners[i + 1]],
+                                     vy[corners[i]:corners[i + 1]])
+
+    perim, feret, feret_x, feret_y, feret_angle, min_feret, hull = shape.T
+    circ = np.minimum(4 * np.pi * area / perim**2, 1.0)
+
+    columns = {'Field': np.full(n, field, dtype=float),
+               'Area': area, 'Mean': mean, 'StdDev': std, 'Mode': mode,
+               'Min': vmin, 'Max': vmax, 'X_cent': xc, 'Y_cent': yc,
+               'XM': xm, 'YM': ym, 'Perim.': perim, 'Major': major,
+               'Minor': minor, 'Angle': angle, 'Circ': circ,
+               'Feret': feret, 'IntDen': area * mean, 'Median': median,
+               'RawIntDen': raw, 'Slice': np.full(n, field, dtype=float),
+               'FeretX': feret_x, 'FeretY': feret_y,
+               'FeretAngle': feret_angle, 'MinFeret': min_feret,
+               'AR': major / minor, 'Round': 4 * area / (np.pi * major**2),
+               'Solidity': area / hull}
+
+    return {col: values[keep] for col, values in columns.items()}
+
+
+def _detect_field_job(args):
+    """detect the particles of a field file in a worker process"""
+    from skimage import io
+
+    filename, field, threshold, min_area = args
+    try:
+        return field, detect_field(io.imread(filename), field, threshold,
+                                   min_area), None
+    except Exception as err:
+        return field, None, '{}: {}'.format(type(err).__name__, err)
+
+
+@traced(lambda df: {'particles': len(df)})
+def detect_particles(stub_dir, ext='.png', threshold=12, min_area=1,
+                     pixelsize=PIXELSIZE, workers=1):
+    """
+    Detects the particles on all field images of a stub
+
+    Keyword arguments:
+    stub_dir -- the stub directory, the fields are read from 'fields/'
+
+    ext -- File extension of the field images
+
+    threshold -- lowest grey value of a particle pixel
+
+    min_area -- smallest particle in pixels
+
+    pixelsize -- pixel size in um, for the column 'AvgDiam'
+
+    workers -- number of worker processes, None uses all cores
+
+    returns a DataFrame with the columns of process_PAsearch.import_IJfile,
+    the particles are numbered in the order of the fields
+    """
+    field_dir = os.path.join(stub_dir, 'fields')
+    jobs = []
+    for name in sorted(os.listdir(field_dir)):
+        if name.startswith('fld') and name.endswith(ext):
+            jobs.append((os.path.join(field_dir, name),
+                         int(name[3:-len(ext)]), threshold, min_area))
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_detect_field_job, jobs, chunksize=8))
+    else:
+        results = [_detect_field_job(job) for job in jobs]
+
+    fields = []
+    for field, columns, error in results:
+        if error is not None:
+            print('Field {:0>4d} failed: {}'.format(field, error))
+        else:
+            fields.append(columns)
+
+    return particle_table(fields, pixelsize)
+
+
+def particle_table(fields, pixelsize=PIXELSIZE):
+    """
+    the particles of the fields as returned by detect_field in one
+    DataFrame, numbered in the given order of the fields
+    """
+    import numpy as np
+    import pandas as pd
+
+    import process_PAsearch
+
+    df = pd.DataFrame({col: np.concatenate([f[col] for f in fields])
+                       if fields else np.zeros(0)
+                       for col in IJ_COLUMNS[1:]},
+                      columns=IJ_COLUMNS[1:])
+    df.insert(0, 'Part', np.arange(1, len(df) + 1))
+    df['AvgDiam'] = df[['Major', 'Minor']].mean(axis=1) * pixelsize
+
+    return process_PAsearch.compact_table(df)
+
+
+def write_IJfile(df, filename):
+    """
+    write the detected particles in the format of the ImageJ csv file, so
+    process_PAsearch.import_IJfile reads them back
+    """
+
+    out = df.drop(columns=['AvgDiam']).rename(
+        columns={'Part': ' ', 'Field': 'Label', 'X_cent': 'X',
+                 'Y_cent': 'Y', 'Circ': 'Circ.'})
+    out['Label'] = ['fields:fld{:0>4d}'.format(int(field))
+                    for field in out['Label']]
+    out.to_csv(filename, index=False, float_format='%.3E')
+
+    return filename
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Detect the particles on the field images of a stub.')
+    parser.add_argument('stub_dir', help='the stub directory')
+    parser.add_argument('--out', default=None,
+                        help='csv file (default: '
+                             '<stub_dir>/IJ_PA_detected.csv)')
+    parser.add_argument('--force', action='store_true',
+                        help='overwrite an existing --out file')
+    parser.add_argument('--threshold', type=int, default=12,
+                        help='lowest grey value of a particle (default: 12)')
+    parser.add_argument('--min-area', type=int, default=1,
+                        help='smallest particle in pixels (default: 1)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: cores)')
+    args = parser.parse_args()
+
+    import process_PAsearch
+
+    # the ImageJ PA search of the stub is kept, the detected particles are
+    # written next to it
+    out = args.out or os.path.join(args.stub_dir,
+                                   process_PAsearch.DETECTED_IJ_FILE)
+    if args.out and os.path.exists(out) and not args.force:
+        parser.error('{} exists, use --force to overwrite it'.format(out))
+
+    df = detect_particles(args.stub_dir, threshold=args.threshold,
+                          min_area=args.min_area, workers=args.workers)
+    write_IJfile(df, out)
+    print('{} particles on {} fields written to {}'.format(
+        len(df), df.Field.nunique(), out))
@@ -0,0 +1,342 @@
+# Particle database across stubs
+#
+# usage: python particle_db.py ingest <root> [--db particles.sqlite]
+#               [--force] [--dedup-dist 0.005]
+#        python particle_db.py query [--db particles.sqlite] [--sample S]
+#               [--min-diam 5] [--min-um 80] [--since 2017-01-01] [--out F]
+#
+# The matched particle table of every stub (see
+# process_PAsearch.match_EDAX_IJ_PAsearch) is appended to a SQLite file,
+# one row per particle with the columns of the table, and the stub to the
+# table 'stubs' with its sample, acquisition date and the fingerprint of
+# its PA search files. Particles are indexed by sample (through the stub),
+# field, AvgDiam and UM, so queries across many stubs read neither the raw
+# files nor the whole table. Reingesting a stub replaces its particles. The
+# duplicates on overlapping fields are removed as on the page of the stub.
+
+import argparse
+import os
+import sqlite3
+import time
+
+import process_PAsearch
+from trace_pipeline import traced
+
+STUB_COLUMNS = [('stub_id', 'INTEGER PRIMARY KEY'),
+                ('sample', 'TEXT'),
+                ('stub_dir', 'TEXT UNIQUE'),
+                ('date', 'TEXT'),
+                ('particles', 'INTEGER'),
+                ('fingerprint', 'TEXT'),
+                ('ingested', 'TEXT')]
+
+INDEXES = {'stubs_sample': 'stubs (sample)',
+           'stubs_date': 'stubs (date)',
+           'particles_field': 'particles (stub_id, Field)',
+           'particles_avgdiam': 'particles (AvgDiam)',
+           'particles_um': 'particles (UM)'}
+
+
+def _quote(name):
+    """SQL identifier of a column name, e.g. '"Perim."'"""
+
+    return '"' + name.replace('"', '""') + '"'
+
+
+def connect(db_file):
+    """ Opens the database, creates the tables and indexes if needed
+
+        returns the sqlite3 connection
+    """
+
+    con = sqlite3.connect(db_file)
+    con.execute('CREATE TABLE IF NOT EXISTS stubs ({})'.format(
+        ', '.join(name + ' ' + kind for name, kind in STUB_COLUMNS)))
+    # the particle columns are added by the ingested stubs
+    con.execute('CREATE TABLE IF NOT EXISTS particles '
+                '(stub_id INTEGER, Part INTEGER, Field REAL, AvgDiam REAL, '
+                'UM REAL)')
+    for name, on in INDEXES.items():
+        con.execute('CREATE INDEX IF NOT EXISTS {} ON {}'.format(name, on))
+    con.commit()
+    return con
+
+
+def particle_columns(con):
+    """names of the columns of the particle table"""
+
+    return [row[1] for row in con.execute('PRAGMA table_info(particles)')]
+
+
+def acquisition_date(header):
+    """ the start of the PA search from the stub summary as
+        'YYYY-MM-DD HH:MM', None if it is missing
+    """
+
+    try:
+        start = time.strptime(' '.join(header['Starting Time'].split()),
+                              '%H:%M %m-%d-%Y')
+    except (KeyError, ValueError):
+        return None
+    return time.strftime('%Y-%m-%d %H:%M', start)
+
+
+def _fingerprint(*files):
+    """modification time and size of the files"""
+
+    stats = [os.stat(file) for file in files]
+    return ';'.join('{}:{}'.format(s.st_mtime_ns, s.st_size) for s in stats)
+
+
+@traced(lambda particles: {'particles': particles})
+def ingest_stub(con, stub_dir, EDAX_file, IJ_file, sample=None, force=False,
+                table=None, dedup_dist=0.005):
+    """ Adds the matched particle table of a stub to the database
+
+        con:        the database connection, see connect
+
+        stub_dir, EDAX_file, IJ_file: the stub directory and its PA search
+                    files
+
+        sample:     name of the sample, the name of the stub directory if
+                    None
+
+        force:      reingest the stub even if its files are unchanged
+
+        table:      the matched particle table of the files if it was made
+                    already (see PB_GeneratePage.generate_page), read and
+                    matched from the files if None
+
+        dedup_dist: particles of neighbouring fields closer than dedup_dist
+                    (in mm) are counted once as on the page of the stub, see
+                    process_PAsearch.deduplicate_particles. None keeps them.
+                    A stub is reingested when dedup_dist changes.
+
+        returns the number of particles ingested, 0 if the stub is up to
+        date
+    """
+    import numpy as np
+
+    stub_dir = os.path.abspath(stub_dir)
+    if sample is None:
+        sample = os.path.basename(os.path.normpath(stub_dir))
+    fingerprint = '{};dedup:{}'.format(_fingerprint(EDAX_file, IJ_file),
+                                       dedup_dist)
+
+    row = con.execute('SELECT stub_id, fingerprint FROM stubs '
+                      'WHERE stub_dir = ?', (stub_dir,)).fetchone()
+    if row is not None and row[1] == fingerprint and not force:
+        return 0
+
+    df = table
+    if df is None:
+        df_EDAX = process_PAsearch.get_stubinfo(EDAX_file)
+        if dedup_dist is not None:
+            df_EDAX, _ = process_PAsearch.deduplicate_particles(
+                df_EDAX, dedup_dist)
+        df = process_PAsearch.match_EDAX_IJ_PAsearch(
+            df_EDAX, process_PAsearch.import_IJfile(IJ_file),
+            match_dist=0.005)
+    try:
+        header = process_PAsearch.get_header_data(stub_dir)
+    except OSError:
+        header = {}
+
+    with con:   # one transaction, the stub is replaced completely
+        if row is None:
+            stub_id = con.execute('INSERT INTO stubs (stub_dir) VALUES (?)',
+                                  (stub_dir,)).lastrowid
+        else:
+            stub_id = row[0]
+            con.execute('DELETE FROM particles WHERE stub_id = ?',
+                        (stub_id,))
+        con.execute('UPDATE stubs SET sample = ?, date = ?, particles = ?, '
+                    'fingerprint = ?, ingested = ? WHERE stub_id = ?',
+                    (sample, acquisition_date(header), len(df), fingerprint,
+                     time.strftime('%Y-%m-%d %H:%M:%S'), stub_id))
+
+        # the element columns differ between stubs
+        existing = set(particle_columns(con))
+        for column in df.columns:
+            if column not in existing:
+                kind = ('INTEGER' if np.issubdtype(df[column].dtype,
+                                                   np.integer) else 'REAL')
+                con.execute('ALTER TABLE particles ADD COLUMN {} {}'.format(
+                    _quote(column), kind))
+
+        columns = ['stub_id'] + list(df.columns)
+        values = [np.full(len(df), stub_id)] + [
+            df[column].values for column in df.columns]
+        con.executemany(
+            'INSERT INTO particles ({}) VALUES ({})'.format(
+                ', '.join(map(_quote, columns)),
+                ', '.join('?' * len(columns))),
+            zip(*[v.tolist() for v in values]))
+
+    return len(df)
+
+
+@traced()
+def ingest_tree(db_file, root, index_file=None, force=False,
+                dedup_dist=0.005):
+    """ Ingests all stubs found below root
+
+        db_file:    the database file
+
+        index_file: the discovery index, see process_PAsearch.walk_stubdir
+
+        force, dedup_dist: see ingest_stub
+
+        returns a dictionary with the number of particles ingested per stub
+        directory (0 if up to date, None if the stub failed)
+    """
+    import PB_BatchReport
+
+    con = connect(db_file)
+    ingested = {}
+    try:
+        for stub in PB_BatchReport.find_stubs(root, index_file=index_file):
+            if stub['EDAX_PAsearch'] is None or stub['IJ_PAsearch'] is None:
+                continue
+            try:
+                ingested[stub['stub_dir']] = ingest_stub(
+                    con, stub['stub_dir'], stub['EDAX_PAsearch'],
+                    stub['IJ_PAsearch'], force=force,
+                    dedup_dist=dedup_dist)
+            except Exception as err:
+                print('{} failed: {}: {}'.format(stub['stub_dir'],
+                                                 type(err).__name__, err))
+                ingested[stub['stub_dir']] = None
+    finally:
+        con.close()
+
+    return ingested
+
+
+def sql(db_file, statement, params=()):
+    """runs a SELECT statement on the database, returns a DataFrame"""
+    import pandas as pd
+
+    con = sqlite3.connect(db_file)
+    try:
+        return pd.read_sql_query(statement, con, params=params)
+    finally:
+        con.close()
+
+
+@traced(lambda df: {'particles': len(df)})
+def query_particles(db_file, samples=None, min_diam=None, max_diam=None,
+                    min_um=None, max_um=None, fields=None, since=None,
+                    until=None, columns=None, where=None, params=()):
+    """ Selects particles across the ingested stubs
+
+        db_file:    the database file
+
+        samples:    list of sample names, all if None
+
+        min_diam, max_diam: range of AvgDiam in um
+
+        min_um, max_um: range of the UM content in wt %
+
+        fields:     list of field numbers
+
+        since, until: range of the acquisition date, e.g. '2017-01-01' and
+                    '2017-04-01' (until is excluded)
+
+        columns:    particle columns returned, all if None
+
+        where, params: additional SQL condition on the columns of the
+                    tables particles (p) and stubs (s) with its parameters,
+                    e.g. where='p.Circ > ?', params=(0.8,)
+
+        returns a DataFrame with the sample, the stub directory (both
+        categorical) and the particle columns, in the compact dtypes of
+        process_PAsearch.compact_table
+    """
+
+    conditions = []
+    values = []
+
+    def add(condition, *value):
+        conditions.append(condition)
+        values.extend(value)
+
+    if samples is not None:
+        add('s.sample IN ({})'.format(', '.join('?' * len(samples))),
+            *samples)
+    if fields is not None:
+        add('p.Field IN ({})'.format(', '.join('?' * len(fields))),
+            *[float(field) for field in fields])
+    for column, op, value in (('p.AvgDiam', '>=', min_diam),
+                              ('p.AvgDiam', '<=', max_diam),
+                              ('p.UM', '>=', min_um),
+                              ('p.UM', '<=', max_um),
+                              ('s.date', '>=', since),
+                              ('s.date', '<', until)):
+        if value is not None:
+            add('{} {} ?'.format(column, op), value)
+    if where is not None:
+        add('(' + where + ')', *params)
+
+    selected = ('p.*' if columns is None
+                else ', '.join('p.' + _quote(c) for c in columns))
+    statement = ('SELECT s.sample, s.stub_dir, {} FROM particles p '
+                 'JOIN stubs s ON s.stub_id = p.stub_id'.format(selected))
+    if conditions:
+        statement += ' WHERE ' + ' AND '.join(conditions)
+
+    df = sql(db_file, statement, values)
+    return process_PAsearch.compact_table(
+        df.drop(columns='stub_id', errors='ignore'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Ingest stubs into and query the particle database.')
+    parser.add_argument('command', choices=['ingest', 'query'])
+    parser.add_argument('root', nargs='?',
+                        help='directory searched for stubs (ingest)')
+    parser.add_argument('--db', default='particles.sqlite',
+                        help='database file (default: particles.sqlite)')
+    parser.add_argument('--force', action='store_true',
+                        help='reingest unchanged stubs')
+    parser.add_argument('--dedup-dist', type=float, default=0.005,
+                        help='particles of different fields closer than '
+                             'this (mm) are counted once, 0 keeps them '
+                             '(default: 0.005)')
+    parser.add_argument('--sample', action='append', default=None,
+                        help='sample name, can be repeated (query)')
+    parser.add_argument('--min-diam', type=float, default=None)
+    parser.add_argument('--max-diam', type=float, default=None)
+    parser.add_argument('--min-um', type=float, default=None)
+    parser.add_argument('--max-um', type=float, default=None)
+    parser.add_argument('--since', default=None,
+                        help='earliest acquisition date, e.g. 2017-01-01')
+    parser.add_argument('--until', default=None,
+                        help='end of the acquisition dates (excluded)')
+    parser.add_argument('--out', default=None,
+                        help='csv file of the selected particles (query)')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        if args.root is None:
+            parser.error('ingest needs the root directory')
+        start = time.time()
+        ingested = ingest_tree(args.db, args.root, force=args.force,
+                               dedup_dist=args.dedup_dist or None)
+        print('{} stubs, {} particles ingested, {} up to date, {} failed, '
+              '{:.1f} s'.format(
+                  len(ingested),
+                  sum(n for n in ingested.values() if n),
+                  sum(n == 0 for n in ingested.values()),
+                  sum(n is None for n in ingested.values()),
+                  time.time() - start))
+    else:
+        df = query_particles(args.db, samples=args.sample,
+                             min_diam=args.min_diam, max_diam=args.max_diam,
+                             min_um=args.min_um, max_um=args.max_um,
+                             since=args.since, until=args.until)
+        print('{} particles from {} stubs'.format(len(df),
+                                                  df.stub_dir.nunique()))
+        if args.out is not None:
+            df.to_csv(args.out, index=False)
@@ -0,0 +1,276 @@
+# Static multi-resolution tiles of the particles for the offline page
+#
+# The particles are partitioned into a quadtree over the substrate
+# (-13..13 mm). Every node keeps a random sample of at most `capacity`
+# particles and passes the others on to its four children, so the nodes of
+# the levels 0..L together hold a sample of the particles which gets denser
+# with L, and every particle is stored exactly once.
+#
+# The root node is embedded in the page, the other nodes are written to
+# '<stub_dir>/tiles/<level>_<ix>_<iy>.js'. A tile holds the columns of its
+# particles as little-endian typed arrays (see create_bokehplot.prune_source)
+# encoded in base64 and wrapped in a script, as browsers do not load binary
+# files from a page opened from disk. The page loads the tiles intersecting
+# the visible range at the level of its zoom (see TILE_LOADER_JS).
+
+import json
+import os
+
+from trace_pipeline import traced
+
+EXTENT = (-13.0, 13.0)
+
+
+def build_quadtree(x, y, capacity=4096, max_level=10, extent=EXTENT,
+                   seed=0):
+    """ Partitions the particles into a quadtree
+
+        x, y:       particle positions in mm, particles without a position
+                    are left out
+
+        capacity:   maximal number of particles of a node, except for the
+                    nodes of max_level
+
+        returns a dictionary with the rows of the particles of each node,
+        the key of a node is (level, ix, iy), the root is (0, 0, 0)
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    # the partition keeps the order of the rows, so the first rows of any
+    # node are a random sample of its particles
+    rows = rows[np.random.default_rng(seed).permutation(len(rows))]
+
+    low, high = extent
+    nodes = {}
+    stack = [(0, 0, 0, rows)]
+    while stack:
+        level, ix, iy, rows = stack.pop()
+        if len(rows) <= capacity or level == max_level:
+            nodes[(level, ix, iy)] = rows
+            continue
+        nodes[(level, ix, iy)] = rows[:capacity]
+        rows = rows[capacity:]
+
+        # children of the node split at its centre
+        size = (high - low) / 2**(level + 1)
+        right = x[rows] >= low + (2 * ix + 1) * size
+        top = y[rows] >= low + (2 * iy + 1) * size
+        for cx in (0, 1):
+            for cy in (0, 1):
+                child = rows[(right == cx) & (top == cy)]
+                if len(child):
+                    stack.append((level + 1, 2 * ix + cx, 2 * iy + cy, child))
+
+    return nodes
+
+
+def tile_key(node):
+    """name of the tile of a node, '<level>_<ix>_<iy>'"""
+
+    return '{}_{}_{}'.format(*node)
+
+
+def thumbnail_numbers(PADataFrame):
+    """number of the thumbnail of each particle within its field, see
+    PB_GeneratePage.create_imagelist"""
+    import process_PAsearch
+
+    return process_PAsearch.particle_numbers(PADataFrame) + 1
+
+
+def encode_tile(data, columns, rows):
+    """ the columns of the particles in rows as little-endian bytes
+
+        data:       dictionary with the arrays of all particles
+
+        columns:    list of (name, dtype) of the columns to be encoded
+    """
+    import numpy as np
+
+    return b''.join(np.asarray(data[name][rows],
+                               dtype=np.dtype(dtype).newbyteorder('<'))
+                    .tobytes() for name, dtype in columns)
+
+
+@traced(lambda index: {'tiles': len(index['nodes'])})
+def write_tiles(PADataFrame, directory, ext='.png', capacity=4096,
+                max_level=10, extent=EXTENT):
+    """ Writes the particle tiles of a stub
+
+        PADataFrame: the particle table, see create_bokehplot.makelayout
+
+        directory:  the stub directory, the tiles are written to 'tiles/'
+
+        ext:        file extension of the thumbnails
+
+        capacity, max_level, extent: see build_quadtree
+
+        returns the tile index, a dictionary with the extent, the deepest
+        level, the columns of the tiles, the extension of the thumbnails,
+        the number of particles of each tile ('nodes') and the rows of the
+        root node ('root_rows', embedded in the page)
+    """
+    import base64
+
+    import numpy as np
+
+    import create_bokehplot
+
+    data = create_bokehplot.prune_source(PADataFrame)
+    data['Thumb'] = thumbnail_numbers(PADataFrame).astype('int32')
+    columns = [(name, str(values.dtype)) for name, values in data.items()]
+
+    nodes = build_quadtree(PADataFrame.StgX.values, PADataFrame.StgY.values,
+                           capacity, max_level, extent)
+
+    tile_dir = os.path.join(directory, 'tiles')
+    os.makedirs(tile_dir, exist_ok=True)
+    for name in os.listdir(tile_dir):
+        if name.endswith('.js'):
+            os.remove(os.path.join(tile_dir, name))
+
+    nbytes = 0
+    for node, rows in nodes.items():
+        if node == (0, 0, 0):
+            continue
+        payload = base64.b64encode(encode_tile(data, columns, rows))
+        with open(os.path.join(tile_dir, tile_key(node) + '.js'), 'w') as f:
+            f.write('PB_tile({}, "{}");\n'.format(
+                json.dumps(tile_key(node)), payload.decode('ascii')))
+        nbytes += len(payload)
+
+    print('{} particle tiles written, {:.0f} kB'.format(
+        len(nodes) - 1, nbytes / 1e3))
+
+    root = (0, 0, 0)
+    return {'extent': list(extent),
+            'levels': max(node[0] for node in nodes) if nodes else 0,
+            'columns': columns,
+            'ext': ext,
+            'nodes': {tile_key(node): len(rows)
+                      for node, rows in nodes.items()},
+            'root_rows': nodes.get(root, np.zeros(0, dtype=int))}
+
+
+# Loads the tiles of the visible range into the particle source. Attached
+# to the start and end of the ranges of the positions plot with the
+# arguments source, x_range and y_range; tiles is the index (without the
+# root rows). The root tile is the initial content of the source.
+TILE_LOADER_JS = """
+    var tiles = %s;
+    var state = window.PB_tile_state;
+    if (state === undefined) {
+        state = window.PB_tile_state = {loaded: {}, requested: {}, keys: ''};
+        var root = {};
+        for (var name in source.data) {
+            root[name] = source.data[name];
+        }
+        state.loaded['0_0_0'] = root;
+
+        window.PB_tile = function(key, payload) {
+            var binary = atob(payload);
+            var bytes = new Uint8Array(binary.length);
+            for (var i = 0; i < binary.length; i++) {
+                bytes[i] = binary.charCodeAt(i);
+            }
+            var n = tiles.nodes[key];
+            var columns = {};
+            var offset = 0;
+            for (var c = 0; c < tiles.columns.length; c++) {
+                var type = tiles.columns[c][1] == 'int32' ? Int32Array
+                                                           : Float32Array;
+                columns[tiles.columns[c][0]] = new type(bytes.buffer,
+                                                        offset, n);
+                offset += 4 * n;
+            }
+            var pad = function(value) {
+                return ('0000' + Math.round(value)).slice(-4);
+            };
+            var imgs = new Array(n);
+            for (var i = 0; i < n; i++) {
+                imgs[i] = 'thumbnails/' + pad(columns.Field[i])
+                          + pad(columns.Thumb[i]) + tiles.ext;
+            }
+            columns.imgs = imgs;
+            state.loaded[key] = columns;
+            state.keys = '';
+            state.refresh();
+        };
+    }
+
+    state.refresh = function() {
+        var low = tiles.extent[0], size = tiles.extent[1] - tiles.extent[0];
+        var width = Math.max(x_range.end - x_range.start,
+                             y_range.end - y_range.start, 1e-9);
+        var level = Math.floor(Math.log(size / width) / Math.LN2) + 1;
+        level = Math.max(0, Math.min(level, tiles.levels));
+
+        // the tiles of the levels 0..level intersecting the visible range
+        var keys = [];
+        for (var l = 0; l <= level; l++) {
+            var step = size / Math.pow(2, l), last = Math.pow(2, l) - 1;
+            var clip = function(v) {
+                var i = Math.floor((v - low) / step);
+                return Math.max(0, Math.min(last, i));
+            };
+            for (var ix = clip(x_range.start); ix <= clip(x_range.end); ix++) {
+                for (var iy = clip(y_range.start); iy <= clip(y_range.end);
+                     iy++) {
+                    var key = l + '_' + ix + '_' + iy;
+                    if (tiles.nodes[key] === undefined) {
+                        continue;
+                    }
+                    if (state.loaded[key] !== undefined) {
+                        keys.push(key);
+                    } else if (!state.requested[key]) {
+                        state.requested[key] = true;
+                        var script = document.createElement('script');
+                        script.src = 'tiles/' + key + '.js';
+                        document.head.appendChild(script);
+                    }
+                }
+            }
+        }
+        if (keys.join() == state.keys) {
+            return;
+        }
+        state.keys = keys.join();
+
+        // concatenate the columns of the loaded tiles
+        var data = {};
+        for (var name in state.loaded['0_0_0']) {
+            var parts = keys.map(function(key) {
+                return state.loaded[key][name];
+            });
+            var total = parts.reduce(function(sum, part) {
+                return sum + part.length;
+            }, 0);
+            var first = state.loaded['0_0_0'][name];
+            var values = ArrayBuffer.isView(first) ? new Float64Array(total)
+                                                   : new Array(total);
+            var offset = 0;
+            for (var p = 0; p < parts.length; p++) {
+                for (var i = 0; i < parts[p].length; i++) {
+                    values[offset + i] = parts[p][i];
+                }
+                offset += parts[p].length;
+            }
+            data[name] = values;
+        }
+        source.selected.indices = [];
+        source.data = data;
+    };
+
+    state.refresh();
+"""
+
+
+def tile_loader_code(index):
+    """the code of TILE_LOADER_JS for a tile index, see write_tiles"""
+
+    public = {key: value for key, value in index.items()
+              if key != 'root_rows'}
+    return TILE_LOADER_JS % json.dumps(public)
@@ -6,21 +6,26 @@
 #
 # <sample_id>
 #     |
-#     |_____/cropped/
+#     |_____/thumbnails/
 #     |_____/Reference Markers/
 #     |_____/spc/
 #     |_____/Stub Summary.txt
 #     |_____/<stubinfo csv-File>
 #
 
-import pandas as pd
-import numpy as np
-from io import BytesIO
-from skimage import io, transform
 import os
+import json
+import hashlib
+import queue
+import threading
+import time
 import warnings
 
+import trace_pipeline
+from trace_pipeline import traced
 
+
+@traced()
 def get_header_data(dir_stub):
     """fetch the header info from 'Stub Summary.txt' """
 
@@ -44,200 +49,1142 @@ def get_header_data(dir_stub):
     return dict_header
 
 
-def get_stubinfo(file_stub):
-    """read the stub info file store PA search info in pandas Dataframe"""
+def _clean_names(columns):
+    """column names as np.genfromtxt creates them with names=True"""
 
-    # open the stub invo .csv file
-    with open(file_stub, 'r') as f:
-        file_inputdata = f.read()
+    deletechars = set("~!@#$%^&*()-=+~\\|]}[{';: /?.>,<\"")
+    return [''.join(c for c in name.strip().replace(' ', '_')
+                    if c not in deletechars)
+            for name in columns]
 
-    # extract the PA data
-    # gets the data from the .csv file generated from EDAX PA searc
-    #
-    # for python 3 the io needs to be handled correctly
-    #
-    # The csv files has \r newlines, which np.genfromtxt cannot handle (bug ?)
-    #
-    # The stream is opened in universal newl mode, converts the newlines to \n
-    # inp_data is rewritten into a in memory bytestream for np.genfromtxt
-    # comments is set to "//" to overide the default value "#"
-    import_stub = np.genfromtxt(
-        BytesIO(file_inputdata.encode()),
-        delimiter=",", skip_header=14,
-        names=True, autostrip=True, comments='//'
-    )
-
-    return pd.DataFrame(import_stub)
-
-
-def import_IJfile(file, pixelsize=0.23142628587258555):
-    """read the imageJ PA search csv file and store in dataframe"""
-    import re
 
-    with open(file, 'r') as f:
-        inp_data = f.read()
+# Compact dtypes of the particle tables: the numbers of particles, fields
+# and phases as int32, text as categorical and the measurements as float32
+# (7 significant digits). The stage positions in mm stay float64, the
+# particles are matched by their distance.
+ID_COLUMNS = ('Part', 'Field', 'Phase', 'Slice', 'Part_edx', 'Part_IJ',
+              'Part_no')
+POSITION_COLUMNS = ('StgX', 'StgY')
+
+
+def column_dtype(name):
+    """compact dtype of a numeric column of the particle tables"""
+
+    if name in ID_COLUMNS:
+        return 'int32'
+    if name in POSITION_COLUMNS:
+        return 'float64'
+    return 'float32'
 
-    df = pd.read_csv(BytesIO(inp_data.encode()), sep=',')
-    df.rename(columns={'Label': 'Field',
-                       ' ': 'Part',
-                       'X': 'X_cent',
-                       'Y': 'Y_cent',
-                       'Circ.': 'Circ'}, inplace=True)
 
-    def stripper(x): return re.sub("[^0-9^.]", "", str(x))
-    df.Field = pd.to_numeric(df.Field.apply(stripper))
-    df['AvgDiam'] = df.loc(axis=1)['Major', 'Minor'].mean(1) * pixelsize
+def compact_table(df, schema=None):
+    """ Converts the columns of a particle table to compact dtypes in place
+
+        schema:     dictionary with the dtype of columns, overriding the
+                    default of ID_COLUMNS (int32), POSITION_COLUMNS
+                    (float64), text (category) and numbers (float32)
+
+        An id column with missing values is float64, which holds any int32
+        exactly. The columns are converted one by one, so only one column is
+        copied at a time.
+
+        returns the DataFrame
+    """
+    import numpy as np
+    import pandas as pd
+
+    for col in df.columns:
+        dtype = None if schema is None else schema.get(col)
+        values = df[col]
+        if dtype is None:
+            if values.dtype == object:
+                dtype = 'category'
+            elif not pd.api.types.is_numeric_dtype(values.dtype):
+                continue
+            elif col in ID_COLUMNS and values.isna().any():
+                dtype = 'float64'
+            else:
+                dtype = column_dtype(col)
+        if dtype == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[col] = values.astype(dtype)
+        elif values.dtype != np.dtype(dtype):
+            df[col] = values.astype(dtype)
 
     return df
 
 
-def get_ImageJPAsearchinfo(file_ImageJPAsearch):
-    """read the ImageJ PA search file and store in pandas DataFrame"""
+def table_mb(df):
+    """memory of the columns of a DataFrame in MB"""
 
-    with open(file_ImageJPAsearch, 'r') as f:
-        inp_data = f.read()
+    return round(df.memory_usage(index=False, deep=True).sum() / 2**20, 3)
 
-    # extract the PA data
-    import_ImageJPAsearch = np.genfromtxt(BytesIO(inp_data.encode()),
-                                          delimiter=",", skip_header=0,
-                                          names=True, autostrip=True,
-                                          comments='#')
 
-    return pd.DataFrame(import_ImageJPAsearch)
+# version of the cache files of cached_table, older caches are parsed again
+CACHE_FORMAT = 2
 
 
-def get_markerpos(stub_dir):
-    """load the marker positions from the file 'marker_pos.txt'"""
+def cached_table(filename, parse, name, use_cache=True):
+    """ Parse a table once and cache it in a binary columnar file
+
+        filename:   the table to be parsed
+
+        parse:      function returning the DataFrame parsed from filename
+
+        name:       name of the parsed table, a file can be cached for
+                    several parsers
+
+        use_cache:  read and write the cache
+
+        The cache '.<filename>.<name>.npz' is stored next to the source and
+        holds one array per column, text columns with the mask of their
+        missing values. It is valid as long as the modification time and
+        size of the source and the format of the cache are unchanged.
+    """
+    import numpy as np
+    import pandas as pd
+
+    if not use_cache:
+        return parse(filename)
+
+    head, tail = os.path.split(filename)
+    cache = os.path.join(head, '.' + tail + '.' + name + '.npz')
+    stat = os.stat(filename)
+    key = np.array([stat.st_mtime_ns, stat.st_size, CACHE_FORMAT])
+
+    try:
+        with np.load(cache) as data:
+            if np.array_equal(data['key'], key):
+                trace_pipeline.add(cache_hits=1)
+                columns = data['columns']
+                df = pd.DataFrame(
+                    {col: data['c{}'.format(i)]
+                     for i, col in enumerate(columns)},
+                    columns=columns)
+                for i, col in enumerate(columns):
+                    if 'n{}'.format(i) in data.files:
+                        values = df[col].values.astype(object)
+                        values[data['n{}'.format(i)]] = np.nan
+                        df[col] = values
+                return df
+    except (OSError, KeyError, ValueError):
+        pass    # no or invalid cache, parse the source
+
+    df = parse(filename)
+    trace_pipeline.add(cache_misses=1, bytes_parsed=stat.st_size)
+
+    # Text columns are stored as fixed length strings and the mask of their
+    # missing values, which would be read back as 'nan'
+    arrays = {}
+    for i, col in enumerate(df.columns):
+        if df[col].dtype in (object, 'category'):
+            arrays['c{}'.format(i)] = np.asarray(df[col]).astype(str)
+            missing = df[col].isna().values
+            if missing.any():
+                arrays['n{}'.format(i)] = missing
+        else:
+            arrays['c{}'.format(i)] = df[col].values
+    try:
+        with open(cache, 'wb') as f:
+            np.savez(f, key=key, columns=np.array(df.columns, dtype=str),
+                     **arrays)
+    except OSError:
+        pass    # read-only stub directory, continue without cache
 
-    from os.path import join
+    return df
+
+
+def _read_numbers(file, rename=None, compact=True, **kwargs):
+    """ Parse a csv table of numbers, invalid values are NaN
+
+        rename:     dictionary renaming columns, the names are then cleaned
+                    as np.genfromtxt does
 
-    file = join(stub_dir, 'refmarkers/marker_pos.txt')
+        compact:    parse the columns directly into their compact dtypes
+                    (see column_dtype), which halves the peak memory. Tables
+                    with text or missing ids are parsed as float64 first.
 
+        kwargs:     arguments of pandas.read_csv
+    """
+    import pandas as pd
+
+    # The csv files has \r newlines, the file is opened in universal newline
+    # mode which converts the newlines to \n
     with open(file, 'r') as f:
-        inp_data = f.read()
+        raw = pd.read_csv(f, nrows=0, **kwargs).columns
+    names = _clean_names([(rename or {}).get(col, col) for col in raw])
+
+    if compact:
+        try:
+            with open(file, 'r') as f:
+                df = pd.read_csv(f, dtype={col: column_dtype(name)
+                                           for col, name in zip(raw, names)},
+                                 **kwargs)
+            df.columns = names
+            return df
+        except (ValueError, TypeError):
+            pass    # text or missing ids, coerced below
+
+    with open(file, 'r') as f:
+        df = pd.read_csv(f, **kwargs)
+    df.columns = names
+    for col in df.columns:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+    return compact_table(df) if compact else df.astype(float)
+
+
+def _parse_stubinfo(file_stub, compact=True):
+    """parse the EDAX PA search .csv file, all columns as numbers"""
+
+    return _read_numbers(file_stub, compact=compact, skiprows=14,
+                         skipinitialspace=True)
+
+
+@traced(lambda df: {'particles': len(df), 'table_mb': table_mb(df)})
+def get_stubinfo(file_stub, use_cache=True, compact=True):
+    """read the stub info file store PA search info in pandas Dataframe
+
+    compact -- int32 ids and float32 measurements (see compact_table),
+               False reads all columns as float64 without the cache
+    """
+
+    # extract the PA data
+    # gets the data from the .csv file generated from EDAX PA search
+    # the header-info has 14 lines, the column names are cleaned as
+    # np.genfromtxt does
+    if not compact:
+        return _parse_stubinfo(file_stub, compact=False)
+    # caches written before the compact dtypes are converted
+    return compact_table(cached_table(file_stub, _parse_stubinfo, 'stubinfo',
+                                      use_cache))
+
+
+def _parse_IJfile(file, compact=True):
+    """parse the imageJ PA search csv file"""
+    import pandas as pd
+
+    names = {'Label': 'Field',
+             ' ': 'Part',
+             'X': 'X_cent',
+             'Y': 'Y_cent',
+             'Circ.': 'Circ'}
+
+    # the numbers are parsed into their compact dtypes, see _read_numbers
+    df = None
+    if compact:
+        dtype = {col: column_dtype(names.get(col, col))
+                 for col in pd.read_csv(file, sep=',', nrows=0).columns
+                 if col != 'Label'}
+        try:
+            df = pd.read_csv(file, sep=',', dtype=dtype)
+        except (ValueError, TypeError):
+            pass    # invalid numbers, converted by compact_table
+    if df is None:
+        df = pd.read_csv(file, sep=',')
+    df.rename(columns=names, inplace=True)
+
+    # the field label 'fields:fld0002' is reduced to the field number
+    df.Field = pd.to_numeric(
+        df.Field.astype(str).str.replace('[^0-9^.]', '', regex=True))
+
+    return compact_table(df) if compact else df
+
+
+@traced(lambda df: {'particles': len(df), 'table_mb': table_mb(df)})
+def import_IJfile(file, pixelsize=0.23142628587258555, use_cache=True,
+                  compact=True):
+    """read the imageJ PA search csv file and store in dataframe
+
+    compact -- see get_stubinfo
+    """
+
+    if compact:
+        df = compact_table(cached_table(file, _parse_IJfile, 'IJfile',
+                                        use_cache))
+    else:
+        df = _parse_IJfile(file, compact=False)
+    df['AvgDiam'] = df[['Major', 'Minor']].mean(axis=1) * pixelsize
+
+    return df
+
+
+def _parse_ImageJPAsearchinfo(file_ImageJPAsearch, compact=True):
+    """parse the ImageJ PA search file, all columns as numbers"""
+
+    return _read_numbers(file_ImageJPAsearch, rename={'Unnamed: 0': 'Part'},
+                         compact=compact, sep=',', comment='#',
+                         skipinitialspace=True)
+
+
+@traced(lambda df: {'particles': len(df), 'table_mb': table_mb(df)})
+def get_ImageJPAsearchinfo(file_ImageJPAsearch, use_cache=True,
+                           compact=True):
+    """read the ImageJ PA search file and store in pandas DataFrame
+
+    compact -- see get_stubinfo
+    """
+
+    # extract the PA data
+    if not compact:
+        return _parse_ImageJPAsearchinfo(file_ImageJPAsearch, compact=False)
+    return compact_table(cached_table(
+        file_ImageJPAsearch, _parse_ImageJPAsearchinfo, 'ImageJPAsearchinfo',
+        use_cache))
+
+
+@traced(lambda markers: {'markers': len(markers)})
+def get_markerpos(stub_dir):
+    """load the marker positions from the file 'marker_pos.txt'"""
+    import pandas as pd
 
-    marker_import = np.genfromtxt(BytesIO(inp_data.encode()), dtype=None,
-                                  delimiter=",", skip_header=4, names=True,
-                                  autostrip=True, comments='#', encoding=None)
+    file = os.path.join(stub_dir, 'refmarkers/marker_pos.txt')
+
+    marker_import = pd.read_csv(file, sep=',', comment='#',
+                                skipinitialspace=True)
 
     # Create a dictionary
 
-    markers = {str(marker[0]):
-               (marker[1], marker[2]) for marker in marker_import}
+    markers = {str(marker[0]): (marker[1], marker[2])
+               for marker in marker_import.itertuples(index=False)}
 
     return markers
 
 
-def crop_img(image, center_x, center_y, size_x, size_y, edax_pasearch=True):
-    """crops an image given the center and the width and height"""
+def crop_windows(imgsize_x, imgsize_y, center_x, center_y, size_x, size_y,
+                 edax_pasearch=True):
+    """ Window boundaries of the particles to be cropped from a field
+
+        center_x, center_y, size_x, size_y: arrays with the particle centres
+                    and the width and height of the windows in pixels
+
+        returns the arrays x_down, x_up, y_down, y_up
+    """
+    import numpy as np
+
+    center_x = np.asarray(center_x, dtype=int)
+    center_y = np.asarray(center_y, dtype=int)
+    half_x = np.abs(np.asarray(size_x, dtype=int)) // 2
+    half_y = np.abs(np.asarray(size_y, dtype=int)) // 2
 
     # The coordinates from the stub info has (0,0) in the bottom left
     # whereas skimage uses top left as origin
     # transformation using size of img
-    imgsize_x = image.shape[1]
-    imgsize_y = image.shape[0]
-
     if (edax_pasearch):
         center_y = imgsize_y - center_y
 
-    y_down = center_y - int(np.abs(size_y/2))
-    y_up = center_y + int(np.abs(size_y/2))
-    x_down = center_x - int(np.abs(size_x/2))
-    x_up = center_x + int(np.abs(size_x/2))
+    x_down = center_x - half_x
+    x_up = center_x + half_x
+    y_down = center_y - half_y
+    y_up = center_y + half_y
 
-    # the window to be cropped should be within bounds of the image
-    if x_down < 0:           # shift to positive x
-        shift = np.abs(x_down)
-        x_down += shift
-        x_up += shift
+    # the window to be cropped should be within bounds of the image,
+    # shift to positive if below zero, else to negative if above the size
+    shift_x = np.where(x_down < 0, -x_down, np.minimum(imgsize_x - x_up, 0))
+    shift_y = np.where(y_down < 0, -y_down, np.minimum(imgsize_y - y_up, 0))
 
-    elif x_up > imgsize_x:   # shift to negative x
-        shift = x_up - imgsize_x
-        x_down -= shift
-        x_up -= shift
+    return x_down + shift_x, x_up + shift_x, y_down + shift_y, y_up + shift_y
 
-    if y_down < 0:             # shift to positive y
-        shift = np.abs(y_down)
-        y_down += shift
-        y_up += shift
 
-    elif y_up > imgsize_y:     # shift to negative y
-        shift = y_up - imgsize_y
-        y_down -= shift
-        y_up -= shift
+def crop_imgs(image, center_x, center_y, size_x, size_y, edax_pasearch=True,
+              scale=3):
+    """ Crops the windows of all particles on a field and upscales them
 
-    rescaled_cropped_img = transform.rescale(
-        image[y_down:y_up, x_down:x_up],
-        3,
-        order=0
-    )
-    # exposure.rescale_intensity(cropped_img, out_range='uint8')
+        image:      the field image
 
-    # return the cropped image and resclaed image
-    return rescaled_cropped_img
+        center_x, center_y, size_x, size_y: arrays with the particle centres
+                    and the width and height of the windows in pixels
 
+        scale:      integer upscaling factor (nearest neighbour)
 
-def process_fields(df_field, directory, ext, edax_pasearch=True):
-    """ Process fields and create cropped images
+        returns a list with the upscaled crops. Windows of the same size are
+        extracted together by a single fancy indexing operation.
+    """
+    import numpy as np
+
+    imgsize_y, imgsize_x = image.shape[:2]
+    x_down, x_up, y_down, y_up = crop_windows(imgsize_x, imgsize_y,
+                                              center_x, center_y,
+                                              size_x, size_y, edax_pasearch)
+    crops = [None] * len(x_down)
+
+    # windows larger than the image cannot be shifted within bounds, these
+    # are sliced one by one
+    inside = ((x_down >= 0) & (x_up <= imgsize_x) &
+              (y_down >= 0) & (y_up <= imgsize_y))
+    for i in np.flatnonzero(~inside):
+        crop = image[y_down[i]:y_up[i], x_down[i]:x_up[i]]
+        crops[i] = crop.repeat(scale, axis=0).repeat(scale, axis=1)
+
+    # nearest neighbour upscaling by repeating the row and column indices
+    width = x_up - x_down
+    height = y_up - y_down
+    for w, h in set(zip(width[inside], height[inside])):
+        group = np.flatnonzero(inside & (width == w) & (height == h))
+        rows = y_down[group, None] + np.arange(h * scale) // scale
+        cols = x_down[group, None] + np.arange(w * scale) // scale
+        stack = image[rows[:, :, None], cols[:, None, :]]
+        for i, crop in zip(group, stack):
+            crops[i] = crop
+
+    return crops
+
+
+def crop_img(image, center_x, center_y, size_x, size_y, edax_pasearch=True):
+    """crops an image given the center and the width and height"""
+
+    return crop_imgs(image, [center_x], [center_y], [size_x], [size_y],
+                     edax_pasearch)[0]
+
+
+def index_fields(df_field, columns=('Part',)):
+    """ Group the particles of a PA search by field
 
         df_field:   Pandas Dataframe object containing the field info
 
-        directory:  path object for the sample directory
+        columns:    columns to be stored in the index
 
-        ext:        String containing the extension
+        returns a dictionary with an entry for each field, in the order the
+        fields appear in df_field. Each entry is a dictionary with the values
+        of the columns for the particles on that field as numpy arrays.
     """
+    import numpy as np
 
-    # if cropped files are present, ask if user really wants to reprocess
-
-    # Create list of images to be loaded and cropped from stub data
-    fields = df_field.Field
-    img_list = [directory + '/fields/' +
-                'fld' + '{:0>4d}'.format(int(field_no)) +
-                ext for field_no in fields]
-    coll = io.ImageCollection(img_list, conserve_memory=False)
-
-    # Loop over fields
-    for field_no, field in enumerate(fields):
-        # fetch the image from the ic
-        img = coll[field_no]
-
-        # fetch the index of particles on the field
-        particles = df_field[df_field.loc[:, 'Field'] == field].Part.values
-
-        # Loop over particles
-        for particle_no, particle in enumerate(particles):
-            x_c, y_c = df_field.loc[df_field.loc[:, 'Part'] == particle,
-                                    ['X_cent', 'Y_cent']].values.flatten()
-            if (edax_pasearch):
-                x_size, y_size = df_field.loc[
-                    df_field.loc[:, 'Part'] ==
-                    particle, ['X_width', 'Y_height']].values.flatten()
-            else:
-                x_size, y_size = 32, 25
+    # a stable sort keeps the order of the particles within each field
+    fields = df_field.Field.values
+    order = np.argsort(fields, kind='stable')
+    field_nos, starts, counts = np.unique(fields[order], return_index=True,
+                                          return_counts=True)
+    data = {col: df_field[col].values[order] for col in columns}
+
+    index = {}
+    for i in np.argsort(order[starts]):
+        rows = slice(starts[i], starts[i] + counts[i])
+        index[field_nos[i]] = {col: values[rows]
+                               for col, values in data.items()}
+
+    return index
+
+
+def particle_numbers(df_field):
+    """ Number of each particle on its field, from 0 in the order of the
+        table, the number of its thumbnail (see crop_filename)
+
+        The thumbnails are cropped from the complete PA search. A table
+        without some of its particles keeps their numbers in the column
+        'Part_no', see deduplicate_particles.
+    """
+
+    if 'Part_no' in df_field.columns:
+        return df_field['Part_no'].values
+    return df_field.groupby('Field', sort=False).cumcount().values
+
+
+def crop_filename(directory, field, particle_no, ext):
+    """path of the cropped image of a particle, numbered from 0 per field"""
+
+    return (directory + '/thumbnails/' +
+            '{:0>4d}'.format(int(field)) +
+            '{:0>4d}'.format(int(particle_no) + 1) + ext)
 
-            # crop image from collection
-            cropped_img = crop_img(img, int(x_c), int(y_c),
-                                   int(x_size), int(y_size),
-                                   edax_pasearch)
 
-            # save in '/cropped/part0000.png'
+def field_crops(particles, img, edax_pasearch=True):
+    """crops all particles of a field from the field image, see crop_imgs"""
+    import numpy as np
+
+    if (edax_pasearch):
+        x_sizes, y_sizes = particles['X_width'], particles['Y_height']
+    else:
+        x_sizes = np.full(len(particles['X_cent']), 32)
+        y_sizes = np.full(len(particles['X_cent']), 25)
+
+    return crop_imgs(img, particles['X_cent'], particles['Y_cent'],
+                     x_sizes, y_sizes, edax_pasearch)
+
+
+# thumbnail formats with their Pillow format and file extension, other
+# formats are looked up in the extensions registered with Pillow
+THUMBNAIL_FORMATS = {'png': ('PNG', '.png'),
+                     'webp': ('WEBP', '.webp'),
+                     'jpeg': ('JPEG', '.jpg'),
+                     'jpg': ('JPEG', '.jpg')}
+
+
+class ThumbnailEncoder(object):
+    """ Encodes and writes the thumbnails of a run in one format
+
+        fmt:        'png', 'webp', 'jpeg' or another format supported by
+                    Pillow. A file extension like '.tif' is kept as the
+                    extension of the thumbnails.
+
+        compress_level: zlib level of PNG from 0 (fastest, largest) to 9,
+                    default 6
+
+        quality:    quality of lossy WebP and JPEG from 1 to 100. WebP is
+                    lossless if None, JPEG uses 90.
+
+        The Pillow format and its options are resolved once, the encoder is
+        passed on to the worker processes. Thumbnails are written as uint8.
+    """
+
+    def __init__(self, fmt='png', compress_level=None, quality=None):
+        from PIL import Image, features
+
+        name = fmt.lower().lstrip('.')
+        if name in THUMBNAIL_FORMATS:
+            self.format, self.ext = THUMBNAIL_FORMATS[name]
+        else:
+            Image.init()
+            self.ext = '.' + name
+            self.format = Image.registered_extensions().get(self.ext)
+            if self.format is None:
+                raise ValueError('unknown thumbnail format: ' + fmt)
+        if fmt.startswith('.'):
+            self.ext = fmt
+        if self.format == 'WEBP' and not features.check('webp'):
+            raise ValueError('Pillow is built without WebP support')
+
+        if self.format == 'PNG':
+            self.options = {'compress_level': (6 if compress_level is None
+                                               else int(compress_level))}
+        elif self.format == 'WEBP':
+            self.options = ({'lossless': True} if quality is None
+                            else {'quality': int(quality)})
+        elif self.format == 'JPEG':
+            self.options = {'quality': 90 if quality is None
+                            else int(quality)}
+        else:
+            self.options = {}
+
+    def params(self):
+        """the settings of the encoder, recorded in the manifest"""
+
+        return dict(self.options, format=self.format, ext=self.ext)
+
+    def encode(self, img):
+        """encode an image, returns the bytes of the file"""
+        import io as _io
+        import numpy as np
+        from PIL import Image
+
+        if img.dtype != np.uint8:
+            from skimage.util import img_as_ubyte
+
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                io.imsave(directory +
-                          '/cropped/' +
-                          '{:0>4d}'.format(int(field)) +
-                          '{:0>4d}'.format(int(particle_no) + 1) +
-                          ext, cropped_img
-                          )
+                img = img_as_ubyte(img)
+        if self.format == 'JPEG' and img.ndim == 3 and img.shape[2] == 4:
+            img = img[..., :3]      # JPEG has no alpha channel
+
+        buffer = _io.BytesIO()
+        Image.fromarray(img).save(buffer, self.format, **self.options)
+        return buffer.getvalue()
+
+    def save(self, filename, img):
+        """ encode and write an image
+
+            returns the encoding time in seconds and the bytes written
+        """
+
+        start = time.perf_counter()
+        data = self.encode(img)
+        seconds = time.perf_counter() - start
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return seconds, len(data)
+
+
+def save_crop(filename, cropped_img, encoder=None):
+    """ save a cropped image, e.g. in '/thumbnails/00020001.png'
+
+        encoder:    the ThumbnailEncoder, chosen by the extension of the
+                    filename if not given
+
+        returns the encoding time in seconds and the bytes written
+    """
+
+    if encoder is None:
+        encoder = ThumbnailEncoder(os.path.splitext(filename)[1])
+    return encoder.save(filename, cropped_img)
+
+
+def _encode_stats(saved):
+    """sum up the (seconds, bytes) of the saved thumbnails"""
+
+    return {'thumbnails': len(saved),
+            'encode_seconds': sum(s[0] for s in saved),
+            'bytes_written': sum(s[1] for s in saved)}
 
 
-def walk_stubdir(path):
+def crop_field(particles, directory, ext, field, img=None,
+               edax_pasearch=True, encoder=None):
+    """ Crop all particles of a single field and save the cropped images
+
+        particles:  dictionary with the arrays 'X_cent', 'Y_cent' (and
+                    'X_width', 'Y_height' for the EDAX PA search) of the
+                    particles on the field, see index_fields
+
+        directory:  path object for the sample directory
+
+        ext:        String containing the extension of the field image
+
+        field:      number of the field
+
+        img:        the field image, loaded from 'fields/' if not given
+
+        encoder:    the ThumbnailEncoder, the format of the field image if
+                    not given
+
+        returns a dictionary with the number of thumbnails, their encoding
+        time and the bytes written
+    """
+    from skimage import io
+
+    if encoder is None:
+        encoder = ThumbnailEncoder(ext)
+
+    if img is None:
+        img = io.imread(directory + '/fields/' +
+                        'fld' + '{:0>4d}'.format(int(field)) + ext)
+
+    cropped_imgs = field_crops(particles, img, edax_pasearch)
+
+    # Loop over particles
+    saved = [encoder.save(crop_filename(directory, field, particle_no,
+                                        encoder.ext), cropped_img)
+             for particle_no, cropped_img in enumerate(cropped_imgs)]
+
+    return _encode_stats(saved)
+
+
+class _ByteBudget(object):
+    """Blocks until the requested number of bytes fits into the limit"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        # a single request larger than the limit passes once nothing is used
+        with self.cond:
+            while self.used and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used -= nbytes
+            self.cond.notify_all()
+
+
+@traced()
+def crop_fields_pipelined(jobs, encoder, read_ahead=2, write_workers=2,
+                          write_buffer=64 * 2**20):
+    """ Crop fields in a pipeline of reading, cropping and writing
+
+        jobs:       list of (particles, directory, ext, field, edax_pasearch)
+                    tuples, see crop_field
+
+        encoder:    the ThumbnailEncoder
+
+        read_ahead: number of decoded fields waiting to be cropped
+
+        write_workers: number of threads encoding and writing the crops
+
+        write_buffer: bytes of cropped images waiting to be written
+
+        A reader thread decodes the next fields while the current field is
+        cropped. Peak memory is bounded by (read_ahead + 2) field images plus
+        write_buffer.
+
+        returns a list of (field, error message or None, statistics)
+        tuples, see crop_field for the statistics
+    """
+    from skimage import io
+    from concurrent.futures import ThreadPoolExecutor
+
+    fields = queue.Queue(maxsize=read_ahead)
+    budget = _ByteBudget(write_buffer)
+
+    def read_fields():
+        for job in jobs:
+            particles, directory, ext, field, edax_pasearch = job
+            try:
+                with trace_pipeline.span('decode_field', field=int(field)):
+                    img = io.imread(directory + '/fields/' + 'fld' +
+                                    '{:0>4d}'.format(int(field)) + ext)
+            except Exception as err:
+                fields.put((job, None, err))
+            else:
+                fields.put((job, img, None))
+        fields.put(None)
+
+    def write_crop(filename, cropped_img):
+        try:
+            return encoder.save(filename, cropped_img)
+        finally:
+            budget.release(cropped_img.nbytes)
+
+    reader = threading.Thread(target=read_fields, daemon=True)
+    reader.start()
+
+    errors = {}
+    writes = []
+    with ThreadPoolExecutor(max_workers=write_workers) as writer:
+        for item in iter(fields.get, None):
+            (particles, directory, ext, field, edax_pasearch), img, err = item
+            errors[field] = err
+            if err is not None:
+                continue
+            try:
+                with trace_pipeline.span('crop_field', field=int(field),
+                                         particles=len(particles['X_cent'])):
+                    cropped_imgs = field_crops(particles, img, edax_pasearch)
+            except Exception as err:
+                errors[field] = err
+                continue
+            del img
+
+            for particle_no, cropped_img in enumerate(cropped_imgs):
+                budget.acquire(cropped_img.nbytes)
+                writes.append((field, writer.submit(
+                    write_crop,
+                    crop_filename(directory, field, particle_no,
+                                  encoder.ext),
+                    cropped_img)))
+            del cropped_imgs
+    reader.join()
+
+    saved = {field: [] for field in errors}
+    for field, write in writes:
+        if write.exception() is None:
+            saved[field].append(write.result())
+        elif errors[field] is None:
+            errors[field] = write.exception()
+
+    stats = {field: _encode_stats(saved[field]) for field in errors}
+    trace_pipeline.add(fields=len(errors),
+                       crops_written=sum(len(s) for s in saved.values()))
+
+    return [(field, None if err is None else
+             '{}: {}'.format(type(err).__name__, err), stats[field])
+            for field, err in errors.items()]
+
+
+def file_digest(filename, previous=None):
+    """ Fingerprint of a file: modification time, size and SHA-1 hash
+
+        previous:   an earlier fingerprint of the file. If mtime and size
+                    are unchanged its hash is reused without reading the file
+    """
+
+    stat = os.stat(filename)
+    digest = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if (previous is not None and previous.get('mtime') == digest['mtime']
+            and previous.get('size') == digest['size']):
+        digest['sha1'] = previous['sha1']
+    else:
+        with open(filename, 'rb') as f:
+            digest['sha1'] = hashlib.sha1(f.read()).hexdigest()
+
+    return digest
+
+
+def particles_digest(particles):
+    """SHA-1 hash of the particle arrays of a field, see index_fields"""
+    import numpy as np
+
+    sha1 = hashlib.sha1()
+    for col in sorted(particles):
+        sha1.update(col.encode())
+        sha1.update(np.ascontiguousarray(particles[col]).tobytes())
+    return sha1.hexdigest()
+
+
+def load_manifest(directory):
+    """load the manifest of the cropped images, empty if there is none"""
+
+    filename = os.path.join(directory, 'thumbnails', 'manifest.json')
+    if not os.path.exists(filename):
+        return {}
+
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(directory, manifest):
+    """write the manifest of the cropped images"""
+
+    filename = os.path.join(directory, 'thumbnails', 'manifest.json')
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def _remove_crops(directory, key, ext, start, stop):
+    """remove the cropped images of the particles start to stop of a field"""
+
+    for particle_no in range(start, stop):
+        stale = crop_filename(directory, int(key), particle_no, ext)
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+def _crop_field_job(args, encoder):
+    """run crop_field in a worker process, return the error per field"""
+
+    particles, directory, ext, field, edax_pasearch = args
+    try:
+        stats = crop_field(particles, directory, ext, field,
+                           edax_pasearch=edax_pasearch, encoder=encoder)
+    except Exception as err:
+        return field, '{}: {}'.format(type(err).__name__, err), None
+    return field, None, stats
+
+
+def thumbnail_report(encoder, stats):
+    """ Print the encoding time and size per thumbnail
+
+        stats:      list of the statistics of the fields, see crop_field
+
+        returns a dictionary with the number of thumbnails, the encoding
+        time and the bytes written in total and per thumbnail
+    """
+
+    report = _encode_stats([])
+    for field_stats in stats:
+        for key in report:
+            report[key] += field_stats[key]
+    report['format'] = encoder.format
+    n = max(report['thumbnails'], 1)
+    report['ms_per_thumbnail'] = 1e3 * report['encode_seconds'] / n
+    report['bytes_per_thumbnail'] = report['bytes_written'] / n
+
+    if report['thumbnails']:
+        print('{} thumbnails encoded as {} in {:.2f} s: {:.2f} ms and '
+              '{:.1f} kB per thumbnail'.format(
+                  report['thumbnails'], report['format'],
+                  report['encode_seconds'], report['ms_per_thumbnail'],
+                  report['bytes_per_thumbnail'] / 1e3))
+
+    return report
+
+
+@traced()
+def process_fields(df_field, directory, ext, edax_pasearch=True, workers=1,
+                   incremental=True, read_ahead=2, write_workers=2,
+                   write_buffer=64 * 2**20, encoder=None):
+    """ Process fields and create cropped images
+
+        df_field:   Pandas Dataframe object containing the field info
+
+        directory:  path object for the sample directory
+
+        ext:        String containing the extension of the field images
+
+        workers:    number of worker processes, the fields are split among
+                    the workers. 1 processes the fields serially, None uses
+                    all cores.
+
+        incremental: only reprocess fields whose image, particles or
+                    processing parameters changed since the last run, as
+                    recorded in 'thumbnails/manifest.json'
+
+        read_ahead, write_workers, write_buffer: settings of the reading and
+                    writing pipeline of the serial processing, see
+                    crop_fields_pipelined
+
+        encoder:    ThumbnailEncoder of the cropped images, the format of
+                    the field images if None. The encoding time and size
+                    per thumbnail are reported, see thumbnail_report.
+
+        returns a dictionary with the error message of each failed field
+    """
+    if encoder is None:
+        encoder = ThumbnailEncoder(ext)
+
+    # Each field is processed once, the particles of a field go to the same
+    # worker
+    columns = ['X_cent', 'Y_cent']
+    if (edax_pasearch):
+        columns += ['X_width', 'Y_height']
+    particle_index = index_fields(df_field, columns)
+
+    # The manifest records the inputs of every processed field. It is
+    # discarded completely when the processing parameters change.
+    params = {'ext': ext, 'edax_pasearch': edax_pasearch,
+              'thumbnails': encoder.params()}
+    manifest = load_manifest(directory) if incremental else {}
+    if manifest.get('params') != params:
+        # thumbnails of another format are not overwritten, remove them
+        previous = manifest.get('params', {})
+        previous_ext = previous.get('thumbnails', previous).get('ext')
+        if previous_ext is not None and previous_ext != encoder.ext:
+            for key, entry in manifest.get('fields', {}).items():
+                _remove_crops(directory, key, previous_ext, 0,
+                              entry.get('count', 0))
+        manifest = {}
+    done = manifest.get('fields', {})
+
+    jobs = []
+    entries = {}
+    for field, particles in particle_index.items():
+        key = '{:0>4d}'.format(int(field))
+        previous = done.get(key, {})
+        try:
+            image = file_digest(directory + '/fields/' + 'fld' + key + ext,
+                                previous.get('image'))
+        except OSError:
+            image = None    # reported when the field is cropped
+        entry = {'image': image,
+                 'particles': particles_digest(particles),
+                 'count': len(particles['X_cent'])}
+        entries[key] = entry
+
+        outputs = [crop_filename(directory, field, particle_no, encoder.ext)
+                   for particle_no in range(entry['count'])]
+        # the mtime only serves to skip hashing, a touched but unchanged
+        # field image is not reprocessed
+        unchanged = (image is not None and previous.get('image')
+                     and previous['image']['sha1'] == image['sha1']
+                     and previous['particles'] == entry['particles']
+                     and previous['count'] == entry['count'])
+        if unchanged and all(map(os.path.exists, outputs)):
+            continue
+
+        _remove_crops(directory, key, encoder.ext, entry['count'],
+                      previous.get('count', 0))
+        jobs.append((particles, directory, ext, field, edax_pasearch))
+
+    # fields which are no longer part of the PA search
+    for key in set(done) - set(entries):
+        _remove_crops(directory, key, encoder.ext, 0,
+                      done[key].get('count', 0))
+
+    if incremental:
+        print('{} of {} fields up to date'.format(
+            len(entries) - len(jobs), len(entries)))
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_crop_field_job, jobs,
+                                    [encoder] * len(jobs)))
+    else:
+        results = crop_fields_pipelined(jobs, encoder, read_ahead=read_ahead,
+                                        write_workers=write_workers,
+                                        write_buffer=write_buffer)
+
+    errors = {field: error for field, error, _ in results
+              if error is not None}
+    report = thumbnail_report(encoder, [stats for _, _, stats in results
+                                        if stats is not None])
+    trace_pipeline.add(fields=len(entries), fields_processed=len(jobs),
+                       particles=len(df_field), failed_fields=len(errors),
+                       thumbnails=report['thumbnails'],
+                       encode_seconds=report['encode_seconds'],
+                       bytes_written=report['bytes_written'])
+    for field, error in errors.items():
+        print('Field {:0>4d} failed: {}'.format(int(field), error))
+        # failed fields are reprocessed in the next run
+        del entries['{:0>4d}'.format(int(field))]
+
+    save_manifest(directory, {'params': params, 'fields': entries})
+
+    return errors
+
+
+@traced(lambda columns: {'thumbnails': len(columns['atlas'])})
+def _channels(img):
+    """number of channels of an image, 1 for grey"""
+
+    return 1 if img.ndim == 2 else img.shape[2]
+
+
+def _to_channels(img, channels):
+    """ Convert an image to grey (1), grey and alpha (2), RGB (3) or RGBA
+        (4) channels, the grey is repeated for the colours and the alpha is
+        opaque if the image has none
+    """
+    import numpy as np
+
+    if _channels(img) == channels:
+        return img
+    if img.ndim == 2:
+        img = img[..., None]
+    colour = img[..., :3] if img.shape[2] >= 3 else img[..., :1]
+    if channels >= 3 and colour.shape[2] == 1:
+        colour = np.repeat(colour, 3, axis=2)
+    if channels % 2 == 0:
+        if img.shape[2] % 2 == 0:
+            alpha = img[..., -1:]
+        else:
+            opaque = (np.iinfo(img.dtype).max
+                      if np.issubdtype(img.dtype, np.integer) else 1)
+            alpha = np.full(img.shape[:2] + (1,), opaque, dtype=img.dtype)
+        colour = np.concatenate([colour, alpha], axis=2)
+    return colour[..., 0] if channels == 1 else colour
+
+
+def build_atlas(imgs, directory, sheet_size=4096):
+    """ Pack the thumbnails into a few sprite sheets
+
+        imgs:       list of thumbnail paths relative to the directory, see
+                    PB_GeneratePage.create_imagelist
+
+        directory:  path object for the sample directory, the sheets are
+                    written to 'thumbnails/atlas000.png', ...
+
+        sheet_size: maximal width and height of a sheet in pixels
+
+        The thumbnails are placed in rows from left to right, only one
+        sheet is kept in memory. Missing thumbnails get an empty entry.
+        Grey and colour thumbnails, with or without alpha, share the sheets
+        with the channels of all of them (see _to_channels). Thumbnails of
+        different dtypes raise a ValueError.
+
+        returns a dictionary with a list for each of the columns 'atlas'
+        (path of the sheet), 'atlas_x', 'atlas_y' (offset of the thumbnail
+        on the sheet), 'atlas_w' and 'atlas_h' (size of the thumbnail)
+    """
+    import numpy as np
+    from skimage import io
+
+    columns = {'atlas': [], 'atlas_x': [], 'atlas_y': [],
+               'atlas_w': [], 'atlas_h': []}
+    sheet = None
+    sheet_no = 0
+    x = y = row_height = 0
+
+    def save_sheet():
+        sheet_path = 'thumbnails/atlas{:0>3d}.png'.format(sheet_no)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            io.imsave(os.path.join(directory, sheet_path),
+                      sheet[:y + row_height])
+
+    for img in imgs:
+        try:
+            thumb = io.imread(os.path.join(directory, img))
+        except (OSError, ValueError):
+            for col in columns:
+                columns[col].append('' if col == 'atlas' else 0)
+            continue
+        h, w = thumb.shape[:2]
+
+        if sheet is None:
+            sheet = np.zeros((sheet_size, sheet_size) + thumb.shape[2:],
+                             dtype=thumb.dtype)
+        elif thumb.dtype != sheet.dtype:
+            raise ValueError('{} is {}, the thumbnails before are {}'.format(
+                img, thumb.dtype, sheet.dtype))
+
+        # the sheet gets the colours and the alpha of any thumbnail
+        colour = max(_channels(sheet), _channels(thumb)) >= 3
+        alpha = _channels(sheet) % 2 == 0 or _channels(thumb) % 2 == 0
+        channels = (3 if colour else 1) + alpha
+        sheet = _to_channels(sheet, channels)
+        thumb = _to_channels(thumb, channels)
+        if x + w > sheet_size:          # next row
+            x, y, row_height = 0, y + row_height, 0
+        if y + h > sheet_size:          # next sheet
+            save_sheet()
+            sheet[:] = 0
+            sheet_no += 1
+            x = y = row_height = 0
+
+        sheet[y:y + h, x:x + w] = thumb
+
+        columns['atlas'].append(
+            'thumbnails/atlas{:0>3d}.png'.format(sheet_no))
+        columns['atlas_x'].append(x)
+        columns['atlas_y'].append(y)
+        columns['atlas_w'].append(w)
+        columns['atlas_h'].append(h)
+
+        x += w
+        row_height = max(row_height, h)
+
+    if sheet is not None:
+        save_sheet()
+
+    return columns
+
+
+# data subdirectories of a stub, walk_stubdir does not descend into them
+PRUNED_DIRS = {'fields', 'thumbnails', 'spc', 'refmarkers',
+               'Reference Markers', 'tiles', 'mosaic'}
+
+# the particles found by detect_particles.py, used by walk_stubdir only if
+# the stub has no ImageJ PA search
+DETECTED_IJ_FILE = 'IJ_PA_detected.csv'
+
+
+def _scan_dir(path, cached=None):
+    """ List a directory for walk_stubdir
+
+        cached:     the entry of the directory in the discovery index, it is
+                    reused if the modification time of the directory is
+                    unchanged (files added, removed or renamed change it)
+
+        returns the entry with the keys 'mtime_ns', 'subdirs' (not pruned)
+        and 'files' (the stub files only), None if the directory cannot be
+        read
+    """
+
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if cached is not None and cached.get('mtime_ns') == mtime_ns:
+            return cached
+
+        subdirs = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in PRUNED_DIRS:
+                        subdirs.append(entry.name)
+                elif (entry.name == 'Stub Summary.txt'
+                      or entry.name.endswith('.csv')):
+                    files.append(entry.name)
+    except OSError:
+        return None     # like os.walk, unreadable directories are skipped
+
+    return {'mtime_ns': mtime_ns, 'subdirs': sorted(subdirs),
+            'files': sorted(files)}
+
+
+def load_stub_index(index_file):
+    """load the discovery index of walk_stubdir, empty if there is none"""
+
+    try:
+        with open(index_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@traced(lambda loc: {'stubs': len(loc['stub_dir'])})
+def walk_stubdir(path, index_file=None, workers=1):
     """Walks the stub directory and extracts the locations."""
 
     """
     Keyword arguments:
     path -- the path searched for stub PA data
 
+    index_file -- json file of the discovery index. The listing of every
+                  directory is stored and reused as long as the modification
+                  time of the directory is unchanged, so a rescan only needs
+                  a stat per directory. None scans without index.
+
+    workers -- number of threads listing the directories, more than one
+               helps on network drives
+
+    The data subdirectories of the stubs (PRUNED_DIRS) are not searched and
+    no directories are created, see make_stub_dirs.
 
     returns dictionary with PA data locations as a list
     """
@@ -250,21 +1197,72 @@ def walk_stubdir(path):
     IJ_PAsearch = []
     extension = []
 
-    for root, dirs, files in os.walk(path):
-        if 'Stub Summary.txt' in files:
-            # Found directory with Stub Summary
-            stub_dir.append(root)
-
-            # Check is subdirectory 'cropped' exists, unless create
-            if 'thumbnails' not in dirs:
-                os.makedirs(os.path.join(root, 'thumbnails'))
-
-            # Look for the .csv files containing the stub info
-            for file in files:
-                if file.endswith('stub01.csv'):
-                    EDAX_PAsearch.append(os.path.join(root, file))
-                if (file.endswith('.csv') & file.startswith('IJ')):
-                    IJ_PAsearch.append(os.path.join(root, file))
+    index = load_stub_index(index_file) if index_file else {}
+    if index.get('root') != os.path.abspath(path):
+        index = {}
+    cached = index.get('dirs', {})
+    scanned = {}
+
+    pool = None
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    # breadth first, the directories of a level are listed together
+    level = [(path, '.')]
+    try:
+        while level:
+            args = ([full for full, rel in level],
+                    [cached.get(rel) for full, rel in level])
+            if pool is not None:
+                entries = list(pool.map(_scan_dir, *args))
+            else:
+                entries = list(map(_scan_dir, *args))
+
+            next_level = []
+            for (root, rel), entry in zip(level, entries):
+                if entry is None:
+                    continue
+                scanned[rel] = entry
+
+                if 'Stub Summary.txt' in entry['files']:
+                    # Found directory with Stub Summary
+                    stub_dir.append(root)
+
+                    # Look for the .csv files containing the stub info
+                    IJ_files = []
+                    for file in entry['files']:
+                        if file.endswith('stub01.csv'):
+                            EDAX_PAsearch.append(os.path.join(root, file))
+                        if (file.endswith('.csv') & file.startswith('IJ')):
+                            IJ_files.append(file)
+                    if len(IJ_files) > 1 and DETECTED_IJ_FILE in IJ_files:
+                        IJ_files.remove(DETECTED_IJ_FILE)
+                    IJ_PAsearch += [os.path.join(root, file)
+                                    for file in IJ_files]
+
+                # also pruned here for the indexes written before a
+                # directory was added to PRUNED_DIRS
+                next_level += [(os.path.join(root, name),
+                                os.path.join(rel, name))
+                               for name in entry['subdirs']
+                               if name not in PRUNED_DIRS]
+            level = next_level
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    trace_pipeline.add(dirs=len(scanned),
+                       dirs_listed=sum(entry is not cached.get(rel)
+                                       for rel, entry in scanned.items()))
+
+    if index_file:
+        try:
+            with open(index_file, 'w') as f:
+                json.dump({'root': os.path.abspath(path), 'dirs': scanned},
+                          f)
+        except OSError:
+            pass    # read-only archive, continue without index
 
     # file extension
     extension = '.png'
@@ -277,58 +1275,234 @@ def walk_stubdir(path):
     return datalocation
 
 
+def make_stub_dirs(stub_dir):
+    """create the output directories of a stub ('thumbnails')"""
+
+    os.makedirs(os.path.join(stub_dir, 'thumbnails'), exist_ok=True)
+
+
+def match_particles(df_EDAX, df_IJ, match_dist=0.005, mode='all',
+                    by_field=True):
+    """match EDAX and ImageJ particles by their stage position (StgX, StgY)
+
+    Keyword arguments:
+    df_EDAX -- DataFrame of the EDAX PA search (Part, Field, StgX, StgY)
+    df_IJ -- DataFrame of the ImageJ PA search with stage positions
+    match_dist -- match tolerance in mm
+    mode -- 'all' returns every pair closer than match_dist,
+            'nearest' only the closest ImageJ particle per EDAX particle
+    by_field -- only match particles located on the same field
+
+    returns DataFrame with the matching pairs in columns Part_edx, Part_IJ
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy.spatial import cKDTree
+
+    if mode not in ('all', 'nearest'):
+        raise ValueError("mode must be 'all' or 'nearest'")
+
+    pos_edx = df_EDAX[['StgX', 'StgY']].values
+    pos_IJ = df_IJ[['StgX', 'StgY']].values
+
+    # all pairs within the tolerance from a kd-tree over the stage positions
+    pairs = cKDTree(pos_edx).sparse_distance_matrix(
+        cKDTree(pos_IJ), match_dist, output_type='ndarray')
+    i_edx, i_IJ, dist = pairs['i'], pairs['j'], pairs['v']
+
+    # The match condition is a distance of less than match_dist
+    keep = dist < match_dist
+    if by_field:
+        keep &= (df_EDAX.Field.values[i_edx] == df_IJ.Field.values[i_IJ])
+    i_edx, i_IJ, dist = i_edx[keep], i_IJ[keep], dist[keep]
+
+    if mode == 'nearest':
+        # sort by distance per EDAX particle and keep the closest one
+        order = np.lexsort((dist, i_edx))
+        i_edx, i_IJ = i_edx[order], i_IJ[order]
+        first = np.ones(len(i_edx), dtype=bool)
+        first[1:] = i_edx[1:] != i_edx[:-1]
+        i_edx, i_IJ = i_edx[first], i_IJ[first]
+    else:
+        order = np.lexsort((i_IJ, i_edx))
+        i_edx, i_IJ = i_edx[order], i_IJ[order]
+
+    return pd.DataFrame({'Part_edx': df_EDAX.Part.values[i_edx],
+                         'Part_IJ': df_IJ.Part.values[i_IJ]},
+                        columns=['Part_edx', 'Part_IJ'])
+
+
+def duplicate_pairs(x, y, fields, tolerance=0.005):
+    """pairs of particles on different fields closer than tolerance
+
+    Keyword arguments:
+    x, y -- particle positions in mm, particles without a position have no
+            duplicates
+    fields -- field of every particle
+    tolerance -- largest distance of duplicates in mm
+
+    The positions are hashed into a grid of cells of the size of the
+    tolerance, so the pairs are found among the particles of neighbouring
+    cells only.
+
+    returns the rows i < j of the pairs and their distances
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    fields = np.asarray(fields)
+    rows = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+
+    ix = np.floor((x[rows] - x[rows].min(initial=0)) / tolerance)
+    iy = np.floor((y[rows] - y[rows].min(initial=0)) / tolerance)
+    ny = int(iy.max(initial=0)) + 3
+    keys = ix.astype(np.int64) * ny + iy.astype(np.int64)
+    order = np.argsort(keys, kind='stable')
+    rows, keys = rows[order], keys[order]
+
+    i_all, j_all = [], []
+    # the cell itself and half of its neighbours, each pair of cells once
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        start = np.searchsorted(keys, keys + dx * ny + dy, 'left')
+        stop = np.searchsorted(keys, keys + dx * ny + dy, 'right')
+        count = stop - start
+        i = np.repeat(np.arange(len(keys)), count)
+        # position of each candidate within its neighbour cell
+        j = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count,
+                                               count) + np.repeat(start, count)
+        if (dx, dy) == (0, 0):
+            keep = i < j
+            i, j = i[keep], j[keep]
+        i_all.append(rows[i])
+        j_all.append(rows[j])
+    i = np.concatenate(i_all)
+    j = np.concatenate(j_all)
+
+    dist = np.hypot(x[i] - x[j], y[i] - y[j])
+    keep = (dist < tolerance) & (fields[i] != fields[j])
+    i, j, dist = i[keep], j[keep], dist[keep]
+    swap = i > j
+    i[swap], j[swap] = j[swap], i[swap]
+    order = np.lexsort((j, i))
+
+    return i[order], j[order], dist[order]
+
+
+@traced(lambda result: {'particles': len(result[0]),
+                        'duplicates': len(result[1])})
+def deduplicate_particles(df, tolerance=0.005):
+    """merge the particles counted twice on overlapping field edges
+
+    Keyword arguments:
+    df -- DataFrame of a PA search (Part, Field, StgX, StgY, AvgDiam)
+    tolerance -- largest distance of duplicates in mm, see duplicate_pairs
+
+    Particles of different fields closer than the tolerance are one
+    particle. Of each group the particle with the largest AvgDiam is kept,
+    at the field edge the other one is cut off. The thumbnails stay cropped
+    from the complete table, the kept particles keep the number of their
+    thumbnail in the column 'Part_no' (see particle_numbers).
+
+    returns the DataFrame without the duplicates and the report, a
+    DataFrame of the removed particles (Part, Field) with the particle kept
+    instead (Part_kept, Field_kept) and their distance in um (Dist)
+    """
+    import numpy as np
+    import pandas as pd
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    i, j, dist = duplicate_pairs(df.StgX.values, df.StgY.values,
+                                 df.Field.values, tolerance)
+
+    # groups of duplicates, chains of pairs included
+    n = len(df)
+    _, group = connected_components(
+        coo_matrix((np.ones(len(i)), (i, j)), shape=(n, n)), directed=False)
+    in_pair = np.zeros(n, dtype=bool)
+    in_pair[i] = in_pair[j] = True
+
+    # the largest particle of each group, the first one for equal sizes
+    rows = np.flatnonzero(in_pair)
+    size = np.nan_to_num(df.AvgDiam.values[rows].astype(float), nan=-1)
+    rows = rows[np.lexsort((rows, -size, group[rows]))]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = group[rows][1:] != group[rows][:-1]
+    kept = np.zeros(n, dtype=np.int64)
+    kept[group[rows[first]]] = rows[first]
+
+    removed = rows[~first]
+    kept_for = kept[group[removed]]
+    report = pd.DataFrame({
+        'Part': df.Part.values[removed],
+        'Field': df.Field.values[removed],
+        'Part_kept': df.Part.values[kept_for],
+        'Field_kept': df.Field.values[kept_for],
+        'Dist': 1000 * np.hypot(
+            df.StgX.values[removed] - df.StgX.values[kept_for],
+            df.StgY.values[removed] - df.StgY.values[kept_for])},
+        columns=['Part', 'Field', 'Part_kept', 'Field_kept', 'Dist'])
+
+    keep = np.ones(n, dtype=bool)
+    keep[removed] = False
+    numbers = particle_numbers(df)
+    df = df[keep].reset_index(drop=True)
+    df['Part_no'] = numbers[keep].astype(np.int32)
+
+    return df, report
+
+
+@traced(lambda df: {'particles': len(df), 'table_mb': table_mb(df)})
 def match_EDAX_IJ_PAsearch(df_EDAX, df_IJ, match_dist=0.005,
                            size_x=2048, size_y=1600,
-                           pixelsize=0.23142628587258555):
+                           pixelsize=0.23142628587258555, mode='all'):
+    import numpy as np
+    import pandas as pd
 
     if 'X_stage' in df_IJ.columns:
         return
-    # pandas merge dataframes from ImageJ and edx PA search on Field
+    # pandas merge dataframes from ImageJ and edx PA search on Field, the
+    # first stage position of a field. This is the one copy of the ImageJ
+    # table, the columns are added to it.
     df_IJ = pd.merge(
-        df_EDAX[['Field', 'X_stage', 'Y_stage']].drop_duplicates(),
-        df_IJ, left_on='Field', right_on='Field')
+        df_EDAX[['Field', 'X_stage', 'Y_stage']].drop_duplicates('Field'),
+        df_IJ, on='Field', copy=False)
 
-    df_IJ['StgX'] = (df_IJ['X_stage'] / 1000
+    # the positions are float64 as in the EDAX table (POSITION_COLUMNS)
+    df_IJ['StgX'] = (df_IJ['X_stage'].astype(float) / 1000
                      + pixelsize / 1000
-                     * (df_IJ['X_cent'] - size_x / 2))
+                     * (df_IJ['X_cent'].astype(float) - size_x / 2))
 
-    df_IJ['StgY'] = (df_IJ['Y_stage'] / 1000
+    df_IJ['StgY'] = (df_IJ['Y_stage'].astype(float) / 1000
                      + pixelsize / 1000
-                     * (size_y - df_IJ['Y_cent'] - size_y / 2 - 160))
-
-    matches = []
-    for field in np.unique(df_EDAX.Field.values):
-        edx_particles = df_EDAX[df_EDAX.Field == field].Part
-        edx_data = df_EDAX[df_EDAX.Field == field]
-        IJ_data = df_IJ[df_IJ.Field == field]
-        for edx_particle in edx_particles:
-            pos_edx = np.array(edx_data[edx_data.Part == edx_particle].StgX,
-                               edx_data[edx_data.Part == edx_particle].StgY)
-
-            # Loop to find a match in the IJ PA search
-            for IJ_particle in IJ_data.Part:
-                pos_IJ = np.array(IJ_data[IJ_data.Part == IJ_particle].StgX,
-                                  IJ_data[IJ_data.Part == IJ_particle].StgY)
-                dist = np.linalg.norm(pos_edx - pos_IJ)
-                # The match condition is a distance of less than 5 µm
-                if (dist < match_dist):
-                    matches.append([edx_particle, IJ_particle])
-
-    df_match = pd.DataFrame(matches, columns=['Part_edx', 'Part_IJ'])
-
-    # create a df to align EDAX data using the matching particles
-    drop_columns = ['Part_edx', 'Part', 'Field', 'X_cent', 'Y_cent',
-                    'X_stage', 'Y_stage', 'AvgDiam', 'Area', 'Perim']
-    new = pd.merge(df_EDAX, df_match, left_on='Part', right_on='Part_edx',
-                   how='left').drop(drop_columns, axis=1)
+                     * (size_y - df_IJ['Y_cent'].astype(float) - size_y / 2
+                        - 160))
+
+    df_match = match_particles(df_EDAX, df_IJ, match_dist=match_dist,
+                               mode=mode, by_field=True)
+
+    # the EDAX data of the first matching EDAX particle of every ImageJ
+    # particle, only the matched rows and the columns not in the ImageJ
+    # table are copied
+    drop_columns = ['Part', 'Field', 'X_cent', 'Y_cent',
+                    'X_stage', 'Y_stage', 'AvgDiam', 'Area', 'Perim',
+                    'Part_no']
+    df_match = df_match.drop_duplicates('Part_IJ')
+    first = pd.Series(np.arange(len(df_EDAX)), index=df_EDAX.Part.values)
+    rows = first[~first.index.duplicated()].reindex(
+        df_match.Part_edx.values).values
+    matched = pd.DataFrame({col: df_EDAX[col].values[rows]
+                            for col in df_EDAX.columns
+                            if col not in drop_columns})
+    matched['Part_IJ'] = df_match.Part_IJ.values
 
     # align with the ImageJPAsearch file
-    df_IJ = pd.merge(df_IJ, new, left_on='Part', right_on='Part_IJ',
-                     copy='False', how='left')
+    df_IJ = pd.merge(df_IJ, matched, left_on='Part', right_on='Part_IJ',
+                     copy=False, how='left')
+    df_IJ.rename(columns={'StgX_y': 'StgX', 'StgY_y': 'StgY'}, inplace=True)
 
-    return df_IJ.rename(
-        columns={'StgX_y': 'StgX',
-                 'StgY_y': 'StgY'}).drop_duplicates(subset='Part')
+    return df_IJ
 
 
 if __name__ == "__main__":
@@ -350,4 +1524,5 @@ if __name__ == "__main__":
     df = get_stubinfo(data_loc['EDAX_PAsearch'][0])
 
     # Process the images
-    process_fields(df, data_loc['stub_dir'][0], data_loc['extension'][0])
+    make_stub_dirs(data_loc['stub_dir'][0])
+    process_fields(df, data_loc['stub_dir'][0], data_loc['extension'])
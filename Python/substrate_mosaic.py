@@ -0,0 +1,417 @@
+# Mosaic of the field images and its image pyramid for the substrate plots
+#
+# usage: python substrate_mosaic.py <stub_dir> [--scale 4] [--tile-size 256]
+#
+# The field images are placed at their stage positions into a grey mosaic
+# which is memory-mapped from '<stub_dir>/mosaic/mosaic.npy', one field at
+# a time and reduced by `scale`. The image pyramid is derived from the
+# mosaic level by level, each level half the size of the one below, in
+# strips of rows. Only one field or strip is held in memory, the size of
+# the mosaic on disk grows with the number of fields.
+#
+# The pyramid is written as PNG tiles 'mosaic/<level>/<tx>_<ty>.png', level
+# 0 fits into a single tile, tiles without any field are left out. The
+# index 'mosaic/index.json' holds the geometry and the tiles of each level,
+# see create_bokehplot.makelayout for the display.
+
+import argparse
+import json
+import os
+import time
+
+from trace_pipeline import traced
+
+PIXELSIZE = 0.23142628587258555     # um per pixel of the field images
+IMG_SIZE = (2048, 1600)             # width and height of the field images
+# rows of the field image between its centre and the stage position, see
+# process_PAsearch.match_EDAX_IJ_PAsearch
+Y_OFFSET = 160
+
+
+def field_numbers(stub_dir, ext='.png'):
+    """numbers of the field images in '<stub_dir>/fields'"""
+
+    numbers = []
+    for name in os.listdir(os.path.join(stub_dir, 'fields')):
+        if name.startswith('fld') and name.endswith(ext):
+            try:
+                numbers.append(int(name[3:-len(ext)]))
+            except ValueError:
+                pass
+    return sorted(numbers)
+
+
+def field_positions(df_EDAX, fields, tolerance=25.0):
+    """ Stage positions of the fields in um
+
+        df_EDAX:    the EDAX PA search, holds the positions of the fields
+                    with particles
+
+        fields:     numbers of the fields
+
+        tolerance:  largest deviation in um of the positions from a raster
+
+        The fields are scanned row by row on a raster. The positions of the
+        fields without particles are predicted from the raster fitted to
+        the known positions, they are left out if no raster fits.
+
+        returns a dictionary with the (X_stage, Y_stage) of each field
+    """
+    import numpy as np
+
+    known = df_EDAX[['Field', 'X_stage', 'Y_stage']].dropna()
+    known = known.drop_duplicates('Field')
+    positions = {int(f): (x, y) for f, x, y in known.values}
+
+    missing = [f for f in fields if f not in positions]
+    if not missing or len(positions) < 2:
+        return {f: positions[f] for f in fields if f in positions}
+
+    number = np.array(list(positions), dtype=int)
+    x, y = np.array(list(positions.values())).T
+    first = min(min(fields), number.min())
+    last = max(max(fields), number.max())
+
+    def fit(index, values):
+        design = np.column_stack([np.ones(len(index)), index])
+        coef = np.linalg.lstsq(design, values, rcond=None)[0]
+        return coef, np.abs(design @ coef - values).max()
+
+    for cols in range(2, last - first + 2):
+        row, col = np.divmod(number - first, cols)
+        x_coef, x_error = fit(col, x)
+        y_coef, y_error = fit(row, y)
+        if x_error < tolerance and y_error < tolerance:
+            row, col = np.divmod(np.array(missing) - first, cols)
+            for f, r, c in zip(missing, row, col):
+                positions[f] = (x_coef[0] + x_coef[1] * c,
+                                y_coef[0] + y_coef[1] * r)
+            break
+    else:
+        print('No raster fits the field positions, {} fields without '
+              'particles are left out'.format(len(missing)))
+
+    return {f: positions[f] for f in fields if f in positions}
+
+
+def _grey(img):
+    """grey image of a field, the mean of the colour channels"""
+    import numpy as np
+
+    if img.ndim == 2:
+        return img
+    channels = min(img.shape[2], 3)
+    total = img[..., 0].astype(np.uint16)
+    for c in range(1, channels):
+        total += img[..., c]
+    return (total // channels).astype(np.uint8)
+
+
+def _reduce(img, factor, method='max'):
+    """ block maximum or mean ('mean') of factor x factor pixels, the edges
+        are cut
+    """
+
+    if factor == 1:
+        return img
+    h, w = img.shape[0] // factor * factor, img.shape[1] // factor * factor
+    blocks = img[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    if method == 'mean':
+        return blocks.mean(axis=(1, 3)).round().astype(img.dtype)
+    return blocks.max(axis=(1, 3))
+
+
+@traced(lambda info: {'fields': info['fields']})
+def build_mosaic(stub_dir, df_EDAX, ext='.png', scale=4,
+                 pixelsize=PIXELSIZE, method='max'):
+    """ Places the field images into the memory-mapped mosaic
+
+        stub_dir:   the stub directory, the mosaic is written to
+                    'mosaic/mosaic.npy'
+
+        df_EDAX:    the EDAX PA search with the stage positions of the fields
+
+        ext:        file extension of the field images
+
+        scale:      reduction of the field images, e.g. 4 for a quarter of
+                    the width and height
+
+        pixelsize:  pixel size of the field images in um
+
+        method:     reduction of the pixels, 'max' keeps the particles
+                    visible which cover only a few pixels on the dark
+                    substrate, 'mean' averages them
+
+        returns a dictionary with the geometry of the mosaic: the position
+        of its top left corner ('x0', 'y0') and the size of a pixel
+        ('pixel') in mm, its 'width' and 'height' in pixels and the number
+        of 'fields' placed
+    """
+    import numpy as np
+    from skimage import io
+
+    fields = field_numbers(stub_dir, ext)
+    positions = field_positions(df_EDAX, fields)
+
+    # top left corner of each field in mm
+    width, height = IMG_SIZE
+    corners = {f: (x / 1000 - pixelsize / 1000 * width / 2,
+                   y / 1000 + pixelsize / 1000 * (height / 2 - Y_OFFSET))
+               for f, (x, y) in positions.items()}
+    pixel = pixelsize * scale / 1000
+    x0 = min(c[0] for c in corners.values()) if corners else 0.0
+    y0 = max(c[1] for c in corners.values()) if corners else 0.0
+    mosaic_w = int(np.ceil((max(c[0] for c in corners.values()) - x0)
+                           / pixel)) + width // scale if corners else 1
+    mosaic_h = int(np.ceil((y0 - min(c[1] for c in corners.values()))
+                           / pixel)) + height // scale if corners else 1
+
+    mosaic_dir = os.path.join(stub_dir, 'mosaic')
+    os.makedirs(mosaic_dir, exist_ok=True)
+    mosaic = np.lib.format.open_memmap(
+        os.path.join(mosaic_dir, 'mosaic.npy'), mode='w+', dtype=np.uint8,
+        shape=(mosaic_h, mosaic_w))
+
+    placed = 0
+    for field, (x, y) in corners.items():
+        try:
+            img = io.imread(os.path.join(
+                stub_dir, 'fields', 'fld{:0>4d}{}'.format(field, ext)))
+        except (OSError, ValueError) as err:
+            print('Field {:0>4d} failed: {}'.format(field, err))
+            continue
+        img = _reduce(_grey(img), scale, method)
+        col = int(round((x - x0) / pixel))
+        row = int(round((y0 - y) / pixel))
+        h = min(img.shape[0], mosaic_h - row)
+        w = min(img.shape[1], mosaic_w - col)
+        mosaic[row:row + h, col:col + w] = img[:h, :w]
+        placed += 1
+    mosaic.flush()
+    del mosaic
+
+    return {'x0': x0, 'y0': y0, 'pixel': pixel,
+            'width': mosaic_w, 'height': mosaic_h, 'fields': placed,
+            'method': method}
+
+
+@traced(lambda index: {'tiles': sum(len(t) for t in index['tiles'])})
+def build_pyramid(stub_dir, info, tile_size=256, encoder=None):
+    """ Writes the image pyramid of the mosaic as tiles
+
+        stub_dir:   the stub directory with 'mosaic/mosaic.npy'
+
+        info:       the geometry of the mosaic, see build_mosaic
+
+        tile_size:  width and height of the tiles in pixels
+
+        encoder:    process_PAsearch.ThumbnailEncoder of the tiles, PNG if
+                    None
+
+        The coarser levels are memory-mapped next to the mosaic while they
+        are derived, strip by strip, and removed afterwards.
+
+        returns the index of the pyramid, a dictionary with the geometry of
+        the mosaic, the number of levels, the tile size, the extension of
+        the tiles and the list of tiles ('<tx>_<ty>') of each level. It is
+        written to 'mosaic/index.json'.
+    """
+    import numpy as np
+
+    import process_PAsearch
+
+    if encoder is None:
+        encoder = process_PAsearch.ThumbnailEncoder('png')
+
+    mosaic_dir = os.path.join(stub_dir, 'mosaic')
+    shape = (info['height'], info['width'])
+    levels = 1
+    while max(shape) > tile_size * 2**(levels - 1):
+        levels += 1
+
+    # the levels from the finest (the mosaic) to the coarsest
+    sources = [os.path.join(mosaic_dir, 'mosaic.npy')]
+    for level in range(levels - 2, -1, -1):
+        finer = np.load(sources[-1], mmap_mode='r')
+        sources.append(os.path.join(mosaic_dir, 'level{}.npy'.format(level)))
+        coarser = np.lib.format.open_memmap(
+            sources[-1], mode='w+', dtype=np.uint8,
+            shape=((finer.shape[0] + 1) // 2, (finer.shape[1] + 1) // 2))
+        for row in range(0, finer.shape[0], 2 * tile_size):
+            strip = np.asarray(finer[row:row + 2 * tile_size])
+            # pad to even size with black
+            strip = np.pad(strip, ((0, strip.shape[0] % 2),
+                                   (0, strip.shape[1] % 2)))
+            coarser[row // 2:row // 2 + strip.shape[0] // 2] = \
+                _reduce(strip, 2, info['method'])
+        coarser.flush()
+        del finer, coarser
+
+    tiles = []
+    for level, source in enumerate(reversed(sources)):
+        image = np.load(source, mmap_mode='r')
+        level_dir = os.path.join(mosaic_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for name in os.listdir(level_dir):
+            os.remove(os.path.join(level_dir, name))
+
+        present = []
+        for ty in range(0, image.shape[0], tile_size):
+            strip = np.asarray(image[ty:ty + tile_size])
+            for tx in range(0, image.shape[1], tile_size):
+                tile = strip[:, tx:tx + tile_size]
+                if not tile.any():
+                    continue
+                key = '{}_{}'.format(tx // tile_size, ty // tile_size)
+                # the tiles at the edges are padded, all are drawn with
+                # the same size
+                tile = np.pad(tile, ((0, tile_size - tile.shape[0]),
+                                     (0, tile_size - tile.shape[1])))
+                encoder.save(os.path.join(level_dir, key + encoder.ext),
+                             tile)
+                present.append(key)
+        tiles.append(present)
+        del image
+
+    for source in sources[1:]:
+        os.remove(source)
+
+    index = dict(info, levels=levels, tile_size=tile_size, ext=encoder.ext,
+                 tiles=tiles)
+    with open(os.path.join(mosaic_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+def make_mosaic(stub_dir, df_EDAX, ext='.png', scale=4, tile_size=256,
+                method='max'):
+    """ Builds the mosaic of a stub and its image pyramid, see build_mosaic
+        and build_pyramid
+
+        returns the index of the pyramid
+    """
+
+    start = time.time()
+    info = build_mosaic(stub_dir, df_EDAX, ext, scale, method=method)
+    index = build_pyramid(stub_dir, info, tile_size)
+    print('Mosaic of {} fields, {} x {} pixels, {} levels, {:.1f} s'.format(
+        info['fields'], info['width'], info['height'], index['levels'],
+        time.time() - start))
+
+    return index
+
+
+def load_mosaic_index(stub_dir):
+    """the index of the image pyramid of a stub, None if there is none"""
+
+    filename = os.path.join(stub_dir, 'mosaic', 'index.json')
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+# Shows the tiles of the image pyramid within the visible range of a plot.
+# Attached to the start and end of its ranges with the arguments source
+# (columns url, x, y, w, h of an image_url glyph), x_range and y_range;
+# mosaic is the index of the pyramid and width the width of the plot in
+# screen pixels.
+MOSAIC_LOADER_JS = """
+    var mosaic = %s, width = %d;
+    var span = x_range.end - x_range.start;
+    // the coarsest level with at least one tile pixel per screen pixel
+    var level = mosaic.levels - 1;
+    while (level > 0 && mosaic.pixel * Math.pow(2, mosaic.levels - level)
+                        * width <= span) {
+        level--;
+    }
+    var size = mosaic.tile_size * mosaic.pixel
+               * Math.pow(2, mosaic.levels - 1 - level);
+    var present = {};
+    for (var i = 0; i < mosaic.tiles[level].length; i++) {
+        present[mosaic.tiles[level][i]] = true;
+    }
+    var tx0 = Math.max(0, Math.floor((x_range.start - mosaic.x0) / size));
+    var tx1 = Math.floor((x_range.end - mosaic.x0) / size);
+    var ty0 = Math.max(0, Math.floor((mosaic.y0 - y_range.end) / size));
+    var ty1 = Math.floor((mosaic.y0 - y_range.start) / size);
+    var data = {url: [], x: [], y: [], w: [], h: []};
+    for (var tx = tx0; tx <= tx1; tx++) {
+        for (var ty = ty0; ty <= ty1; ty++) {
+            if (!present[tx + '_' + ty]) {
+                continue;
+            }
+            data.url.push('mosaic/' + level + '/' + tx + '_' + ty
+                          + mosaic.ext);
+            data.x.push(mosaic.x0 + tx * size);
+            data.y.push(mosaic.y0 - ty * size);
+            data.w.push(size);
+            data.h.push(size);
+        }
+    }
+    if (data.url.join() != source.data.url.join()) {
+        source.data = data;
+    }
+"""
+
+
+def mosaic_tiles(index, x_range, y_range, width):
+    """ The tiles of the pyramid within a range, as MOSAIC_LOADER_JS
+        selects them: the columns url, x, y, w and h of an image_url glyph
+        (x, y is the top left corner of a tile)
+    """
+    import math
+
+    span = x_range[1] - x_range[0]
+    level = index['levels'] - 1
+    while (level > 0 and index['pixel'] * 2**(index['levels'] - level)
+           * width <= span):
+        level -= 1
+    size = (index['tile_size'] * index['pixel']
+            * 2**(index['levels'] - 1 - level))
+    present = set(index['tiles'][level])
+
+    data = {'url': [], 'x': [], 'y': [], 'w': [], 'h': []}
+    for tx in range(max(0, math.floor((x_range[0] - index['x0']) / size)),
+                    math.floor((x_range[1] - index['x0']) / size) + 1):
+        for ty in range(max(0, math.floor((index['y0'] - y_range[1]) / size)),
+                        math.floor((index['y0'] - y_range[0]) / size) + 1):
+            if '{}_{}'.format(tx, ty) not in present:
+                continue
+            data['url'].append('mosaic/{}/{}_{}{}'.format(level, tx, ty,
+                                                          index['ext']))
+            data['x'].append(index['x0'] + tx * size)
+            data['y'].append(index['y0'] - ty * size)
+            data['w'].append(size)
+            data['h'].append(size)
+
+    return data
+
+
+def mosaic_loader_code(index, width):
+    """the code of MOSAIC_LOADER_JS for a pyramid and a plot width"""
+
+    return MOSAIC_LOADER_JS % (json.dumps(index), width)
+
+
+if __name__ == "__main__":
+    import process_PAsearch
+
+    parser = argparse.ArgumentParser(
+        description='Build the mosaic of the field images of a stub.')
+    parser.add_argument('stub_dir', help='the stub directory')
+    parser.add_argument('--scale', type=int, default=4,
+                        help='reduction of the field images (default: 4)')
+    parser.add_argument('--tile-size', type=int, default=256,
+                        help='tile size of the pyramid (default: 256)')
+    parser.add_argument('--mean', action='store_true',
+                        help='average the pixels instead of their maximum')
+    args = parser.parse_args()
+
+    stub_loc = process_PAsearch.walk_stubdir(args.stub_dir)
+    make_mosaic(args.stub_dir,
+                process_PAsearch.get_stubinfo(stub_loc['EDAX_PAsearch'][0]),
+                stub_loc['extension'], scale=args.scale,
+                tile_size=args.tile_size,
+                method='mean' if args.mean else 'max')
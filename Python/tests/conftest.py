@@ -0,0 +1,8 @@
+# The modules of the Particle Browser are scripts in the directory above,
+# imported by their name as the scripts import each other
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
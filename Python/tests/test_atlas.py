@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+from skimage import io
+
+import process_PAsearch
+
+
+def write_thumbnails(directory, thumbnails):
+    os.makedirs(os.path.join(directory, 'thumbnails'))
+    imgs = []
+    for i, thumb in enumerate(thumbnails):
+        imgs.append('thumbnails/{:0>4d}.png'.format(i))
+        io.imsave(os.path.join(directory, imgs[-1]), thumb,
+                  check_contrast=False)
+    return imgs
+
+
+def test_grey_and_colour_thumbnails(tmp_path):
+    rng = np.random.RandomState(0)
+    grey = rng.randint(0, 256, (6, 8)).astype(np.uint8)
+    rgb = rng.randint(0, 256, (5, 7, 3)).astype(np.uint8)
+    rgba = rng.randint(0, 256, (4, 6, 4)).astype(np.uint8)
+    imgs = write_thumbnails(str(tmp_path), [grey, rgb, grey, rgba])
+
+    columns = process_PAsearch.build_atlas(imgs, str(tmp_path),
+                                           sheet_size=16)
+    assert columns['atlas_w'] == [8, 7, 8, 6]
+
+    opaque = np.full((6, 8, 1), 255, dtype=np.uint8)
+    expected = [np.concatenate([np.dstack([grey] * 3), opaque], axis=2),
+                np.concatenate([rgb, opaque[:5, :7]], axis=2),
+                np.concatenate([np.dstack([grey] * 3), opaque], axis=2),
+                rgba]
+    for i, thumb in enumerate(expected):
+        sheet = io.imread(os.path.join(str(tmp_path), columns['atlas'][i]))
+        x, y = columns['atlas_x'][i], columns['atlas_y'][i]
+        h, w = thumb.shape[:2]
+        np.testing.assert_array_equal(sheet[y:y + h, x:x + w], thumb)
+
+
+def test_mixed_dtypes_are_rejected(tmp_path):
+    imgs = write_thumbnails(str(tmp_path), [
+        np.zeros((4, 4), dtype=np.uint8), np.zeros((4, 4), dtype=np.uint16)])
+
+    with pytest.raises(ValueError, match='uint16'):
+        process_PAsearch.build_atlas(imgs, str(tmp_path))
@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import PB_BatchReport
+import PB_GeneratePage
+
+
+def fake_generate_page(stub_dir, EDAX_file, IJ_file, **options):
+    if stub_dir == 'crash':
+        os._exit(1)     # the worker dies like on a segfault
+    if stub_dir == 'error':
+        raise ValueError('bad header')
+    start = time.time()
+    time.sleep(0.2)
+    return {'particles': 1, 'start': start, 'end': time.time()}
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='the workers inherit the patched module by fork')
+def test_dead_worker_fails_its_stub_only(monkeypatch):
+    monkeypatch.setattr(PB_GeneratePage, 'generate_page',
+                        fake_generate_page)
+    stubs = [{'stub_dir': name, 'EDAX_PAsearch': 'stub01.csv',
+              'IJ_PAsearch': 'IJ_PA.csv'}
+             for name in ('a', 'crash', 'b', 'error', 'c', 'd')]
+
+    results = PB_BatchReport.process_stubs(stubs, {}, workers=2)
+
+    assert [r['stub_dir'] for r in results] == [
+        s['stub_dir'] for s in stubs]
+    assert [r['status'] for r in results] == ['ok', 'failed', 'ok',
+                                              'failed', 'ok', 'ok']
+    assert results[1]['error'].startswith('BrokenProcessPool')
+    assert results[3]['error'] == 'ValueError: bad header'
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='the workers inherit the patched module by fork')
+def test_stubs_after_a_dead_worker_run_in_parallel(monkeypatch):
+    monkeypatch.setattr(PB_GeneratePage, 'generate_page',
+                        fake_generate_page)
+    names = ['crash'] + ['s{}'.format(i) for i in range(8)]
+    stubs = [{'stub_dir': name, 'EDAX_PAsearch': 'stub01.csv',
+              'IJ_PAsearch': 'IJ_PA.csv'} for name in names]
+
+    results = PB_BatchReport.process_stubs(stubs, {}, workers=3)
+
+    assert [r['status'] for r in results] == ['failed'] + ['ok'] * 8
+    assert results[0]['error'].startswith('BrokenProcessPool')
+    # the largest number of stubs processed at the same time
+    ends = sorted(r['end'] for r in results[1:])
+    concurrent = max(sum(r['start'] < end <= r['end'] for r in results[1:])
+                     for end in ends)
+    assert concurrent > 1
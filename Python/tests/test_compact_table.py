@@ -0,0 +1,90 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import process_PAsearch
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'DemoData')
+
+
+def particles():
+    return pd.DataFrame({'Part': [1.0, 2.0, 3.0],
+                         'Field': np.array([7, 7, 8], dtype=np.int64),
+                         'StgX': [-3.5601234567891, 2.1, 0.000123456789],
+                         'AvgDiam': [1.39, 1.16, 1.2],
+                         'Label': ['a', 'b', 'a']})
+
+
+def test_compact_dtypes():
+    df = process_PAsearch.compact_table(particles())
+
+    assert df.Part.dtype == np.int32
+    assert df.Field.dtype == np.int32
+    assert df.StgX.dtype == np.float64
+    assert df.AvgDiam.dtype == np.float32
+    assert isinstance(df.Label.dtype, pd.CategoricalDtype)
+
+    # the values survive, the positions exactly
+    reference = particles()
+    assert list(df.Part) == [1, 2, 3]
+    np.testing.assert_array_equal(df.StgX, reference.StgX)
+    np.testing.assert_allclose(df.AvgDiam, reference.AvgDiam, rtol=1e-7)
+    assert list(df.Label) == ['a', 'b', 'a']
+
+
+def test_missing_ids_stay_float64():
+    df = particles()
+    df.loc[1, 'Part'] = np.nan
+    df = process_PAsearch.compact_table(df)
+
+    assert df.Part.dtype == np.float64
+    assert df.Part.isna().tolist() == [False, True, False]
+
+
+def test_schema_overrides_the_defaults():
+    df = process_PAsearch.compact_table(particles(),
+                                        schema={'AvgDiam': 'float64'})
+
+    assert df.AvgDiam.dtype == np.float64
+    assert df.Field.dtype == np.int32
+
+
+def test_read_compact_and_float64(tmp_path):
+    stub_file = str(tmp_path / 'stub01.csv')
+    shutil.copy(os.path.join(DEMO_DIR, 'stub01.csv'), stub_file)
+
+    wide = process_PAsearch.get_stubinfo(stub_file, compact=False)
+    assert set(wide.dtypes) == {np.dtype('float64')}
+
+    # parsed, then read back from the cache
+    for _ in range(2):
+        df = process_PAsearch.get_stubinfo(stub_file)
+        assert list(df.columns) == list(wide.columns)
+        assert df.Part.dtype == np.int32
+        assert df.Field.dtype == np.int32
+        assert df.StgX.dtype == np.float64
+        assert df.AvgDiam.dtype == np.float32
+        np.testing.assert_array_equal(df.Part, wide.Part)
+        np.testing.assert_array_equal(df.StgX, wide.StgX)
+        np.testing.assert_allclose(df.AvgDiam, wide.AvgDiam, rtol=1e-7)
+    assert os.path.exists(str(tmp_path / '.stub01.csv.stubinfo.npz'))
+
+
+def test_cached_text_with_missing_values(tmp_path):
+    source = str(tmp_path / 'table.csv')
+    with open(source, 'w') as f:
+        f.write('Part,Label,Comment\n1,a,x\n2,,y\n3,b,\n')
+
+    def parse(filename):
+        return process_PAsearch.compact_table(pd.read_csv(filename))
+
+    fresh = process_PAsearch.cached_table(source, parse, 'test')
+    cached = process_PAsearch.cached_table(source, parse, 'test')
+
+    assert cached.Label.isna().tolist() == [False, True, False]
+    assert 'nan' not in cached.Label.tolist()
+    pd.testing.assert_frame_equal(process_PAsearch.compact_table(cached),
+                                  fresh)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import process_PAsearch
+
+
+def reference_crop(image, center_x, center_y, size_x, size_y,
+                   edax_pasearch=True, scale=3):
+    """the window of one particle as cropped before the batch kernel"""
+
+    imgsize_y, imgsize_x = image.shape[:2]
+    if edax_pasearch:
+        center_y = imgsize_y - center_y
+    x_down = center_x - int(abs(size_x / 2))
+    x_up = center_x + int(abs(size_x / 2))
+    y_down = center_y - int(abs(size_y / 2))
+    y_up = center_y + int(abs(size_y / 2))
+    if x_down < 0:
+        x_down, x_up = 0, x_up - x_down
+    elif x_up > imgsize_x:
+        x_down, x_up = x_down - (x_up - imgsize_x), imgsize_x
+    if y_down < 0:
+        y_down, y_up = 0, y_up - y_down
+    elif y_up > imgsize_y:
+        y_down, y_up = y_down - (y_up - imgsize_y), imgsize_y
+
+    crop = image[y_down:y_up, x_down:x_up]
+    return crop.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+# particles within the field, at each edge and corner, with odd and
+# negative window sizes
+PARTICLES = [(50, 40, 32, 25), (3, 40, 32, 25), (98, 40, 32, 25),
+             (50, 2, 32, 25), (50, 79, 32, 25), (0, 0, 10, 10),
+             (99, 79, 10, 10), (20, 30, 7, 9), (60, 50, -12, -8),
+             (60, 50, 12, 8)]
+
+
+@pytest.fixture
+def grey():
+    return np.random.RandomState(0).randint(0, 256, (80, 100)).astype(
+        np.uint8)
+
+
+@pytest.mark.parametrize('edax_pasearch', [True, False])
+def test_crop_imgs_matches_single_crops(grey, edax_pasearch):
+    x, y, w, h = map(np.array, zip(*PARTICLES))
+    crops = process_PAsearch.crop_imgs(grey, x, y, w, h, edax_pasearch)
+
+    assert len(crops) == len(PARTICLES)
+    for crop, particle in zip(crops, PARTICLES):
+        expected = reference_crop(grey, *particle,
+                                  edax_pasearch=edax_pasearch)
+        assert crop.dtype == grey.dtype
+        np.testing.assert_array_equal(crop, expected)
+        np.testing.assert_array_equal(
+            process_PAsearch.crop_img(grey, *particle,
+                                      edax_pasearch=edax_pasearch),
+            expected)
+
+
+def test_crop_imgs_rgb(grey):
+    rgb = np.stack([grey, 255 - grey, grey // 2], axis=2)
+    x, y, w, h = map(np.array, zip(*PARTICLES))
+    crops = process_PAsearch.crop_imgs(rgb, x, y, w, h)
+
+    for crop, particle in zip(crops, PARTICLES):
+        # the channels are not scaled
+        assert crop.shape[2] == 3
+        np.testing.assert_array_equal(crop, reference_crop(rgb, *particle))
+
+
+def test_crop_imgs_window_larger_than_field(grey):
+    crops = process_PAsearch.crop_imgs(grey, [50], [40], [120], [100])
+
+    # the window cannot be shifted within bounds, it is cut at the edges
+    assert crops[0].shape == (3 * 80, 3 * 100)
+    np.testing.assert_array_equal(crops[0][::3, ::3], grey)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+import PB_GeneratePage
+import particle_tiles
+import process_PAsearch
+
+
+def overlapping_fields():
+    """
+    Three fields overlapping at x = 1 mm: particles 2 and 4 are one
+    particle, 6, 7 and 9 another, seen on three fields. Particles 1 and 3
+    are close but on the same field.
+    """
+
+    return pd.DataFrame({
+        'Part': [1, 2, 3, 4, 5, 6, 7, 8, 9],
+        'Field': [1, 1, 1, 2, 2, 2, 3, 3, 4],
+        'StgX': [0.500, 0.999, 0.502, 1.001, 1.300, 1.500, 1.502, 2.0,
+                 1.504],
+        'StgY': [0.0, 0.2, 0.0, 0.2, 0.4, 0.6, 0.6, 0.8, 0.6],
+        'AvgDiam': [1.0, 2.0, 1.0, 1.5, 1.0, 1.0, 3.0, 1.0, 2.0]})
+
+
+def brute_force_pairs(x, y, fields, tolerance):
+    pairs = []
+    for i in range(len(x)):
+        for j in range(i + 1, len(x)):
+            if (fields[i] != fields[j]
+                    and np.hypot(x[i] - x[j], y[i] - y[j]) < tolerance):
+                pairs.append((i, j))
+    return pairs
+
+
+def test_duplicate_pairs_on_overlapping_fields():
+    df = overlapping_fields()
+    i, j, dist = process_PAsearch.duplicate_pairs(
+        df.StgX.values, df.StgY.values, df.Field.values, 0.005)
+
+    assert list(zip(i, j)) == [(1, 3), (5, 6), (5, 8), (6, 8)]
+    np.testing.assert_allclose(dist[0], 0.002)
+
+
+def test_duplicate_pairs_match_brute_force():
+    rng = np.random.RandomState(1)
+    x = rng.uniform(0, 0.2, 400)
+    y = rng.uniform(0, 0.2, 400)
+    x[::50] = np.nan
+    fields = rng.randint(1, 5, 400)
+
+    i, j, dist = process_PAsearch.duplicate_pairs(x, y, fields, 0.01)
+    assert list(zip(i, j)) == brute_force_pairs(x, y, fields, 0.01)
+    np.testing.assert_allclose(dist, np.hypot(x[i] - x[j], y[i] - y[j]))
+
+
+def test_deduplicate_keeps_the_largest_particle():
+    df, report = process_PAsearch.deduplicate_particles(
+        overlapping_fields(), 0.005)
+
+    assert list(df.Part) == [1, 2, 3, 5, 7, 8]
+    assert list(df.index) == list(range(6))
+    report = report.sort_values('Part')
+    assert list(report.Part) == [4, 6, 9]
+    assert list(report.Part_kept) == [2, 7, 7]
+    assert list(report.Field_kept) == [1, 3, 3]
+    np.testing.assert_allclose(report.Dist, [2.0, 2.0, 2.0])
+
+
+def test_thumbnail_paths_survive_deduplication():
+    full = overlapping_fields()
+    df, _ = process_PAsearch.deduplicate_particles(full, 0.005)
+
+    # the kept particles point to the thumbnails cropped from the full table
+    imgs = PB_GeneratePage.create_imagelist(full, '', '.png')
+    kept = [list(full.Part).index(part) for part in df.Part]
+    assert PB_GeneratePage.create_imagelist(df, '', '.png') == [
+        imgs[i] for i in kept]
+    assert PB_GeneratePage.create_imagelist(df, '', '.png')[3] == (
+        'thumbnails/00020002.png')
+    np.testing.assert_array_equal(
+        particle_tiles.thumbnail_numbers(df),
+        particle_tiles.thumbnail_numbers(full)[kept])
+
+    # deduplicating again keeps the numbers
+    again, report = process_PAsearch.deduplicate_particles(df, 0.005)
+    assert len(report) == 0
+    assert list(again.Part_no) == list(df.Part_no)
+
+
+def test_no_duplicates():
+    df = overlapping_fields().iloc[:3]
+    deduplicated, report = process_PAsearch.deduplicate_particles(df, 0.005)
+
+    assert len(report) == 0
+    assert list(deduplicated.Part) == [1, 2, 3]
+    assert list(deduplicated.Part_no) == [0, 1, 2]
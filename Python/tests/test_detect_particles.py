@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+import detect_particles
+
+
+def field(*boxes, size=(20, 24)):
+    img = np.zeros(size, dtype=np.uint8)
+    for y0, y1, x0, x1 in boxes:
+        img[y0:y1, x0:x1] = 200
+    return img
+
+
+def test_single_pixel():
+    particles = detect_particles.detect_field(field((5, 6, 7, 8)), 1)
+
+    # the corner correction of ImageJ: 4 sides of one pixel, 2 corners
+    assert particles['Perim.'] == pytest.approx([2 * 2**0.5])
+    assert particles['Feret'] == pytest.approx([2**0.5])
+    assert particles['MinFeret'] == pytest.approx([1.0])
+    assert particles['Solidity'] == pytest.approx([1.0])
+
+
+def test_rectangle_and_ring():
+    img = field((2, 5, 3, 8), (8, 15, 10, 17))
+    img[10:13, 12:15] = 0
+    particles = detect_particles.detect_field(img, 1)
+
+    assert list(particles['Area']) == [15, 40]
+    # the hole of the ring does not add to its perimeter
+    assert particles['Perim.'] == pytest.approx(
+        [16 - 4 * (2 - 2**0.5), 28 - 4 * (2 - 2**0.5)])
+    assert particles['Feret'] == pytest.approx([34**0.5, 98**0.5])
+    assert particles['MinFeret'] == pytest.approx([3.0, 7.0])
+    # of the equal diagonals the first counterclockwise from the top left
+    assert particles['FeretAngle'][0] == pytest.approx(
+        180 - np.degrees(np.arctan2(3, 5)))
+
+
+def test_outline_of_random_particles():
+    rng = np.random.RandomState(2)
+    img = (rng.rand(40, 50) < 0.55).astype(np.uint8) * 200
+    particles = detect_particles.detect_field(img, 1)
+    labels, n = ndimage.label(img > 0, structure=np.ones((3, 3)))
+    vl, xs, ys = detect_particles.outlines(labels)
+
+    assert sorted(set(vl)) == list(range(1, n + 1))
+    for i in range(n):
+        # the hull of the outline is the hull of all pixel corners, the
+        # Feret the largest distance of the outline vertices
+        py, px = np.nonzero(labels == i + 1)
+        corners = np.concatenate([np.column_stack([px + dx, py + dy])
+                                  for dx in (0, 1) for dy in (0, 1)])
+        pts = np.column_stack([xs[vl == i + 1], ys[vl == i + 1]])
+        assert set(map(tuple, pts)) <= set(map(tuple, corners))
+        diff = corners[:, None, :] - corners[None, :, :]
+        assert particles['Feret'][i] == pytest.approx(
+            np.hypot(diff[..., 0], diff[..., 1]).max())
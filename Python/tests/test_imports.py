@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+import PB_Benchmark
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(PB_Benchmark.__file__))
+
+
+def command_line_tools():
+    """the modules with a __main__ block"""
+
+    tools = []
+    for name in sorted(os.listdir(SCRIPT_DIR)):
+        if name.endswith('.py'):
+            with open(os.path.join(SCRIPT_DIR, name), encoding='utf-8') as f:
+                if "__name__ == \"__main__\"" in f.read():
+                    tools.append(name[:-3])
+    return tools
+
+
+def test_every_command_line_tool_is_checked():
+    assert set(command_line_tools()) <= set(PB_Benchmark.CLI_MODULES)
+
+
+@pytest.mark.parametrize('module', PB_Benchmark.CLI_MODULES)
+def test_import_within_budget(module):
+    # a fresh interpreter, the heavy dependencies are imported by the
+    # functions using them
+    assert PB_Benchmark.check_imports([module]) == []
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from skimage import io
+
+import process_PAsearch
+
+
+@pytest.fixture
+def stub(tmp_path):
+    """stub directory with two fields of two particles each"""
+
+    os.makedirs(tmp_path / 'fields')
+    rng = np.random.RandomState(0)
+    for field in (1, 2):
+        io.imsave(str(tmp_path / 'fields' / 'fld{:0>4d}.png'.format(field)),
+                  rng.randint(0, 256, (80, 100)).astype(np.uint8),
+                  check_contrast=False)
+    process_PAsearch.make_stub_dirs(str(tmp_path))
+    return str(tmp_path)
+
+
+def particles(x_cent=(20, 60, 30, 70)):
+    return pd.DataFrame({'Part': [1, 2, 3, 4], 'Field': [1, 1, 2, 2],
+                         'X_cent': list(x_cent), 'Y_cent': [40, 30, 40, 50],
+                         'X_width': 12, 'Y_height': 10})
+
+
+def thumbnails(stub):
+    """modification time of every thumbnail"""
+
+    directory = os.path.join(stub, 'thumbnails')
+    return {name: os.stat(os.path.join(directory, name)).st_mtime_ns
+            for name in os.listdir(directory) if name != 'manifest.json'}
+
+
+def fields_processed(capsys):
+    """fields cropped by the last process_fields, from its report"""
+
+    out = capsys.readouterr().out
+    up_to_date, total = out.split(' fields up to date')[0].split()[-3::2]
+    return int(total) - int(up_to_date)
+
+
+def test_manifest_skips_unchanged_fields(stub, capsys):
+    process_PAsearch.process_fields(particles(), stub, '.png')
+    assert fields_processed(capsys) == 2
+    first = thumbnails(stub)
+    assert sorted(first) == ['00010001.png', '00010002.png',
+                             '00020001.png', '00020002.png']
+
+    process_PAsearch.process_fields(particles(), stub, '.png')
+    assert fields_processed(capsys) == 0
+    assert thumbnails(stub) == first
+
+
+def test_manifest_recrops_changed_particles(stub, capsys):
+    process_PAsearch.process_fields(particles(), stub, '.png')
+    capsys.readouterr()
+    first = thumbnails(stub)
+    manifest = process_PAsearch.load_manifest(stub)['fields']
+
+    # a moved particle changes the particles digest of field 2 only
+    process_PAsearch.process_fields(particles((20, 60, 31, 70)), stub,
+                                    '.png')
+    assert fields_processed(capsys) == 1
+    changed = process_PAsearch.load_manifest(stub)['fields']
+    assert changed['0001'] == manifest['0001']
+    assert changed['0002']['particles'] != manifest['0002']['particles']
+
+    second = thumbnails(stub)
+    assert second['00010001.png'] == first['00010001.png']
+    assert second['00020001.png'] != first['00020001.png']
+
+
+def test_manifest_removes_stale_thumbnails(stub, capsys):
+    process_PAsearch.process_fields(particles(), stub, '.png')
+    process_PAsearch.process_fields(particles().iloc[:3], stub, '.png')
+    capsys.readouterr()
+
+    assert sorted(thumbnails(stub)) == ['00010001.png', '00010002.png',
+                                        '00020001.png']
+    assert process_PAsearch.load_manifest(stub)['fields']['0002'][
+        'count'] == 1
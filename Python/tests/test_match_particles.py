@@ -0,0 +1,54 @@
+import pandas as pd
+
+import process_PAsearch
+
+
+def table(parts, fields, positions):
+    """PA search table of particles at stage positions (x, y) in mm"""
+
+    x, y = zip(*positions)
+    return pd.DataFrame({'Part': parts, 'Field': fields,
+                         'StgX': x, 'StgY': y})
+
+
+def pairs(df_match):
+    return list(zip(df_match.Part_edx, df_match.Part_IJ))
+
+
+def test_match_uses_the_2d_distance():
+    # EDAX 1 is within the tolerance in x only, the loop before the
+    # kd-tree compared only x and matched it first
+    df_EDAX = table([1, 2], [1, 1], [(0.0010, 1.0), (0.0, 0.0)])
+    df_IJ = table([7], [1], [(0.0012, 0.0)])
+
+    assert pairs(process_PAsearch.match_particles(df_EDAX, df_IJ)) == [
+        (2, 7)]
+
+
+def test_match_excludes_the_tolerance():
+    df_EDAX = table([1], [1], [(0.0, 0.0)])
+    df_IJ = table([7, 8], [1, 1], [(0.003, 0.004), (0.003, 0.0039)])
+
+    assert pairs(process_PAsearch.match_particles(
+        df_EDAX, df_IJ, match_dist=0.005)) == [(1, 8)]
+
+
+def test_match_nearest_by_2d_distance():
+    # ImageJ 7 is closer in x, ImageJ 8 in the plane
+    df_EDAX = table([1], [1], [(0.0, 0.0)])
+    df_IJ = table([7, 8], [1, 1], [(0.0001, 0.004), (0.002, 0.0)])
+
+    assert pairs(process_PAsearch.match_particles(df_EDAX, df_IJ)) == [
+        (1, 7), (1, 8)]
+    assert pairs(process_PAsearch.match_particles(
+        df_EDAX, df_IJ, mode='nearest')) == [(1, 8)]
+
+
+def test_match_same_field_only():
+    df_EDAX = table([1, 2], [1, 2], [(0.0, 0.0), (0.0, 0.0)])
+    df_IJ = table([7], [2], [(0.001, 0.001)])
+
+    assert pairs(process_PAsearch.match_particles(df_EDAX, df_IJ)) == [
+        (2, 7)]
+    assert pairs(process_PAsearch.match_particles(
+        df_EDAX, df_IJ, by_field=False)) == [(1, 7), (2, 7)]
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+import PB_BatchReport
+import PB_GeneratePage
+import PB_SyntheticStub
+import particle_db
+import process_PAsearch
+
+
+@pytest.fixture
+def stub(tmp_path):
+    return PB_SyntheticStub.make_stub(str(tmp_path / 'shipment' / 'stub01'),
+                                      n_fields=9, n_particles=60,
+                                      images=False)
+
+
+def count(con, table='particles'):
+    return con.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+
+def ingest(con, stub, **kwargs):
+    return particle_db.ingest_stub(con, stub['stub_dir'],
+                                   stub['EDAX_PAsearch'],
+                                   stub['IJ_PAsearch'], **kwargs)
+
+
+def test_ingest_skips_unchanged_stub(tmp_path, stub):
+    con = particle_db.connect(str(tmp_path / 'particles.sqlite'))
+
+    n = ingest(con, stub)
+    assert n > 0
+    assert count(con) == n
+    assert ingest(con, stub) == 0
+    assert count(con) == n
+
+
+def test_reingest_replaces_particles(tmp_path, stub):
+    con = particle_db.connect(str(tmp_path / 'particles.sqlite'))
+    n = ingest(con, stub)
+
+    assert ingest(con, stub, force=True) == n
+    assert count(con) == n
+
+    # new PA search files of the same stub
+    changed = PB_SyntheticStub.make_stub(stub['stub_dir'], n_fields=9,
+                                         n_particles=30, images=False,
+                                         seed=1)
+    m = ingest(con, changed)
+    assert m > 0 and m != n
+    assert count(con) == m
+    assert count(con, 'stubs') == 1
+    assert con.execute('SELECT particles FROM stubs').fetchone()[0] == m
+
+
+def test_ingest_matched_table(tmp_path, stub):
+    con = particle_db.connect(str(tmp_path / 'particles.sqlite'))
+    table = process_PAsearch.match_EDAX_IJ_PAsearch(
+        process_PAsearch.get_stubinfo(stub['EDAX_PAsearch']),
+        process_PAsearch.import_IJfile(stub['IJ_PAsearch']))
+
+    assert ingest(con, stub, table=table.iloc[:5]) == 5
+    assert count(con) == 5
+
+
+def test_batch_ingest_error_keeps_the_run(tmp_path, stub, monkeypatch):
+    PB_SyntheticStub.make_stub(str(tmp_path / 'shipment' / 'stub02'),
+                               n_fields=9, n_particles=60, images=False)
+
+    def fake_generate_page(stub_dir, EDAX_file, IJ_file, **options):
+        return {'particles': 1, 'table': 'matched ' + stub_dir}
+
+    tables = {}
+
+    def fake_ingest_stub(con, stub_dir, EDAX_file, IJ_file, table=None,
+                         dedup_dist=None):
+        if stub_dir.endswith('stub01'):
+            raise ValueError('column type conflict')
+        tables[stub_dir] = table
+        return 1
+
+    monkeypatch.setattr(PB_GeneratePage, 'generate_page',
+                        fake_generate_page)
+    monkeypatch.setattr(particle_db, 'ingest_stub', fake_ingest_stub)
+
+    summary = PB_BatchReport.batch_report(
+        str(tmp_path / 'shipment'), workers=1,
+        db_file=str(tmp_path / 'particles.sqlite'))
+
+    results = {os.path.basename(r['stub_dir']): r
+               for r in summary['results']}
+    assert summary['failed'] == 0
+    assert results['stub01']['ingest_error'] == (
+        'ValueError: column type conflict')
+    assert results['stub02']['ingested'] == 1
+    # the table matched by the worker is ingested, not returned
+    assert tables == {results['stub02']['stub_dir']:
+                      'matched ' + results['stub02']['stub_dir']}
+    assert all('table' not in r for r in summary['results'])
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+from bokeh.document import Document
+from bokeh.events import SelectionGeometry
+
+import PB_Server
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'DemoData')
+
+
+def test_points_in_polygon():
+    # a square with a notch from the top down to y = 1
+    xs = [0, 4, 4, 3, 2, 1, 0]
+    ys = [0, 0, 4, 4, 1, 4, 4]
+    x = np.array([0.5, 2.0, 2.0, 3.5, 5.0, 2.0])
+    y = np.array([0.5, 0.5, 3.0, 3.0, 2.0, -1.0])
+
+    assert list(PB_Server.points_in_polygon(x, y, xs, ys)) == [
+        True, True, False, True, False, False]
+
+
+def test_query_polygon_matches_the_rectangle():
+    rng = np.random.RandomState(0)
+    grid = PB_Server.ParticleGrid(rng.uniform(-5, 5, 2000),
+                                  rng.uniform(-5, 5, 2000))
+
+    np.testing.assert_array_equal(
+        grid.query_polygon([-1, 2, 2, -1], [-3, -3, 1, 1]),
+        grid.query(-1, 2, -3, 1))
+    # the triangle below the diagonal of the rectangle
+    rows = grid.query_polygon([-1, 2, 2], [-3, -3, 1])
+    expected = grid.query(-1, 2, -3, 1)
+    x, y = grid.x[expected], grid.y[expected]
+    np.testing.assert_array_equal(
+        rows, expected[(y + 3) / 4 < (x + 1) / 3])
+
+
+def test_selection_in_the_aggregated_view():
+    stub = PB_Server.load_stub(DEMO_DIR)
+    doc = Document()
+    PB_Server.make_document(doc, stub, max_points=10)
+    plot = doc.select_one({'name': 'positions'})
+    selection = doc.select_one({'name': 'selection'})
+
+    # more than max_points are visible, the browser has no particles
+    assert len(doc.select_one({'name': 'particles'}).data['Part']) == 0
+
+    grid = stub['grid']
+    box = {'type': 'rect', 'x0': 2.0, 'x1': -2.0, 'y0': -2.0, 'y1': 2.0}
+    plot._trigger_event(SelectionGeometry(plot, geometry=box))
+    rows = grid.query(-2, 2, -2, 2)
+    assert len(rows) > 10
+    assert list(selection.data['Part']) == list(
+        stub['particles'].Part.values[rows])
+
+    # the lasso as serialized from a typed array
+    lasso = {'type': 'poly', 'x': {'0': -2, '1': 2, '2': 2},
+             'y': {'0': -2, '1': -2, '2': 2}}
+    plot._trigger_event(SelectionGeometry(plot, geometry=lasso))
+    rows = grid.query_polygon([-2, 2, 2], [-2, -2, 2])
+    assert 0 < len(rows) < len(grid.query(-2, 2, -2, 2))
+    assert list(selection.data['Part']) == list(
+        stub['particles'].Part.values[rows])
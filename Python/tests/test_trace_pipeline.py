@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+import trace_pipeline
+
+
+def allocate(mb):
+    data = np.ones(int(mb * 2**20), dtype=np.uint8)
+    return int(data[-1])
+
+
+def records_by_name(trace):
+    return {r['name']: r for r in trace.records}
+
+
+def test_peak_memory_of_each_span():
+    with trace_pipeline.tracing() as trace:
+        with trace_pipeline.span('big'):
+            allocate(40)
+        with trace_pipeline.span('small'):
+            allocate(5)
+        with trace_pipeline.span('outer'):
+            kept = np.ones(3 * 2**20, dtype=np.uint8)
+            with trace_pipeline.span('inner'):
+                allocate(10)
+    del kept
+
+    records = records_by_name(trace)
+    # a span does not report the peak of an earlier span
+    assert records['big']['peak_mb'] == pytest.approx(40, abs=1)
+    assert records['small']['peak_mb'] == pytest.approx(5, abs=1)
+    # the peak of a nested span counts for the outer span
+    assert records['inner']['peak_mb'] == pytest.approx(10, abs=1)
+    assert records['outer']['peak_mb'] == pytest.approx(13, abs=1)
+
+
+def test_without_memory_tracing():
+    with trace_pipeline.tracing(memory=False) as trace:
+        with trace_pipeline.span('stage'):
+            allocate(1)
+
+    assert records_by_name(trace)['stage']['peak_mb'] is None
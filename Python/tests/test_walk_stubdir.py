@@ -0,0 +1,61 @@
+import os
+
+import process_PAsearch
+
+
+def make_stub(directory, files):
+    os.makedirs(directory)
+    for name in ['Stub Summary.txt', 'stub01.csv'] + files:
+        open(os.path.join(directory, name), 'w').close()
+    return str(directory)
+
+
+def test_imagej_search_preferred_to_detected(tmp_path):
+    stub = make_stub(tmp_path / 'stub', ['IJ_PA.csv',
+                                         'IJ_PA_detected.csv'])
+
+    loc = process_PAsearch.walk_stubdir(str(tmp_path))
+    assert loc['stub_dir'] == [stub]
+    assert loc['IJ_PAsearch'] == [os.path.join(stub, 'IJ_PA.csv')]
+
+
+def test_detected_particles_without_imagej(tmp_path):
+    stub = make_stub(tmp_path / 'stub', ['IJ_PA_detected.csv'])
+
+    loc = process_PAsearch.walk_stubdir(str(tmp_path))
+    assert loc['IJ_PAsearch'] == [os.path.join(stub, 'IJ_PA_detected.csv')]
+
+
+def test_output_directories_are_not_searched(tmp_path, monkeypatch):
+    stub = make_stub(tmp_path / 'stub', ['IJ_PA.csv'])
+    # a stub inside them would be found if they were searched
+    for name in ('tiles', 'mosaic'):
+        make_stub(tmp_path / 'stub' / name / '0', ['IJ_PA.csv'])
+
+    listed = []
+    scandir = os.scandir
+
+    def listing(path):
+        listed.append(os.path.relpath(path, str(tmp_path)))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', listing)
+    loc = process_PAsearch.walk_stubdir(str(tmp_path))
+    assert loc['stub_dir'] == [stub]
+    assert sorted(listed) == ['.', 'stub']
+
+
+def test_index_of_unpruned_directories(tmp_path, monkeypatch):
+    stub = make_stub(tmp_path / 'stub', ['IJ_PA.csv'])
+    for name in ('tiles', 'mosaic'):
+        make_stub(tmp_path / 'stub' / name / '0', ['IJ_PA.csv'])
+    index_file = str(tmp_path / 'index.json')
+
+    # an index written before the directories were pruned
+    monkeypatch.setattr(process_PAsearch, 'PRUNED_DIRS', set())
+    loc = process_PAsearch.walk_stubdir(str(tmp_path), index_file=index_file)
+    assert len(loc['stub_dir']) == 3
+    monkeypatch.undo()
+
+    loc = process_PAsearch.walk_stubdir(str(tmp_path), index_file=index_file)
+    assert loc['stub_dir'] == [stub]
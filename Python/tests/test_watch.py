@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import pytest
+
+import PB_GeneratePage
+import PB_Watch
+import process_PAsearch
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'DemoData')
+
+
+@pytest.fixture
+def stub(tmp_path):
+    """the DemoData stub while its last row is being written"""
+
+    for name in ('IJ_PA.csv', 'Stub Summary.txt'):
+        shutil.copy(os.path.join(DEMO_DIR, name), str(tmp_path))
+    with open(os.path.join(DEMO_DIR, 'stub01.csv'), 'rb') as f:
+        data = f.read().rstrip(b'\r\n')
+    with open(str(tmp_path / 'stub01.csv'), 'wb') as f:
+        f.write(data[:data.rindex(b',')])
+    return str(tmp_path)
+
+
+def demo_particles():
+    return len(process_PAsearch.get_stubinfo(
+        os.path.join(DEMO_DIR, 'stub01.csv'), use_cache=False))
+
+
+def test_read_table_leaves_out_the_partly_written_row(stub):
+    df = PB_Watch.read_table(os.path.join(stub, 'stub01.csv'))
+    assert len(df) == demo_particles() - 1
+
+
+def test_failed_refresh_does_not_end_the_watch(stub, monkeypatch, capsys):
+    calls = []
+
+    def fake_generate_page(stub_dir, EDAX_file, IJ_file, ext, df_EDAX=None,
+                           **options):
+        calls.append(len(df_EDAX))
+        if len(calls) == 1:
+            raise ValueError('cannot convert float NaN to integer')
+        return {'particles': len(df_EDAX)}
+
+    monkeypatch.setattr(PB_GeneratePage, 'generate_page', fake_generate_page)
+    result = PB_Watch.watch(stub, interval=0.01, report_interval=0,
+                            idle=0.2)
+
+    # the pages are made from the rows read so far
+    assert len(calls) >= 3
+    assert set(calls) == {demo_particles() - 1}
+    assert result == {'particles': demo_particles() - 1}
+    assert 'Refresh failed: ValueError' in capsys.readouterr().out
+
+
+def test_stub_files_prefer_the_imagej_search(stub):
+    detected = os.path.join(stub, process_PAsearch.DETECTED_IJ_FILE)
+    shutil.copy(os.path.join(stub, 'IJ_PA.csv'), detected)
+    assert PB_Watch.stub_files(stub)['IJ_PAsearch'] == os.path.join(
+        stub, 'IJ_PA.csv')
+
+    os.remove(os.path.join(stub, 'IJ_PA.csv'))
+    assert PB_Watch.stub_files(stub)['IJ_PAsearch'] == detected
@@ -0,0 +1,266 @@
+# Timing and memory instrumentation of the processing pipeline
+#
+# The stages of the pipeline are wrapped in spans (see span and traced).
+# While tracing is enabled every finished span is recorded with its wall
+# time, CPU time, peak memory and item counts, e.g.
+#
+#     with trace_pipeline.tracing('trace.json'):
+#         PB_GeneratePage.generate_page(...)
+#
+# The peak memory of a span is the peak of the memory allocated by Python
+# and numpy while it runs (tracemalloc) above the allocation at its start,
+# for spans running at the same time in several threads the peak of all of
+# them. The peak RSS of the process is the peak of its whole lifetime.
+#
+# While tracing is disabled a span costs a single flag check. Spans are
+# only recorded in the process which enabled tracing, not in the worker
+# processes of process_PAsearch.process_fields (workers > 1).
+
+import functools
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+_enabled = False
+_records = []
+_callback = None
+_trace_file = None
+_start = 0.0
+_memory = False
+_started_tracemalloc = False
+_running = set()    # the spans tracing their memory
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def peak_rss_mb():
+    """peak resident set size of the process in MB, None if unknown"""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def _update_peaks():
+    """
+    passes the peak of the traced memory since the last call to the running
+    spans and starts a new peak, called with _lock held
+
+    returns the memory allocated now in bytes
+    """
+
+    current, peak = tracemalloc.get_traced_memory()
+    for running in _running:
+        running.peak = max(running.peak, peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+def enabled():
+    """True while tracing is enabled"""
+
+    return _enabled
+
+
+def enable(trace_file=None, callback=None, memory=True):
+    """
+    Starts recording spans
+
+    Keyword arguments:
+    trace_file -- the records are written to this json file by disable
+
+    callback -- called with the record (a dictionary) of every finished span
+
+    memory -- trace the peak memory of every span with tracemalloc, which
+              slows down the allocations
+    """
+    global _enabled, _records, _callback, _trace_file, _start, _memory
+    global _started_tracemalloc
+
+    _records = []
+    _callback = callback
+    _trace_file = trace_file
+    _start = time.time()
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _enabled = True
+
+
+def disable():
+    """stops recording, writes the trace file and returns the records"""
+    global _enabled, _memory, _started_tracemalloc
+
+    _enabled = False
+    _memory = False
+    with _lock:
+        _running.clear()
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    if _trace_file is not None:
+        with open(_trace_file, 'w') as f:
+            json.dump({'start': time.strftime('%Y-%m-%d %H:%M:%S',
+                                              time.localtime(_start)),
+                       'spans': _records}, f, indent=1)
+
+    return _records
+
+
+class tracing(object):
+    """context manager enabling tracing, see enable"""
+
+    def __init__(self, trace_file=None, callback=None, memory=True):
+        self.trace_file = trace_file
+        self.callback = callback
+        self.memory = memory
+
+    def __enter__(self):
+        enable(self.trace_file, self.callback, self.memory)
+        return self
+
+    def __exit__(self, *exc):
+        self.records = disable()
+        return False
+
+
+class _Span(object):
+    """a running span, records itself when it is left"""
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+
+        self.allocated = None
+        if _memory:
+            with _lock:
+                self.allocated = self.peak = _update_peaks()
+                _running.add(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak = None
+        with _lock:
+            if self in _running:
+                _update_peaks()
+                _running.discard(self)
+                peak = round((self.peak - self.allocated) / 2**20, 3)
+        _local.stack.pop()
+
+        record = {'name': self.name,
+                  'parent': self.parent,
+                  'depth': self.depth,
+                  'thread': threading.current_thread().name,
+                  'start': round(self.started - _start, 6),
+                  'wall': round(wall, 6),
+                  'cpu': round(cpu, 6),
+                  'peak_mb': peak,
+                  'process_peak_rss_mb': peak_rss_mb(),
+                  'counts': self.counts}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+
+        with _lock:
+            _records.append(record)
+        if _callback is not None:
+            _callback(record)
+        return False
+
+    def add(self, **counts):
+        """add item counts to the span"""
+
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+
+class _NoSpan(object):
+    """the span used while tracing is disabled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, **counts):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **counts):
+    """
+    Context manager measuring a stage of the pipeline
+
+    Keyword arguments:
+    name -- name of the stage
+
+    counts -- initial item counts, e.g. particles=402. More counts are added
+              with the add method of the span or with the function add.
+    """
+
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, counts)
+
+
+def add(**counts):
+    """add item counts to the innermost running span of this thread"""
+
+    if not _enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1].add(**counts)
+
+
+def traced(counts=None):
+    """
+    Decorator measuring every call of a function as a span named
+    '<module>.<function>'
+
+    Keyword arguments:
+    counts -- function returning the item counts (a dictionary) from the
+              return value of the decorated function
+    """
+
+    def decorator(func):
+        name = func.__module__ + '.' + func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}) as running:
+                result = func(*args, **kwargs)
+                if counts is not None and result is not None:
+                    running.add(**counts(result))
+            return result
+
+        return wrapper
+
+    return decorator